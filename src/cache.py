@@ -0,0 +1,102 @@
+'''
+name:		cache.py
+author:		rmb
+
+description: 	A content-addressed on-disk cache of NumPy arrays
+'''
+
+import os
+import errno
+import hashlib
+import uuid
+
+import numpy as np
+
+class arrayCache():
+    '''
+    arrays are stored as .npy files named after their key. a hit bumps the file's mtime, and the
+    least recently used entries are evicted once the cache grows beyond [max_size] bytes.
+
+    entries are written to a temporary file and renamed into place, so the cache can be shared
+    between processes without locking; a reader only ever sees complete entries.
+    '''
+    def __init__(self, path, max_size, logger):
+        self.path = path
+        self.max_size = max_size
+        self.logger = logger
+        if not os.path.exists(self.path):
+            try:
+                os.makedirs(self.path)
+            except OSError, e:
+                if e.errno != errno.EEXIST:     # another process may have got there first
+                    raise
+
+    def _entry_path(self, key):
+        return os.path.join(self.path, key + '.npy')
+
+    def get(self, key):
+        '''
+        returns the array stored under [key], or None on a miss.
+        '''
+        entry = self._entry_path(key)
+        try:
+            data = np.load(entry)
+            os.utime(entry, None)
+        except (IOError, OSError, ValueError):
+            return None
+        self.logger.info("(arrayCache.get) Cache hit for " + key)
+        return data
+
+    def put(self, key, data):
+        '''
+        store [data] under [key], evicting old entries if the cache is full.
+        '''
+        entry = self._entry_path(key)
+        tmp = os.path.join(self.path, '.' + str(uuid.uuid4()) + '.tmp')
+        try:
+            with open(tmp, 'wb') as f:
+                np.save(f, data)
+            os.rename(tmp, entry)
+        except (IOError, OSError), e:
+            self.logger.warning("(arrayCache.put) Failed to cache " + key + ": " + str(e))
+            if os.path.exists(tmp):
+                os.remove(tmp)
+            return False
+        self._evict()
+        return True
+
+    def _evict(self):
+        entries = []
+        for f in os.listdir(self.path):
+            if not f.endswith('.npy'):
+                continue
+            try:
+                st = os.stat(os.path.join(self.path, f))
+            except OSError:                     # evicted by another process
+                continue
+            entries.append((st.st_mtime, st.st_size, f))
+
+        size = sum([e[1] for e in entries])
+        for mtime, fsize, f in sorted(entries):
+            if size <= self.max_size:
+                break
+            try:
+                os.remove(os.path.join(self.path, f))
+                self.logger.info("(arrayCache._evict) Evicted " + f)
+            except OSError:
+                pass
+            size = size - fsize
+
+def hash_files(paths, extra=None, blocksize=1<<20):
+    '''
+    returns a hex digest over the contents of [paths] (in order) and any [extra] values.
+    '''
+    h = hashlib.sha1()
+    for path in paths:
+        with open(path, 'rb') as f:
+            for block in iter(lambda: f.read(blocksize), ''):
+                h.update(block)
+        h.update('\0')
+    if extra is not None:
+        h.update(repr(extra))
+    return h.hexdigest()
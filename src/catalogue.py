@@ -7,16 +7,23 @@ description: 	Catalogue classes
 import subprocess
 import os
 import json
+import hashlib
+import threading
 
-import asciidata
+import numpy as np
 import pywcs
 
 from errors import errors
 from FITSFile import FITSFile
-from pysex import pysex
+from pysex import pysex, read_cat
+from cache import hash_files
+from tiles import tileStore, COLUMNS as SCS_COLUMNS
 from database import database_postgresql
 from util import read_password_file as rpf
+from util import find_delta_cones
 from ws import ws_catalogue as wsc
+from scs import decodeSCS, decodeSCSBinary, decodeSCSStream, decodeSCSBinaryStream
+import pyspherematch as pysm
 
 class Catalogue():
     def __init__(self):  
@@ -24,18 +31,164 @@ class Catalogue():
         self.REF = []
         self.RA = []
         self.DEC = [] 
+        self._tree = None
+        self._window = None
+        self.scsCache = None
+        self.scsQuantum = None
+        self.scsFormat = 'json'
+        self.scsMaxBytes = 0
         
     def _clear(self):
         pass    
         
     def insert(self):
         pass
+
+    def _toArrays(self, attrs):
+        '''
+        convert catalogue columns [attrs] that have been filled an object at a time into typed arrays, so 
+        cross-matches can index them directly.
+        '''
+        for attr in attrs:
+            setattr(self, attr, np.asarray(getattr(self, attr)))
+
+    def _insertCone(self, cone):
+        '''
+        fill the catalogue from a tile store cone search, column by column.
+        '''
+        for attr, col in self.TILE_COLUMNS:
+            setattr(self, attr, cone[col])
+
+    def _SCS(self, ip, port, raDeg, decDeg, searchRadius, magCol, magBrightLim, magFaintLim, maxNumSources):
+        '''
+        do SCS, asking the web service for [self.scsFormat] output (json or npy). if [self.scsMaxBytes] is set, 
+        the response is decoded as it streams in and the decoded rows are held to that many bytes.
+
+        returns the response as a structured array of SCS columns, or None if the web service failed or the 
+        streamed response was cut off, and whether the response was truncated (at [maxNumSources] rows or 
+        [self.scsMaxBytes] bytes) so that it may be missing the furthest objects in the cone.
+        '''
+        ws_cat = wsc(ip, port, self.err, self.logger)
+        ws_cat.SCS(self.NAME.lower(), raDeg, decDeg, searchRadius, magCol, magBrightLim, magFaintLim, 'distance', maxNumSources, self.scsFormat, 
+                   stream=self.scsMaxBytes > 0)
+        if ws_cat.status != 200:
+            return None, False
+        if self.scsMaxBytes > 0:
+            try:
+                if self.scsFormat == 'npy':
+                    data, truncated = decodeSCSBinaryStream(ws_cat.response.raw, SCS_COLUMNS[self.NAME], self.scsMaxBytes, self.logger)
+                else:
+                    data, truncated = decodeSCSStream(ws_cat.response.iter_content(chunk_size=1<<16), SCS_COLUMNS[self.NAME], self.scsMaxBytes, self.logger)
+            finally:
+                ws_cat.response.close()
+            if data is None:
+                self.err.setError(21)
+                self.err.handleError()
+                return None, False
+        elif self.scsFormat == 'npy':
+            data, truncated = decodeSCSBinary(ws_cat.content, SCS_COLUMNS[self.NAME]), False
+        else:
+            data, truncated = decodeSCS(ws_cat.text, SCS_COLUMNS[self.NAME]), False
+        return data, truncated or len(data) >= int(maxNumSources)
+
+    def _cachedSCS(self, ip, port, raDeg, decDeg, searchRadius, magCol, magBrightLim, magFaintLim, maxNumSources):
+        '''
+        do SCS through the response cache shared between processes. the cone is snapped to a grid of 
+        [self.scsQuantum] deg and padded by a quantum so nearby pointings share an entry, then trimmed back 
+        to the requested cone. hits skip both the web service and the JSON decode.
+
+        only complete responses are cached. a truncated response is missing the objects furthest from the 
+        padded cone's centre, so it is only used if it still reaches the edge of the requested cone; 
+        otherwise the requested cone is queried directly.
+
+        returns the response as a structured array of SCS columns, or None if the web service failed.
+        '''
+        q = self.scsQuantum
+        qRa, qDec = round((round(raDeg/q)*q) % 360, 6), round(round(decDeg/q)*q, 6)
+        qSr = round(np.ceil(searchRadius/q)*q + q, 6)
+        key = hashlib.sha1(repr((self.NAME, qRa, qDec, qSr, magCol, float(magBrightLim), float(magFaintLim), int(maxNumSources)))).hexdigest()
+
+        data = self.scsCache.get(key)
+        if data is None:
+            data, truncated = self._SCS(ip, port, qRa, qDec, qSr, magCol, magBrightLim, magFaintLim, maxNumSources)
+            if data is None:
+                return None
+            if not truncated:
+                self.scsCache.put(key, data)
+            else:
+                reach = pysm._great_circle_distance(qRa, qDec, data['ra'], data['dec']).max() if len(data) else 0.
+                if pysm._great_circle_distance(qRa, qDec, raDeg, decDeg) + searchRadius >= reach:
+                    self.logger.info("(" + self.__class__.__name__ + "._cachedSCS) Padded cone was truncated short of the requested cone, querying it directly")
+                    return self._SCS(ip, port, raDeg, decDeg, searchRadius, magCol, magBrightLim, magFaintLim, maxNumSources)[0]
+
+        dist = pysm._great_circle_distance(raDeg, decDeg, data['ra'], data['dec'])
+        inCone = np.flatnonzero(dist <= searchRadius)
+        return data[inCone[np.argsort(dist[inCone], kind='mergesort')]][:int(maxNumSources)]
+
+    def slide(self, pw_file, pw_file_id, raDeg, decDeg, searchRadius, limitingMag, maxNumSourcesXMatch):
+        '''
+        query the catalogue, treating the previous query as a sliding window on the sky. if the cone has only 
+        moved a little, just the newly exposed crescent is queried (as a set of small cones) and objects that 
+        have left the cone are evicted. otherwise, if the cone or magnitude limit has changed size, or if any of 
+        the small cones fails, the whole cone is requeried.
+
+        returns False if the query failed.
+        '''
+        cones = None
+        if self._window is not None and self._window[2:] == (searchRadius, limitingMag, maxNumSourcesXMatch):
+            cones = find_delta_cones(self._window[:2], (raDeg, decDeg), searchRadius)
+        
+        if cones is not None:
+            attrs = [attr for attr, col in self.TILE_COLUMNS]
+
+            # evict objects that have left the window...
+            inWindow = pysm._great_circle_distance(raDeg, decDeg, np.asarray(self.RA, dtype=float), np.asarray(self.DEC, dtype=float)) <= searchRadius
+            parts = [[np.asarray(getattr(self, attr))[inWindow] for attr in attrs]]
+            self.logger.info("(" + self.__class__.__name__ + ".slide) Kept " + str(np.count_nonzero(inWindow)) + " " + self.NAME 
+                             + " object(s) in window, querying " + str(len(cones)) + " cone(s) covering the newly exposed region")
+
+            # ...and add those that have entered it
+            for cra, cdec, sr in cones:
+                if not self.query(pw_file, pw_file_id, cra, cdec, sr, limitingMag, maxNumSourcesXMatch):
+                    self.logger.warning("(" + self.__class__.__name__ + ".slide) Query of newly exposed region failed, requerying whole cone")
+                    cones = None
+                    break
+                entered = pysm._great_circle_distance(raDeg, decDeg, np.asarray(self.RA, dtype=float), np.asarray(self.DEC, dtype=float)) <= searchRadius
+                parts.append([np.asarray(getattr(self, attr))[entered] for attr in attrs])
+
+        if cones is not None:
+            # objects picked up by more than one query are only kept once
+            columns = [np.concatenate([part[idx] for part in parts]) for idx in range(len(attrs))]
+            first = np.sort(np.unique(columns[0], return_index=True)[1])
+            self._clear()
+            for attr, column in zip(attrs, columns):
+                setattr(self, attr, column[first])
+        elif not self.query(pw_file, pw_file_id, raDeg, decDeg, searchRadius, limitingMag, maxNumSourcesXMatch):
+            self._window = None         # nothing to slide from next time
+            return False
+
+        self._window = (raDeg, decDeg, searchRadius, limitingMag, maxNumSourcesXMatch)
+        return True
+
+    def getTree(self):
+        '''
+        returns a KD-tree over the catalogue positions. it's built on first use and kept until the 
+        catalogue is next cleared, so frames reusing a previous query don't rebuild it.
+        '''
+        if self._tree is None:
+            self._tree = pysm.build_tree(self.RA, self.DEC)
+        return self._tree
       
     def query(self):
         pass
 
 class APASSCatalogue(Catalogue):
-    def __init__(self, err, logger):
+    # catalogue attributes filled from each tile store column
+    TILE_COLUMNS = [('REF', 'apassref'), ('RA', 'ra'), ('DEC', 'dec'), ('RAERR', 'raerrasec'), ('DECERR', 'decerrasec'), ('VMAG', 'vmag'), 
+                    ('BMAG', 'bmag'), ('GMAG', 'gmag'), ('RMAG', 'rmag'), ('IMAG', 'imag'), ('VMAGERR', 'verr'), ('BMAGERR', 'berr'), 
+                    ('GMAGERR', 'gerr'), ('RMAGERR', 'rerr'), ('IMAGERR', 'ierr'), ('NOBS', 'nobs')]
+
+    def __init__(self, err, logger, tiles=None, scsCache=None, scsQuantum=0.1, scsFormat='json', scsMaxBytes=0):
         Catalogue.__init__(self) 
         self.NAME = "APASS"
         self.RAERR = []
@@ -51,10 +204,16 @@ class APASSCatalogue(Catalogue):
         self.RMAGERR = [] 
         self.IMAGERR = []   
         self.NOBS = []
+        self.tiles = tiles
+        self.scsCache = scsCache
+        self.scsQuantum = scsQuantum
+        self.scsFormat = scsFormat
+        self.scsMaxBytes = scsMaxBytes
         self.err = err
         self.logger = logger
         
     def _clear(self):
+        self._tree = None
         self.REF = []
         self.RA = []
         self.DEC = []  
@@ -96,7 +255,16 @@ class APASSCatalogue(Catalogue):
     def query(self, pw_file, pw_file_id, raDeg, decDeg, searchRadius, limitingMag, maxNumSourcesXMatch, appendToCat=True):
         ''' 
         do SCS on APASS catalogue
+
+        returns False if the query failed.
         '''
+        # read from the local tile store if we have one
+        if self.tiles is not None:
+            self._clear()
+            if appendToCat:
+                self._insertCone(self.tiles.cone(raDeg, decDeg, searchRadius, 'rmag', -1, limitingMag, maxNumSourcesXMatch))
+            return True
+
         try:
             ip, port, username, password = rpf(pw_file, pw_file_id)
             port = int(port)
@@ -110,6 +278,24 @@ class APASSCatalogue(Catalogue):
         # clear internal catalogue
         self._clear()
             
+        # go through the shared response cache if we have one
+        if self.scsCache is not None:
+            if appendToCat:
+                cone = self._cachedSCS(ip, port, raDeg, decDeg, searchRadius, 'rmag', -1, limitingMag, maxNumSourcesXMatch)
+                if cone is None:
+                    return False
+                self._insertCone(cone)
+            return True
+
+        # binary output and streamed responses decode straight into columns
+        if self.scsFormat == 'npy' or self.scsMaxBytes > 0:
+            if appendToCat:
+                cone, truncated = self._SCS(ip, port, raDeg, decDeg, searchRadius, 'rmag', -1, limitingMag, maxNumSourcesXMatch)
+                if cone is None:
+                    return False
+                self._insertCone(cone)
+            return True
+
         # ws call outputs json
         ws_cat = wsc(ip, port, self.err, self.logger)
         ws_cat.SCS(self.NAME.lower(), raDeg, decDeg, searchRadius, 'rmag', -1, limitingMag, 'distance', maxNumSourcesXMatch, 'json')
@@ -138,9 +324,16 @@ class APASSCatalogue(Catalogue):
                         self.insert(apassref=APASSREF, ra=RA, dec=DEC, raerr=RAERR, decerr=DECERR, vmag=VMAG, bmag=BMAG, gmag=GMAG, rmag=RMAG, imag=IMAG, 
                                     vmagerr=VMAGERR, bmagerr=BMAGERR, gmagerr=GMAGERR, rmagerr=RMAGERR, imagerr=IMAGERR, nobs=NOBS)
                     except ValueError: 
-                        continue         
-        
+                        continue
+        self._toArrays([attr for attr, col in self.TILE_COLUMNS])
+        return ws_cat.text is not None
+
 class SkycamCatalogue(Catalogue):
+    # catalogue attributes, one per catalogue table field
+    COLUMNS = ['REF', 'RA', 'DEC', 'RAERR', 'DECERR', 'FIRSTOBSDATE', 'LASTOBSDATE', 'APASSREF', 'USNOBREF', 'NOBS', 
+               'APASSXMATCHBRCOLOUR', 'USNOBXMATCHBRCOLOUR', 'APASSXMATCHDISTASEC', 'USNOBXMATCHDISTASEC', 'ROLLINGMEANAPASSMAG', 
+               'ROLLINGSTDEVAPASSMAG', 'ROLLINGMEANUSNOBMAG', 'ROLLINGSTDEVUSNOBMAG', 'APASSNUMTIMESSWITCHED', 'USNOBNUMTIMESSWITCHED']
+
     def __init__(self, err, logger, schema):
         Catalogue.__init__(self) 
         self.NAME = schema
@@ -165,6 +358,7 @@ class SkycamCatalogue(Catalogue):
         self.logger = logger
         
     def _clear(self):
+        self._tree = None
         self.REF = []
         self.RA = []
         self.DEC = [] 
@@ -211,9 +405,39 @@ class SkycamCatalogue(Catalogue):
         self.APASSNUMTIMESSWITCHED.append(apassnumtimesswitched)  
         self.USNOBNUMTIMESSWITCHED.append(usnobnumtimesswitched)
 
+    def overlay(self, rows):
+        '''
+        overlay catalogue table upserts [rows] that haven't been flushed to the database yet, replacing any 
+        objects with the same skycamref. fields are converted as they are when read from the web service.
+        '''
+        if not rows:
+            return
+        refs = set([row['skycamref'] for row in rows])
+        keep = [i for i, ref in enumerate(self.REF) if ref not in refs]
+        for attr in self.COLUMNS:
+            values = getattr(self, attr)
+            setattr(self, attr, [values[i] for i in keep])
+        for row in rows:
+            self.insert(skycamref=str(row['skycamref']), ra=float(row['radeg']), dec=float(row['decdeg']), raerr=float(row['raerrasec']), 
+                        decerr=float(row['decerrasec']), firstobsdate=str(row['firstobs_date']) + '.000Z', 
+                        lastobsdate=str(row['lastobs_date']) + '.000Z', apassref=str(row['xmatch_apassref']), 
+                        usnobref=str(row['xmatch_usnobref']), nobs=int(row['nobs']), 
+                        apassxmatchbrcolour=str(row['xmatch_apass_brcolour']), usnobxmatchbrcolour=str(row['xmatch_usnob_brcolour']), 
+                        rollingmeanapassmag=float(row['xmatch_apass_rollingmeanmag']), 
+                        rollingstdevapassmag=float(row['xmatch_apass_rollingstdevmag']), 
+                        rollingmeanusnobmag=float(row['xmatch_usnob_rollingmeanmag']), 
+                        rollingstdevusnobmag=float(row['xmatch_usnob_rollingstdevmag']), 
+                        apassxmatchdistasec=str(row['xmatch_apass_distasec']), usnobxmatchdistasec=str(row['xmatch_usnob_distasec']), 
+                        apassnumtimesswitched=str(row['xmatch_apass_ntimesswitched']), 
+                        usnobnumtimesswitched=str(row['xmatch_usnob_ntimesswitched']))
+        self._toArrays(self.COLUMNS)
+        self._tree = None
+
     def query(self, pw_file, pw_file_id, raDeg, decDeg, searchRadius, limitingMag, maxNumSourcesXMatch, appendToCat=True):
         ''' 
         do SCS on skycam[tz?] catalogue
+
+        returns False if the query failed.
         '''
         try:
             ip, port, username, password = rpf(pw_file, pw_file_id)
@@ -266,9 +490,15 @@ class SkycamCatalogue(Catalogue):
                                     apassnumtimesswitched=APASSNUMTIMESSWITCHED, usnobnumtimesswitched=USNOBNUMTIMESSWITCHED)
                     except ValueError: 
                         continue 
+        self._toArrays(self.COLUMNS)
+        return ws_cat.text is not None
 
 class USNOBCatalogue(Catalogue):
-    def __init__(self, err, logger):
+    # catalogue attributes filled from each tile store column
+    TILE_COLUMNS = [('REF', 'usnobref'), ('RA', 'ra'), ('DEC', 'dec'), ('RAERR', 'raerrasec'), ('DECERR', 'decerrasec'), ('R1MAG', 'rmag1'), 
+                    ('B1MAG', 'bmag1'), ('R2MAG', 'rmag2'), ('B2MAG', 'bmag2')]
+
+    def __init__(self, err, logger, tiles=None, scsCache=None, scsQuantum=0.1, scsFormat='json', scsMaxBytes=0):
         Catalogue.__init__(self)  
         self.NAME = "USNOB"
         self.RAERR = []
@@ -277,10 +507,16 @@ class USNOBCatalogue(Catalogue):
         self.B1MAG = []
         self.R2MAG = []      
         self.B2MAG = []            
+        self.tiles = tiles
+        self.scsCache = scsCache
+        self.scsQuantum = scsQuantum
+        self.scsFormat = scsFormat
+        self.scsMaxBytes = scsMaxBytes
         self.err = err
         self.logger = logger
         
     def _clear(self):
+        self._tree = None
         self.REF = []
         self.RA = []
         self.DEC = []  
@@ -308,7 +544,16 @@ class USNOBCatalogue(Catalogue):
     def query(self, pw_file, pw_file_id, raDeg, decDeg, searchRadius, limitingMag, maxNumSourcesXMatch, appendToCat=True):
         ''' 
         do SCS on USNOB catalogue
+
+        returns False if the query failed.
         '''
+        # read from the local tile store if we have one
+        if self.tiles is not None:
+            self._clear()
+            if appendToCat:
+                self._insertCone(self.tiles.cone(raDeg, decDeg, searchRadius, 'rmag1', -1, limitingMag, maxNumSourcesXMatch))
+            return True
+
         try:
             ip, port, username, password = rpf(pw_file, pw_file_id)
             port = int(port)
@@ -322,6 +567,24 @@ class USNOBCatalogue(Catalogue):
         # clear internal catalogue
         self._clear()
         
+        # go through the shared response cache if we have one
+        if self.scsCache is not None:
+            if appendToCat:
+                cone = self._cachedSCS(ip, port, raDeg, decDeg, searchRadius, 'rmag1', -1, limitingMag, maxNumSourcesXMatch)
+                if cone is None:
+                    return False
+                self._insertCone(cone)
+            return True
+
+        # binary output and streamed responses decode straight into columns
+        if self.scsFormat == 'npy' or self.scsMaxBytes > 0:
+            if appendToCat:
+                cone, truncated = self._SCS(ip, port, raDeg, decDeg, searchRadius, 'rmag1', -1, limitingMag, maxNumSourcesXMatch)
+                if cone is None:
+                    return False
+                self._insertCone(cone)
+            return True
+
         # ws call outputs json
         ws_cat = wsc(ip, port, self.err, self.logger)
         ws_cat.SCS(self.NAME.lower(), raDeg, decDeg, searchRadius, 'rmag1', -1, limitingMag, 'distance', maxNumSourcesXMatch, 'json')
@@ -342,171 +605,170 @@ class USNOBCatalogue(Catalogue):
                         B2MAG       = float(entry['bmag2'])
                         self.insert(usnobref=USNOBREF, ra=RA, dec=DEC, raerr=RAERR, decerr=DECERR, r1mag=R1MAG, b1mag=B1MAG, r2mag=R2MAG, b2mag=B2MAG)
                     except ValueError: 
-                        continue    
-                    
+                        continue
+        self._toArrays([attr for attr, col in self.TILE_COLUMNS])
+        return ws_cat.text is not None
+
 class sExCatalogue(Catalogue):
+    # sExtractor output columns held by the catalogue, with the type of each column
+    COLUMNS = [('X_IMAGE', float), ('Y_IMAGE', float), ('FLUX_MAX', float), ('FLUX_AUTO', float), ('FLUXERR_AUTO', float), 
+               ('MAG_AUTO', float), ('MAGERR_AUTO', float), ('BACKGROUND', float), ('ISOAREA_WORLD', float), ('FLAGS', int), 
+               ('FWHM_WORLD', float), ('ELONGATION', float), ('ELLIPTICITY', float), ('THETA_IMAGE', float)]
+
     def __init__(self, err, logger):
         Catalogue.__init__(self) 
         self.NAME = "sEx"
-        self.X_IMAGE = []
-        self.Y_IMAGE = []
-        self.FLUX_MAX = []
-        self.FLUX_AUTO = []
-        self.FLUXERR_AUTO = []
-        self.MAG_AUTO = []
-        self.MAGERR_AUTO = []
-        self.BACKGROUND = []
-        self.ISOAREA_WORLD = []
-        self.FLAGS = []
-        self.FWHM_WORLD = []
-        self.ELONGATION = []
-        self.ELLIPTICITY = []
-        self.THETA_IMAGE = []
         self.err = err
         self.logger = logger
+        self.hardCopyThread = None
+        self._clear()
+
+    def _clear(self):
+        self.RA = np.empty(0)
+        self.DEC = np.empty(0)
+        for col, dtype in self.COLUMNS:
+            setattr(self, col, np.empty(0, dtype=dtype))
 
-    def insert(self, ra, dec, x, y, fluxmax, fluxauto, fluxerrauto, magauto, magerrauto, background, isoareaworld, flags, fwhmworld, elongation, ellipticity, thetaimage):
+    def insert(self, catdata, hdr):
         '''
-        insert sExtractor source into catalogue.
+        insert sExtractor sources into catalogue, filling each column straight from the sExtractor output.
         '''
-        self.RA.append(ra)
-        self.DEC.append(dec)
-        self.X_IMAGE.append(x)
-        self.Y_IMAGE.append(y)
-        self.FLUX_MAX.append(fluxmax)
-        self.FLUX_AUTO.append(fluxauto)
-        self.FLUXERR_AUTO.append(fluxerrauto)
-        self.MAG_AUTO.append(magauto)
-        self.MAGERR_AUTO.append(magerrauto)
-        self.BACKGROUND.append(background)
-        self.ISOAREA_WORLD.append(isoareaworld)
-        self.FLAGS.append(flags)
-        self.FWHM_WORLD.append(fwhmworld)
-        self.ELONGATION.append(elongation)
-        self.ELLIPTICITY.append(ellipticity)
-        self.THETA_IMAGE.append(thetaimage)
-
-    def query(self, inFile, resPath, pathToConfFile, clean=True, ccdSizeX=0, ccdSizeY=0, fieldMargin=0, appendToCat=True, hard=False):
+        for col, dtype in self.COLUMNS:
+            setattr(self, col, np.array(catdata[col], dtype=dtype))
+
+        self.RA, self.DEC = self._xy2radec(hdr, self.X_IMAGE, self.Y_IMAGE)
+
+    def query(self, inFile, resPath, pathToConfFile, clean=True, ccdSizeX=0, ccdSizeY=0, fieldMargin=0, appendToCat=True, hard=False, hdr=None, scratchPath=None, stream=False, cache=None):
         '''
         init sExtractor using a specified config file.
+
+        if a [scratchPath] is given, sExtractor's config and output are kept in a per-process scratch directory 
+        there rather than in [resPath]. if the FITS header is passed in [hdr], the image isn't reopened to 
+        fill the catalogue. if [stream] is set, the catalogue is read straight off sExtractor's stdout and never 
+        touches disk. if an arrayCache is passed in [cache], cleaned output is looked up by a hash of the frame 
+        and the effective sExtractor config, and sExtractor is only run on a miss. a hard copy of the catalogue is written on a background thread [self.hardCopyThread], 
+        join it before relying on the file.
         '''
         if not os.path.exists(pathToConfFile):
             self.err.setError(-6)
             self.err.handleError()
         self.logger.info("(sExCatalogue.query) Using config file " + pathToConfFile)
 
-        # run sExtractor
-        self.logger.info("(sExCatalogue.query) Running sExtractor")
-        sEx = pysex(inFile, resPath, pathToConfFile, self.err, self.logger)
-        sEx.run()
+        sEx = pysex(inFile, resPath, pathToConfFile, self.err, self.logger, scratch_path=scratchPath, stream=stream)
 
-        # clean output if requested
-        if clean:
-            self._clean(sEx.catdata, ccdSizeX, ccdSizeY, fieldMargin)   # sEx.catdata is passed by reference
+        # look for output from a previous run on the same frame and config
+        key = None
+        if cache is not None:
+            key = hash_files([inFile] + sEx.get_conf_files(), extra=(clean, ccdSizeX, ccdSizeY, fieldMargin))
+            sEx.catdata = cache.get(key)
+            sEx.catalog_type = sEx.get_catalog_type()       # the hard copy is written as configured
 
-        # append to internal catalogue if requested 
-        im = FITSFile(inFile, self.err) 
-        im.openFITSFile()
-        im.getHeaders(0)
-        if appendToCat:
-            for idx in range(sEx.catdata.nrows):
-                ra, dec = self._xy2radec(im.headers, [sEx.catdata['X_IMAGE'][idx], sEx.catdata['Y_IMAGE'][idx]])
-                self.insert(ra, dec, sEx.catdata['X_IMAGE'][idx], sEx.catdata['Y_IMAGE'][idx], sEx.catdata['FLUX_MAX'][idx], sEx.catdata['FLUX_AUTO'][idx], sEx.catdata['FLUXERR_AUTO'][idx], sEx.catdata['MAG_AUTO'][idx], sEx.catdata['MAGERR_AUTO'][idx], sEx.catdata['BACKGROUND'][idx], sEx.catdata['ISOAREA_WORLD'][idx], sEx.catdata['FLAGS'][idx], sEx.catdata['FWHM_WORLD'][idx], sEx.catdata['ELONGATION'][idx], sEx.catdata['ELLIPTICITY'][idx], sEx.catdata['THETA_IMAGE'][idx])
+        if sEx.catdata is None:
+            # run sExtractor
+            self.logger.info("(sExCatalogue.query) Running sExtractor")
+            sEx.run()
 
-        im.closeFITSFile()
+            # clean output if requested
+            if clean:
+                sEx.catdata = self._clean(sEx.catdata, ccdSizeX, ccdSizeY, fieldMargin)
+
+            if key is not None:
+                cache.put(key, sEx.catdata)
+        else:
+            self.logger.info("(sExCatalogue.query) Using cached sExtractor output for " + inFile)
+
+        # fill internal catalogue if requested 
+        if appendToCat:
+            if hdr is None:
+                im = FITSFile(inFile, self.err) 
+                im.openFITSFile()
+                im.getHeaders(0)
+                self.insert(sEx.catdata, im.headers)
+                im.closeFITSFile()
+            else:
+                self.insert(sEx.catdata, hdr)
 
         # make a hard copy of the catalogue if requested
         if hard:
-            sEx.write_cat(inFile + ".cat")
+            self.hardCopyThread = threading.Thread(target=sEx.write_cat, args=(inFile + ".cat",))
+            self.hardCopyThread.start()
 
         return sEx.catdata
 
     def read(self, inFile):
-        catdata = asciidata.open(inFile + ".cat")
+        catdata = read_cat(inFile + ".cat")
 
         im = FITSFile(inFile, self.err) 
         im.openFITSFile()
         im.getHeaders(0)
-        for idx in range(catdata.nrows):
-            ra, dec = self._xy2radec(im.headers, [catdata['X_IMAGE'][idx], catdata['Y_IMAGE'][idx]])
-            self.insert(ra, dec, catdata['X_IMAGE'][idx], catdata['Y_IMAGE'][idx], catdata['FLUX_MAX'][idx], catdata['FLUX_AUTO'][idx], catdata['FLUXERR_AUTO'][idx], catdata['MAG_AUTO'][idx], catdata['MAGERR_AUTO'][idx], catdata['BACKGROUND'][idx], catdata['ISOAREA_WORLD'][idx], catdata['FLAGS'][idx], catdata['FWHM_WORLD'][idx], catdata['ELONGATION'][idx], catdata['ELLIPTICITY'][idx], catdata['THETA_IMAGE'][idx])
-
+        self.insert(catdata, im.headers)
         im.closeFITSFile()
 
     def _clean(self, catdata, ccdSizeX, ccdSizeY, fieldMargin):
         '''
         remove suspect sources from sExtractor output.
-        '''
-        # purge sources lying inside a margin from the CCD chip edge
-        numRowsBeforePurge = catdata.nrows
-        if numRowsBeforePurge == 0:
-            return None
-
-        catdata.sort('X_IMAGE')
-
-        rowsToPurge = [i for i in range(catdata.nrows) if catdata['X_IMAGE'][i] <= fieldMargin]
-        idxUpper = max(rowsToPurge) + 1 if len(rowsToPurge) > 0 else 0
-
-        catdata.delete(0, idxUpper)
-        self.logger.info("(sExCatalogue._clean) Purged " + str(numRowsBeforePurge - catdata.nrows) + " sources failing x low margin criteria")
-
-        numRowsBeforePurge = catdata.nrows
-        if numRowsBeforePurge == 0:
-            return None
-        catdata.sort('X_IMAGE', descending=1)
-
-        rowsToPurge = [i for i in range(catdata.nrows) if catdata['X_IMAGE'][i] >= ccdSizeX-fieldMargin]
-        idxUpper = max(rowsToPurge) + 1 if len(rowsToPurge) > 0 else 0
-
-        catdata.delete(0, idxUpper)
-        self.logger.info("(sExCatalogue._clean) Purged " + str(numRowsBeforePurge - catdata.nrows) + " sources failing x high margin criteria")
-
-        numRowsBeforePurge = catdata.nrows
-        if numRowsBeforePurge == 0:
-            return None
-        catdata.sort('Y_IMAGE')
-
-        rowsToPurge = [i for i in range(catdata.nrows) if catdata['Y_IMAGE'][i] <= fieldMargin]
-        idxUpper = max(rowsToPurge) + 1 if len(rowsToPurge) > 0 else 0
 
-        catdata.delete(0, idxUpper)
-        self.logger.info("(sExCatalogue._clean) Purged " + str(numRowsBeforePurge - catdata.nrows) + " sources failing y low margin criteria")
+        all criteria are evaluated in a single pass over the columns. purge counts are reported per 
+        criterion, in the order they're listed, so each source is only counted against the first it fails.
 
-        numRowsBeforePurge = catdata.nrows
-        if numRowsBeforePurge == 0:
-            return None
-        catdata.sort('Y_IMAGE', descending=1)
-
-        rowsToPurge = [i for i in range(catdata.nrows) if catdata['Y_IMAGE'][i] >= ccdSizeY-fieldMargin]
-        idxUpper = max(rowsToPurge) + 1 if len(rowsToPurge) > 0 else 0
-
-        catdata.delete(0, idxUpper)
-        self.logger.info("(sExCatalogue._clean) Purged " + str(numRowsBeforePurge - catdata.nrows) + " sources failing y high margin criteria")
-
-        # purge sources with non-zero sExtractor flags
-        numRowsBeforePurge = catdata.nrows
-        if numRowsBeforePurge == 0:
-            return None
-        catdata.sort('FLAGS', ordered=1, descending=1)
-
-        rowsToPurge = [i for i in range(catdata.nrows) if catdata['FLAGS'][i] is not 0]
-        idxUpper = max(rowsToPurge) + 1 if len(rowsToPurge) > 0 else 0
-
-        catdata.delete(0, idxUpper)
-        self.logger.info("(sExCatalogue._clean) Purged " + str(numRowsBeforePurge - catdata.nrows) + " sources with non-zero sExtractor flag")
+        returns the cleaned catalogue, in the original sExtractor order.
+        '''
+        criteria = [("failing x low margin criteria",  catdata['X_IMAGE'] > fieldMargin),           # purge sources lying inside a margin from the CCD chip edge
+                    ("failing x high margin criteria", catdata['X_IMAGE'] < ccdSizeX-fieldMargin),
+                    ("failing y low margin criteria",  catdata['Y_IMAGE'] > fieldMargin),
+                    ("failing y high margin criteria", catdata['Y_IMAGE'] < ccdSizeY-fieldMargin),
+                    ("with non-zero sExtractor flag",  catdata['FLAGS'] == 0)]                       # purge sources with non-zero sExtractor flags
 
-        if catdata.nrows == 0:
-            return None
+        keep = np.ones(len(catdata), dtype=bool)
+        for description, passed in criteria:
+            numPurged = np.count_nonzero(keep & ~passed)
+            keep &= passed
+            self.logger.info("(sExCatalogue._clean) Purged " + str(numPurged) + " sources " + description)
 
-        catdata.sort('NUMBER')
+        return catdata[keep]
 
-    def _xy2radec(self, hdr, pix):
+    def _isPlainTAN(self, hdr):
+        '''
+        check if a FITS header describes an undistorted TAN projection with a CD matrix
         '''
-        convert from xy to RADEC using the WCS from a FITS header
+        if hdr.get('CTYPE1') != 'RA---TAN' or hdr.get('CTYPE2') != 'DEC--TAN':
+            return False
+        for key in ('CRVAL1', 'CRVAL2', 'CRPIX1', 'CRPIX2', 'CD1_1', 'CD1_2', 'CD2_1', 'CD2_2'):
+            if key not in hdr:
+                return False
+        if float(hdr.get('LONPOLE', 180.)) != 180.:
+            return False
+        for key in hdr.keys():
+            if key.startswith('PV') or key in ('A_ORDER', 'B_ORDER', 'AP_ORDER', 'BP_ORDER'):
+                return False
+        return True
+
+    def _xy2radec(self, hdr, x, y):
+        '''
+        convert arrays of xy to RADEC using the WCS from a FITS header. 
+        
+        the WCS is built once for the whole frame. plain TAN headers are deprojected directly.
         '''
-        wcs = pywcs.WCS(hdr)
-        radec = wcs.all_pix2sky([pix], 1)
-        return radec.tolist()[0][0], radec.tolist()[0][1]                    
-                    
-                    
- 
+        x = np.asarray(x, dtype=float)
+        y = np.asarray(y, dtype=float)
+        if x.size == 0:
+            return np.empty(0), np.empty(0)
+
+        if not self._isPlainTAN(hdr):
+            wcs = pywcs.WCS(hdr)
+            ra, dec = wcs.all_pix2sky(x, y, 1)
+            return np.asarray(ra), np.asarray(dec)
+
+        # intermediate world coordinates (radians) from the CD matrix
+        dx = x - float(hdr['CRPIX1'])
+        dy = y - float(hdr['CRPIX2'])
+        xi  = np.radians(float(hdr['CD1_1'])*dx + float(hdr['CD1_2'])*dy)
+        eta = np.radians(float(hdr['CD2_1'])*dx + float(hdr['CD2_2'])*dy)
+
+        # inverse gnomonic projection about the reference point
+        ra0  = np.radians(float(hdr['CRVAL1']))
+        dec0 = np.radians(float(hdr['CRVAL2']))
+        denom = np.cos(dec0) - eta*np.sin(dec0)
+        ra  = np.degrees(ra0 + np.arctan2(xi, denom)) % 360.
+        dec = np.degrees(np.arctan2(np.sin(dec0) + eta*np.cos(dec0), np.hypot(xi, denom)))
+        return ra, dec
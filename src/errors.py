@@ -21,8 +21,8 @@ class errors:
                                    -5:"",
                                    -6:"(catalogue.sExCatalogue.query) Config file doesn't exist",
                                    -7:"(catalogue.sExCatalogue.query) Params file doesn't exist",
-                                   -8:"",
-                                   -9:"",
+                                   -8:"(pysex.run) sExtractor failed",
+                                   -9:"(tiles.tileStore.__init__) Tile store not found",
                                    -10:"",
                                    -11:"",
                                    -12:"(process.run_*) Sorted image list is Nonetype. Probably no images found",
@@ -53,7 +53,9 @@ class errors:
                                    16:"(pipeline._XMatchSources_*) matchedSources list is empty",
                                    17:"(pipeline._XMatchSources) Query returned no sources",
                                    18:"(pipeline._storeToPostgresDatabase) Image already processed, ignoring",
-				   19:"(util.decompress_files) Failed to decompress a file"
+				   19:"(util.decompress_files) Failed to decompress a file",
+                                   20:"(pipeline._flushStoreBatch) Failed to store batch, frames not stored",
+                                   21:"(catalogue.Catalogue._SCS) SCS response was cut off or malformed"
                                    }
 
     def setError(self, newErrorCode):
@@ -84,3 +86,37 @@ class errors:
                 sys.exit(1)
         elif self._errorCode > 0:
             self.logger.warning(errorMsg)
+
+class deferredError(Exception):
+    '''
+    raised by deferredErrors in place of handling a critical error code.
+    '''
+    def __init__(self, errorCode):
+        Exception.__init__(self, errorCode)
+        self.errorCode = errorCode
+
+class deferredErrors(errors):
+    '''
+    collects error codes set off the main thread, e.g. in a pool worker, so they can be handled on the main 
+    thread with replay(). a critical code raises deferredError, unwinding the worker as handleError would.
+    '''
+    def __init__(self, logger):
+        errors.__init__(self, logger, True)
+        self.errorCodes = []
+
+    def handleError(self):
+        '''
+        record internal error code
+        '''
+        if self._errorCode != 0:
+            self.errorCodes.append(self._errorCode)
+        if self._errorCode < 0:
+            raise deferredError(self._errorCode)
+
+    def replay(self, err):
+        '''
+        handle the recorded error codes, in order, with [err]
+        '''
+        for errorCode in self.errorCodes:
+            err.setError(errorCode)
+            err.handleError()
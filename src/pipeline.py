@@ -10,34 +10,73 @@ import subprocess
 import os
 import urllib
 import uuid
+import time
 from datetime import datetime
+from multiprocessing.pool import ThreadPool
 from lockfile import LockFile
 
 import numpy as np
 import scipy.stats as stats
 
-from errors import errors
+from errors import errors, deferredErrors, deferredError
 from FITSFile import FITSFile
 from catalogue import *
-from source import source
+from source import sourceTable
 from util import *
 from database import database_postgresql
 from plot import plotZPCalibration, plotMollweide
 from ws import ws_catalogue as wsc
-from pyspherematch import _great_circle_distance as gcd
+from ws import configure_session, configure_retries, configure_payloads
+from cache import arrayCache
+from tiles import tileStore
 
 class pipeline():
+    # headers an image needs for a valid WCS
+    VALID_WCS_KEYS = {"CRVAL1", "CRVAL2", "CRPIX1", "CRPIX2", "CD1_1", "CD1_2", "CD2_1", "CD2_2", "RA_CENT", "DEC_CENT", "ROTSKYPA"}
+
     def __init__(self, params, err, logger):
         self.params 		= params
         self.err		= err
         self.logger		= logger
         
         self.lastPointing       = []
+
+        # all webservice calls in this process go through one pooled keep-alive session, with a shared retry policy 
+        # and upload format
+        configure_session(self.params['WSPoolSize'], self.params['WSConnectTimeout'], self.params['WSReadTimeout'])
+        configure_retries(self.params['WSMaxRetries'], self.params['WSRetryDelay'], self.params['WSMaxRetryDelay'], self.params['WSHedgeSCS'], 
+                          self.params['WSHedgeQuantile'], self.params['WSBreakerThreshold'], self.params['WSBreakerCooldown'])
+        configure_payloads(self.params['WSPayloadColumnar'], self.params['WSPayloadCompression'])
+        
+        # sExtractor is run on a bounded pool of threads (each waiting on its own sExtractor subprocess) so that 
+        # upcoming frames can be extracted while the current one is being cross-matched and stored
+        self.sExPool            = ThreadPool(processes=int(self.params['maxSExProcesses']))
+
+        # each reference catalogue is cross-matched on its own thread, numpy/scipy release the GIL 
+        # for the heavy lifting so a frame takes as long as its slowest catalogue rather than the sum of them
+        self.XMatchPool         = ThreadPool(processes=max(int(self.params['maxXMatchThreads']), 1))
+
+        # reference catalogues for a new pointing are all queried at once, while sExtractor finishes with the frame
+        self.catQueryPool       = ThreadPool(processes=len(self.params['cat']))
+        
+        # cleaned sExtractor output is cached by frame and config, so reprocessing runs can skip sExtractor
+        self.sExCache           = None
+        if self.params['sExCacheSize'] > 0:
+            self.sExCache       = arrayCache(self.params['sExCachePath'], self.params['sExCacheSize'], self.logger)
+
+        # reference catalogue SCS responses are cached on disk too, shared by all processes and runs
+        self.SCSCache           = None
+        if self.params['SCSCacheSize'] > 0:
+            self.SCSCache       = arrayCache(self.params['SCSCachePath'], self.params['SCSCacheSize'], self.logger)
         
         # the following catalogues are kept in the constructor so that they are not reinitialised every time 
         # pipeline.run() is invoked. this is important for sync operations
         self.RefCatAll          = {}                                                                  # reference catalogues to match against
         self.SkycamCat          = SkycamCatalogue(self.err, self.logger, self.params['schemaName'])   # required if we're amending the Skycam catalogue table (if --sdb is set)
+        
+        # frames waiting to be stored, if storing in batches
+        self.storeBatch         = []
+        self.storeBatchStart    = None
 
     def run(self, images):
         '''
@@ -49,30 +88,73 @@ class pipeline():
         # this is done to avoid having to requery the same pointing
         if not self.RefCatAll:  # first we check if it's empty, this is important for sync runs
             for c in self.params['cat']:
+                tiles = None
+                if self.params['useRefTiles']:       # cone search the local tile store rather than the web service
+                    tiles = tileStore(self.params['refTilesPath'], c, self.err, self.logger)
                 if c == "APASS":
-                    self.RefCatAll[c] = APASSCatalogue(self.err, self.logger) 
+                    self.RefCatAll[c] = APASSCatalogue(self.err, self.logger, tiles=tiles, scsCache=self.SCSCache, scsQuantum=self.params['SCSCacheQuantum'], scsFormat=self.params['SCSFormat'], scsMaxBytes=self.params['SCSMaxBytes']) 
                 elif c == "USNOB":
-                    self.RefCatAll[c] = USNOBCatalogue(self.err, self.logger)    
+                    self.RefCatAll[c] = USNOBCatalogue(self.err, self.logger, tiles=tiles, scsCache=self.SCSCache, scsQuantum=self.params['SCSCacheQuantum'], scsFormat=self.params['SCSFormat'], scsMaxBytes=self.params['SCSMaxBytes'])    
 
         doCatQuery = True     # this keeps track of whether we need to perform a new catalogue query
         valid_images = []
+        frames = {}           # images opened ahead and their pending sExtractor results, keyed on image index
+        aheadPointing = self.lastPointing
+        hardCopies = []       # threads writing hard copies of the sExtractor catalogues
         for idx, f in enumerate(images):
+            # keep the sExtractor pool working on the frames following this one. frames are opened and checked in 
+            # image (DATE-OBS) order as they're submitted, so those the WCS and pointing checks below will reject 
+            # aren't extracted. results are still consumed in order, so the catalogue reuse below is unaffected
+            for ahead_idx in range(idx, min(idx + int(self.params['maxSExProcesses']) + 1, len(images))):
+                if ahead_idx not in frames:
+                    ahead_im, ahead_err, ahead_extraction, aheadPointing = self._openAhead(images[ahead_idx], aheadPointing)
+                    frames[ahead_idx] = (ahead_im, ahead_err, ahead_extraction)
+            im, openErr, extraction = frames.pop(idx)
+
             self.logger.info("(pipeline.run) processing file " + str(idx+1) + " of " + str(len(images)) + " (" + os.path.basename(f) + ")")
-            im = FITSFile(f, self.err) 
-            im.openFITSFile()
-            im.getHeaders(0)     
+            openErr.replay(self.err)                                                                                   # handle any errors opening the image, in turn
+            im.err = self.err
             if self._hasValidWCS(im):                                                                                  # checks that we have a valid WCS
                 if not self._hasPointingChanged(im):                                                                   # checks that pointing hasn't changed
-                    sources = self._extractSources(f, im)                                                              # extract sources
+                    fetches = []
+                    if doCatQuery:                                                                                     # query reference catalogues for this pointing, concurrently
+                        fetches = [self.catQueryPool.apply_async(self._fetchCatalogue, (im, c)) for c in self.params['cat']]
+                        if not self.params['forceCatalogueQuery']:
+                            doCatQuery = False                                                                         # frames rejected below reuse the query too
+                    try:
+                        sources = self._extractSources(f, im, extraction)                                              # extract sources
+                    finally:
+                        fetched = [fetch.get() for fetch in fetches]                                                   # wait for every catalogue query, even on failure
+                    for fetchErr, e in fetched:
+                        fetchErr.replay(self.err)
+                        if e is not None:
+                            raise e
                     if sources is not None:
                         ZPs = {}                                                                                           # we store ZP for each reference catalogue
                         ZP_COEFFS = {}                                                                                     # and also ZP coeffs for each reference catalogue
                         catalogue_success = []										   # keep a track of whether the cross-matching spat out failure codes
-                        for c in self.params['cat']:
-                            sources, this_success = self._XMatchSources(im, doCatQuery, cat=self.RefCatAll[c], sources=sources) # multiple catalogue cross-matching 
-                            catalogue_success.append(this_success)
-                            if this_success is not False:
-                                magDifference, BRcolour, zp_coeffs, V = self._calibrateZP(sources, cat=c)                  # frame zeropoint calculation
+                        xmatches = [self.XMatchPool.apply_async(self._XMatchReference, (im, c, sources)) 
+                                    for c in self.params['cat']]                                                           # multiple catalogue cross-matching, concurrently
+                        xmatches = [xmatch.get() for xmatch in xmatches]
+                        for this_keep, errorCode, e in xmatches:
+                            if e is not None:
+                                raise e
+                        # errors are handled and ZPs fitted here, in catalogue order, with each catalogue's checks and ZP 
+                        # using only the sources kept by the catalogues before it. this isn't quite matching them in turn: 
+                        # every catalogue is matched against all the sources, so where two sources are within tolerance of 
+                        # the same reference object (in either assign mode), it can go to a source an earlier catalogue 
+                        # dropped, leaving the kept source unmatched
+                        keep = np.ones(len(sources), dtype=bool)
+                        for c, (this_keep, errorCode, e) in zip(self.params['cat'], xmatches):
+                            if errorCode is None:
+                                errorCode = self._checkXMatches(self.RefCatAll[c], sources, keep, this_keep)
+                            if errorCode is not None:
+                                self.err.setError(errorCode)
+                                self.err.handleError()
+                            catalogue_success.append(errorCode is None)
+                            if errorCode is None:
+                                keep = keep & this_keep                                                                    # drop sources removed by this catalogue
+                                magDifference, BRcolour, zp_coeffs, V = self._calibrateZP(sources.select(keep), cat=c)     # frame zeropoint calculation
                                 zp_stdev = np.sqrt(V[1,1])                                                                 # variance is last element of covariance matrix
                                 ZPs[c] = (zp_coeffs[1], zp_stdev)                                                          # for zero colour term, take intercept
                                 ZP_COEFFS[c] = zp_coeffs
@@ -85,7 +167,10 @@ class pipeline():
                                                   outImageFilename=self.params['resPath'] + os.path.basename(f) + "." + c + ".calibration.png", 
                                                   outDataFilename=self.params['resPath'] + os.path.basename(f) + "." + c + ".data.calibration", 
                                                   )
-                        if self.params['storeToDB'] and all(catalogue_success):
+                        sources = sources.select(keep)
+                        if self.params['storeToDB'] and all(catalogue_success) and self.params['storeBatchSize'] > 1:
+                            self._queueStore(f, dict(im.headers.items()), sources, ZPs, ZP_COEFFS)                     # store in batches, the image is closed before it's stored
+                        elif self.params['storeToDB'] and all(catalogue_success):
 			    lock = LockFile(self.params['path_lock'])
 			    try:
 			        lock.acquire()										       # we effectively lock any other threads from executing, otherwise mid-air collision
@@ -97,13 +182,23 @@ class pipeline():
                             except:
                                 lock.release()										       # always release lock after exception, otherwise it'll hang other threads..
                                 self.logger.info("(pipeline.run) released database after fault")
-                        if not self.params['forceCatalogueQuery']:
-                            doCatQuery = False
                         valid_images.append(f)
                 else:                                                                                     # skip processing file if pointing has changed
                     doCatQuery = True
                 self.lastPointing = self._getPointing(im)
             im.closeFITSFile()
+            if extraction is not None:
+                extraction.wait()  # make sure frames failing the quality checks have finished with sExtractor before the res directory is archived
+                sExCat = extraction.get()[0]
+                if sExCat is not None and sExCat.hardCopyThread is not None:
+                    hardCopies.append(sExCat.hardCopyThread)
+            if self.storeBatch and time.time() - self.storeBatchStart >= self.params['storeBatchMaxLatency']:
+                self._flushStoreBatch()   # don't hold processed frames back for longer than the maximum latency
+
+        for hardCopy in hardCopies:   # ...and that their catalogues have been written out
+            hardCopy.join()
+
+        self._flushStoreBatch()       # store any frames still batched
 
         if len(valid_images) == 0:
             self.err.setError(14)
@@ -121,10 +216,33 @@ class pipeline():
 
         self.logger.info("(pipeline.run) Finished run")
         
+    def _openAhead(self, in_filename, lastPointing):
+        '''
+        open an image ahead of its turn and submit it to the sExtractor pool, unless run() will reject it for its 
+        WCS or for its pointing having changed since [lastPointing]. errors opening the image are deferred until 
+        it's processed, see deferredErrors.
+
+        returns the image, the errors set opening it, the pending sExtractor result (None if it wasn't submitted) 
+        and the pointing to check the next image against.
+        '''
+        err = deferredErrors(self.logger)
+        im = FITSFile(in_filename, err)
+        try:
+            im.openFITSFile()
+            im.getHeaders(0)
+        except deferredError:
+            return im, err, None, lastPointing
+        extraction = None
+        if all([key in im.headers for key in self.VALID_WCS_KEYS]):
+            thisPointing = self._getPointing(im)
+            if not lastPointing or find_pointing_angle_diff(thisPointing, lastPointing) <= float(self.params['pointingDiffThresh']):
+                extraction = self.sExPool.apply_async(self._runSExtractor, (in_filename,))
+            lastPointing = thisPointing
+        return im, err, extraction, lastPointing
+
     def _hasValidWCS(self, in_FITS_im):
-        validWCSKeys = {"CRVAL1", "CRVAL2", "CRPIX1", "CRPIX2", "CD1_1", "CD1_2", "CD2_1", "CD2_2", "RA_CENT", "DEC_CENT", "ROTSKYPA"}
         hasValidWCS = True
-        for key in validWCSKeys:
+        for key in self.VALID_WCS_KEYS:
             if key not in in_FITS_im.headers:
                 hasValidWCS = False
                 self.err.setError(1)
@@ -147,22 +265,45 @@ class pipeline():
                 pointingChanged = True  
         return pointingChanged 
 
-    def _extractSources(self, in_filename, in_FITS_im):
+    def _runSExtractor(self, in_filename):
+        '''
+        run sExtractor on an image. this is called from the sExtractor pool.
+
+        returns the sExtractor catalogue instance, its cleaned output, the errors set (to be handled by the main 
+        thread, see deferredErrors) and any unexpected exception raised. the catalogue's hard copy may still be 
+        being written, see run().
+        '''
+        err = deferredErrors(self.logger)
+        try:
+            sExCat = sExCatalogue(err, self.logger)
+            catdata = sExCat.query(in_filename,
+                                   self.params['resPath'], 
+                                   self.params['sExConfFile'], 
+                                   ccdSizeX=int(self.params['CCDSizeX']), 
+                                   ccdSizeY=int(self.params['CCDSizeY']), 
+                                   fieldMargin=int(self.params['fieldMargin']), 
+                                   appendToCat=False, 
+                                   hard=True,
+                                   scratchPath=self.params['scratchPath'],
+                                   stream=self.params['streamSExCat'],
+                                   cache=self.sExCache
+                                   )
+            return sExCat, catdata, err, None
+        except deferredError:
+            return None, None, err, None
+        except BaseException, e:      # anything else would otherwise kill the pool's worker thread
+            return None, None, err, e
+
+    def _extractSources(self, in_filename, in_FITS_im, extraction):
         '''
-        run sExtractor on images and check source output.
+        collect sExtractor output for an image from the sExtractor pool and check source output.
         
-        returns a list of source instances (w/ unpopulated reference catalogue fields).
-        '''
-        sExCat = sExCatalogue(self.err, self.logger)
-        catdata = sExCat.query(in_filename,
-                               self.params['resPath'], 
-                               self.params['sExConfFile'], 
-                               ccdSizeX=int(self.params['CCDSizeX']), 
-                               ccdSizeY=int(self.params['CCDSizeY']), 
-                               fieldMargin=int(self.params['fieldMargin']), 
-                               appendToCat=False, 
-                               hard=True
-                               )
+        returns a sourceTable (w/ unpopulated reference catalogue fields).
+        '''
+        sExCat, catdata, err, e = extraction.get()
+        err.replay(self.err)
+        if e is not None:
+            raise e
  
         # ...and check the output
         ## check number of catalogue sources != 0 (i.e. empty catalogue returned)
@@ -170,231 +311,236 @@ class pipeline():
             self.err.setError(9)
             self.err.handleError()
             return None
-    
-        ## check number of catalogue sources
-        numExtSources = catdata.nrows
-        self.logger.info("(pipeline._extractSources) " + str(numExtSources) + " legit sources in image (" + str(int(self.params['minSources'])) + ")")
-        if numExtSources < int(self.params['minSources']):
-            self.err.setError(4)
-            self.err.handleError()
-            return None 
 
-        ## check maximum elongation of sources
-        elongation = round(max(catdata["ELONGATION"].tonumpy()), 2)
-        self.logger.info("(pipeline._extractSources) Max elongation in image is " + str(elongation) + " (" + str(self.params['maxElongation']) + ")")
-        if elongation > float(self.params['maxElongation']):
-            self.err.setError(5)
+        ## check frame quality
+        verdict = self._checkFrameQuality(catdata)
+        if not verdict['passed']:
+            self.err.setError(verdict['errorCode'])
             self.err.handleError()
             return None 
 
-        ## check excess kurtosis of object angle   
-        exKurtosis = round(stats.kurtosis(catdata["THETA_IMAGE"].tonumpy()), 2)
-        self.logger.info("(pipeline._extractSources) Kurtosis of object angle is " + str(exKurtosis) + " (" + str(float(self.params['maxExKurtosis'])) + ")")
-        if exKurtosis > float(self.params['maxExKurtosis']):
-            self.err.setError(6)
-            self.err.handleError() 
-            return None 
-
-        ## combined check of kurtosis and elongation
-        sourcesCombCheck = 0
-        for idx in range(catdata.nrows):
-            if catdata['ELONGATION'][idx] > float(self.params['maxCombElongation']) and catdata['KURTOSIS'][idx] > float(self.params['maxCombExKurtosis']):
-              sourcesCombCheck += 1
-        self.logger.info("(pipeline._extractSources) Number of objects failing combined elongation/kurtosis constraint is " + str(sourcesCombCheck) 
-                         + " (" + str(float(self.params['maxSourcesCombCheck'])) + ")")
-        if sourcesCombCheck > float(self.params['maxSourcesCombCheck']):
-            self.err.setError(7)
-            self.err.handleError() 
-            return None 
-
-        ## check maximum flux   
-        flux = max(catdata['FLUX_MAX'].tonumpy())
-        self.logger.info("(pipeline._extractSources) Maximum flux in catalogue is " + str(flux) + " (" + str(self.params['maxFlux']) + ")")
-        if flux > float(self.params['maxFlux']):
-            self.err.setError(8)
-            self.err.handleError()
-            return None 
+        # only now convert the sources to RA/DEC and insert them into the catalogue
+        sExCat.insert(catdata, in_FITS_im.headers)
           
-        # parse sExtractor catalogue
-        sExCat = sExCatalogue(self.err, self.logger)
-        sExCat.read(in_filename)        
-        
-        sources = []
-        # create a list of source instances from each sExtracted source
-        # with Nonetype cross-match catalogue variables
-        for i in range(len(sExCat.RA)):
-            sources.append(source(in_filename, 
-                                  sExCat.RA[i], 
-                                  sExCat.DEC[i], 
-                                  sExCat.X_IMAGE[i], 
-                                  sExCat.Y_IMAGE[i], 
-                                  sExCat.FLUX_AUTO[i], 
-                                  sExCat.FLUXERR_AUTO[i], 
-                                  sExCat.MAG_AUTO[i], 
-                                  sExCat.MAGERR_AUTO[i], 
-                                  sExCat.BACKGROUND[i], 
-                                  sExCat.ISOAREA_WORLD[i], 
-                                  sExCat.FLAGS[i], 
-                                  sExCat.FWHM_WORLD[i], 
-                                  sExCat.ELONGATION[i], 
-                                  sExCat.ELLIPTICITY[i], 
-                                  sExCat.THETA_IMAGE[i]
-                                  )
-            )              
+        # create a table of sources from the catalogue columns
+        # with empty cross-match catalogue fields
+        sources = sourceTable(in_filename, sExCat)
           
         return sources
     
-    def _XMatchSources(self, in_FITS_im, doCatQuery, cat, sources, checkColourIndex=True, checkNumMatchedSources=True):
+    def _checkFrameQuality(self, catdata):
         '''
-        cross-match sources with catalogue(s).
+        apply the frame quality gates to the sExtractor catalogue.
 
-        returns a list of source instances (w/ reference catalogue fields filled) and a success flag.  
+        the statistics for every gate are computed from a single set of column arrays, then the gates are 
+        applied in order: number of sources, maximum elongation, excess kurtosis of object angle, combined 
+        elongation/kurtosis check and maximum flux.
+
+        the combined check is made at frame level, as the catalogue has no per-object kurtosis. if the excess 
+        kurtosis of object angle over the whole frame is above maxCombExKurtosis, every object more elongated than 
+        maxCombElongation is counted, and the frame fails if more than maxSourcesCombCheck are.
+
+        returns a verdict dict with the gate statistics, whether the frame passed and the error code of the 
+        first gate it failed.
+        '''
+        verdict = {'passed': True, 'errorCode': 0, 'numSources': len(catdata)}
+
+        ## check number of catalogue sources
+        self.logger.info("(pipeline._checkFrameQuality) " + str(verdict['numSources']) + " legit sources in image (" + str(int(self.params['minSources'])) + ")")
+        if verdict['numSources'] < int(self.params['minSources']):
+            verdict['passed'], verdict['errorCode'] = False, 4
+            return verdict
+
+        elongation = np.asarray(catdata['ELONGATION'], dtype=float)
+        thetaImage = np.asarray(catdata['THETA_IMAGE'], dtype=float)
+        fluxMax    = np.asarray(catdata['FLUX_MAX'], dtype=float)
+        verdict['maxElongation']        = round(elongation.max(), 2)
+        verdict['exKurtosis']           = round(stats.kurtosis(thetaImage), 2)
+        verdict['numFailingCombCheck']  = 0
+        if verdict['exKurtosis'] > float(self.params['maxCombExKurtosis']):
+            verdict['numFailingCombCheck'] = int(np.count_nonzero(elongation > float(self.params['maxCombElongation'])))
+        verdict['maxFlux']              = fluxMax.max()
+
+        gates = [(5, verdict['maxElongation'] > float(self.params['maxElongation']),
+                  "Max elongation in image is " + str(verdict['maxElongation']) + " (" + str(self.params['maxElongation']) + ")"),
+                 (6, verdict['exKurtosis'] > float(self.params['maxExKurtosis']),
+                  "Kurtosis of object angle is " + str(verdict['exKurtosis']) + " (" + str(float(self.params['maxExKurtosis'])) + ")"),
+                 (7, verdict['numFailingCombCheck'] > float(self.params['maxSourcesCombCheck']),
+                  "Number of objects failing combined elongation/kurtosis constraint is " + str(verdict['numFailingCombCheck']) + " (" + str(float(self.params['maxSourcesCombCheck'])) + ")"),
+                 (8, verdict['maxFlux'] > float(self.params['maxFlux']),
+                  "Maximum flux in catalogue is " + str(verdict['maxFlux']) + " (" + str(self.params['maxFlux']) + ")")]
+        for errorCode, failed, msg in gates:
+            self.logger.info("(pipeline._checkFrameQuality) " + msg)
+            if failed:
+                verdict['passed'], verdict['errorCode'] = False, errorCode
+                break
+
+        return verdict
+
+    def _queryCatalogue(self, hdr, cat):
+        '''
+        query a catalogue around the pointing in image headers [hdr].
+
+        returns False if the query failed.
         '''
-        self.logger.info("(pipeline._XMatchSources) Cross-matching sources with " + cat.NAME + " catalogue")
-        
-        # set cross-matching parameters
-        matchingTolerance   = self.params['matchingTolerance']
         limitingMag         = self.params['limitingMag']
         maxNumSourcesXMatch = self.params['maxNumSourcesXMatch']
         searchRadius        = self.params['fieldSize']
-        # requery catalogue and cross-match if pointing has changed
-        if doCatQuery:
-            self.logger.info("(pipeline._XMatchSources) No previous pointing information, user has forced always-do catalogue queries or pointing has changed since last image")
-            self.logger.info("(pipeline._XMatchSources) Querying " + cat.NAME + " catalogue at " + in_FITS_im.headers['RA'] 
-                             + " " + in_FITS_im.headers['DEC'] + " with a search radius of " 
-                             + str(searchRadius + float(self.params['pointingDiffThresh'])) + ", " 
-                             + str(searchRadius + float(self.params['pointingDiffThresh'])) + " deg")
-                
-            cat.query(self.params['path_pw_list'], 
+        self.logger.info("(pipeline._queryCatalogue) No previous pointing information, user has forced always-do catalogue queries or pointing has changed since last image")
+        self.logger.info("(pipeline._queryCatalogue) Querying " + cat.NAME + " catalogue at " + hdr['RA'] 
+                         + " " + hdr['DEC'] + " with a search radius of " 
+                         + str(searchRadius + float(self.params['pointingDiffThresh'])) + ", " 
+                         + str(searchRadius + float(self.params['pointingDiffThresh'])) + " deg")
+            
+        # reference catalogues can slide their previous query along with the pointing
+        catQuery = cat.query
+        if self.params['slideCatalogueWindow'] and (cat.NAME == "APASS" or cat.NAME == "USNOB"):
+            catQuery = cat.slide
+        return catQuery(self.params['path_pw_list'], 
                         self.params['catalogue_credentials_id'], 
-                        hms_2_deg(in_FITS_im.headers['RA']), 
-                        dms_2_deg(in_FITS_im.headers['DEC']), 
+                        hms_2_deg(hdr['RA']), 
+                        dms_2_deg(hdr['DEC']), 
                         searchRadius + self.params['pointingDiffThresh'],
                         limitingMag,
                         maxNumSourcesXMatch
                         )
+
+    def _fetchCatalogue(self, in_FITS_im, c):
+        '''
+        query reference catalogue [c]. this is called from the catalogue query pool, so the catalogue's errors are 
+        collected rather than handled while it's queried.
+
+        returns the errors set, to be handled by the main thread (see deferredErrors), and any unexpected 
+        exception raised.
+        '''
+        cat = self.RefCatAll[c]
+        err = deferredErrors(self.logger)
+        cat.err = err
+        try:
+            self._queryCatalogue(in_FITS_im.headers, cat)
+            return err, None
+        except deferredError:
+            return err, None
+        except BaseException, e:      # anything else would otherwise kill the pool's worker thread
+            return err, e
+        finally:
+            cat.err = self.err
+
+    def _XMatchSources(self, in_FITS_im, doCatQuery, cat, sources, checkColourIndex=True, checkNumMatchedSources=True):
+        '''
+        cross-match sources with catalogue(s).
+
+        returns a sourceTable (w/ reference catalogue fields filled) and a success flag.  
+        '''
+        keep, errorCode = self._XMatchSourcesInPlace(in_FITS_im, doCatQuery, cat, sources, checkColourIndex)
+        if errorCode is None:
+            errorCode = self._checkXMatches(cat, sources, np.ones(len(sources), dtype=bool), keep, checkNumMatchedSources)
+        if errorCode is not None:
+            self.err.setError(errorCode)
+            self.err.handleError()
+            return sources, False
+        return sources.select(keep), True   	# filter out removed sources
+
+    def _XMatchSourcesInPlace(self, in_FITS_im, doCatQuery, cat, sources, checkColourIndex=True):
+        '''
+        cross-match sources with a catalogue, filling its reference catalogue fields in [sources].
+
+        matches are applied to the whole table at once: colour cuts are a mask over the matched pairs, reference 
+        catalogue fields are gathered by index and match distances are taken from spherematch. only the fields of
+        [cat] are written and errors are returned rather than handled, so different catalogues can be matched into 
+        the same table concurrently. the number of matches is checked afterwards by _checkXMatches().
+
+        returns a mask of the sources to keep and an error code, or None if the cross-match succeeded.
+        '''
+        self.logger.info("(pipeline._XMatchSources) Cross-matching sources with " + cat.NAME + " catalogue")
+        
+        # set cross-matching parameters
+        matchingTolerance   = self.params['matchingTolerance']
+        
+        # requery catalogue and cross-match if pointing has changed
+        if doCatQuery:
+            self._queryCatalogue(in_FITS_im.headers, cat)
         else:
-            self.logger.info("(pipeline._XMatchSources) Pointing has not changed since last image. Using data from previous query")
+            self.logger.info("(pipeline._XMatchSources) Using data from the last " + cat.NAME + " query")
 
         # check to see if our catalogue returned any sources
         if len(cat.RA) <= 0:
-	    self.err.setError(17)
-            self.err.handleError()
-            return sources, False
+            return None, 17
 	
         # do cross-match	
 	self.logger.info("(pipeline._XMatchSources) Cross-matching catalogues with a tolerance of " + str(matchingTolerance*3600) + " arcsec")
-        matches = pysm.spherematch([s.sExCatRA for s in sources], [s.sExCatDEC for s in sources], cat.RA, cat.DEC, self.logger, tol=matchingTolerance, nnearest=1)     
+        matches = pysm.spherematch(sources.sExCatRA, sources.sExCatDEC, cat.RA, cat.DEC, self.logger, tol=matchingTolerance, nnearest=1, tree=cat.getTree(), assign=self.params['XMatchAssign'], n_jobs=self.params['XMatchQueryJobs'])     
         sourcesMatchedIndexes = matches[0]
         RefCatMatchedIndexes = matches[1]
-
-        # if set, check number of matched sources is greater than the minimum required     
-        if cat.NAME == "APASS" or cat.NAME == "USNOB":
-            if checkNumMatchedSources:
-                if len(sourcesMatchedIndexes) < int(self.params['minNumMatchedSources']):
-                    self.err.setError(12)
-                    self.err.handleError()
-                    return sources, False	  
+        matchDistances = matches[2]
         
         self.logger.info("(pipeline._XMatchSources) Cross-matched " + str(len(sourcesMatchedIndexes)) + " source(s)")
 	    
-        # populate cross-matched catalogue variables for each source
+        # populate cross-matched catalogue fields for all matched sources
+        keep = np.ones(len(sources), dtype=bool)
         numRemovedSourcesColour = 0
-        numUnmatchedSources = 0
-        for source_idx in range(len(sources)):                                     # for every source in the source list...
-            if source_idx in sourcesMatchedIndexes:                                # .. has it been cross-matched to the catalogue?
-                thisMatchedIndex    = np.where(sourcesMatchedIndexes==source_idx)  # and if so, what index?
-                thisSourcesIndex    = sourcesMatchedIndexes[thisMatchedIndex]      # set the corresponding sources index
-                thisCatIndex        = RefCatMatchedIndexes[thisMatchedIndex]       # set the corresponding reference catalogue index
-                if cat.NAME == "APASS":    
-                    ## if set, check for sources lying outside of colour limits
-                    if checkColourIndex:
-                        BRColour = cat.BMAG[thisCatIndex] - cat.RMAG[thisCatIndex]
-                        if BRColour < float(self.params['lowerColourLimit']) or BRColour > float(self.params['upperColourLimit']):
-                            numRemovedSourcesColour = numRemovedSourcesColour + 1
-                            numUnmatchedSources = numUnmatchedSources + 1
-                            sources[source_idx] = None
-                            continue
-                    ## update source information with cross-matched catalogue details
-                    sources[thisSourcesIndex].APASSCatREF=cat.REF[thisCatIndex]
-                    sources[thisSourcesIndex].APASSCatRA=cat.RA[thisCatIndex]
-                    sources[thisSourcesIndex].APASSCatDEC=cat.DEC[thisCatIndex]
-                    sources[thisSourcesIndex].APASSCatRAERR=cat.RAERR[thisCatIndex]
-                    sources[thisSourcesIndex].APASSCatDECERR=cat.DECERR[thisCatIndex]
-                    sources[thisSourcesIndex].APASSCatVMAG=cat.VMAG[thisCatIndex]
-                    sources[thisSourcesIndex].APASSCatBMAG=cat.BMAG[thisCatIndex]
-                    sources[thisSourcesIndex].APASSCatGMAG=cat.GMAG[thisCatIndex]
-                    sources[thisSourcesIndex].APASSCatRMAG=cat.RMAG[thisCatIndex]
-                    sources[thisSourcesIndex].APASSCatIMAG=cat.IMAG[thisCatIndex]
-                    sources[thisSourcesIndex].APASSCatVMAGERR=cat.VMAGERR[thisCatIndex]
-                    sources[thisSourcesIndex].APASSCatBMAGERR=cat.BMAGERR[thisCatIndex]
-                    sources[thisSourcesIndex].APASSCatGMAGERR=cat.GMAGERR[thisCatIndex]
-                    sources[thisSourcesIndex].APASSCatRMAGERR=cat.RMAGERR[thisCatIndex]
-                    sources[thisSourcesIndex].APASSCatIMAGERR=cat.IMAGERR[thisCatIndex]
-                    sources[thisSourcesIndex].APASSCatNOBS=cat.NOBS[thisCatIndex]     
-                    sources[thisSourcesIndex].APASSCatXMatchDist=gcd(cat.RA[thisCatIndex],
-                                                                     cat.DEC[thisCatIndex],
-                                                                     sources[thisSourcesIndex].sExCatRA,
-                                                                     sources[thisSourcesIndex].sExCatDEC)*3600
-                elif cat.NAME == "USNOB":
-                    ## if set, check for sources lying outside of colour limits
-                    if checkColourIndex:
-                        BRColour = cat.B1MAG[thisCatIndex] - cat.R1MAG[thisCatIndex]
-                        if BRColour < float(self.params['lowerColourLimit']) or BRColour > float(self.params['upperColourLimit']):
-                            numRemovedSourcesColour = numRemovedSourcesColour + 1
-                            numUnmatchedSources = numUnmatchedSources + 1
-                            sources[source_idx] = None
-                            continue
-                          
-                    ## update source information with cross-matched catalogue details
-                    sources[thisSourcesIndex].USNOBCatREF=cat.REF[thisCatIndex]
-                    sources[thisSourcesIndex].USNOBCatRA=cat.RA[thisCatIndex]
-                    sources[thisSourcesIndex].USNOBCatDEC=cat.DEC[thisCatIndex]
-                    sources[thisSourcesIndex].USNOBCatRAERR=cat.RAERR[thisCatIndex]
-                    sources[thisSourcesIndex].USNOBCatDECERR=cat.DECERR[thisCatIndex]
-                    sources[thisSourcesIndex].USNOBCatR1MAG=cat.R1MAG[thisCatIndex]
-                    sources[thisSourcesIndex].USNOBCatB1MAG=cat.B1MAG[thisCatIndex]
-                    sources[thisSourcesIndex].USNOBCatR2MAG=cat.R2MAG[thisCatIndex]
-                    sources[thisSourcesIndex].USNOBCatB2MAG=cat.B2MAG[thisCatIndex]  
-                    sources[thisSourcesIndex].USNOBCatXMatchDist=gcd(cat.RA[thisCatIndex],
-                                                                     cat.DEC[thisCatIndex],
-                                                                     sources[thisSourcesIndex].sExCatRA,
-                                                                     sources[thisSourcesIndex].sExCatDEC)*3600
-                elif cat.NAME == "skycamz" or cat.NAME == "skycamt":
-                    sources[thisSourcesIndex].SKYCAMCatREF=cat.REF[thisCatIndex]
-                    sources[thisSourcesIndex].SKYCAMCatRA=cat.RA[thisCatIndex] 
-                    sources[thisSourcesIndex].SKYCAMCatDEC=cat.DEC[thisCatIndex]
-                    sources[thisSourcesIndex].SKYCAMCatRAERR=cat.RAERR[thisCatIndex]
-                    sources[thisSourcesIndex].SKYCAMCatDECERR=cat.DECERR[thisCatIndex]
-                    sources[thisSourcesIndex].SKYCAMCatFIRSTOBSDATE=cat.FIRSTOBSDATE[thisCatIndex]
-                    sources[thisSourcesIndex].SKYCAMCatLASTOBSDATE=cat.LASTOBSDATE[thisCatIndex]
-                    sources[thisSourcesIndex].SKYCAMCatAPASSREF=cat.APASSREF[thisCatIndex]
-                    sources[thisSourcesIndex].SKYCAMCatUSNOBREF=cat.USNOBREF[thisCatIndex].strip()
-                    sources[thisSourcesIndex].SKYCAMCatNOBS=cat.NOBS[thisCatIndex]
-                    sources[thisSourcesIndex].SKYCAMCatAPASSBRCOLOUR=cat.APASSXMATCHBRCOLOUR[thisCatIndex]
-                    sources[thisSourcesIndex].SKYCAMCatUSNOBBRCOLOUR=cat.USNOBXMATCHBRCOLOUR[thisCatIndex]
-                    sources[thisSourcesIndex].SKYCAMCatROLLINGMEANAPASSMAG=cat.ROLLINGMEANAPASSMAG[thisCatIndex]
-                    sources[thisSourcesIndex].SKYCAMCatROLLINGSTDEVAPASSMAG=cat.ROLLINGSTDEVAPASSMAG[thisCatIndex]   
-                    sources[thisSourcesIndex].SKYCAMCatROLLINGMEANUSNOBMAG=cat.ROLLINGMEANUSNOBMAG[thisCatIndex] 
-                    sources[thisSourcesIndex].SKYCAMCatROLLINGSTDEVUSNOBMAG=cat.ROLLINGSTDEVUSNOBMAG[thisCatIndex]
-                    sources[thisSourcesIndex].SKYCAMCatAPASSNUMTIMESSWITCHED=cat.APASSNUMTIMESSWITCHED[thisCatIndex] 
-                    sources[thisSourcesIndex].SKYCAMCatUSNOBNUMTIMESSWITCHED=cat.USNOBNUMTIMESSWITCHED[thisCatIndex]
+        if cat.NAME == "APASS" or cat.NAME == "USNOB":
+            ## if set, drop sources lying outside of colour limits
+            if checkColourIndex:
+                if cat.NAME == "APASS":
+                    BRColour = cat.BMAG[RefCatMatchedIndexes] - cat.RMAG[RefCatMatchedIndexes]
                 else:
-                    numUnmatchedSources = numUnmatchedSources + 1
-            else:
-                numUnmatchedSources = numUnmatchedSources + 1  
+                    BRColour = cat.B1MAG[RefCatMatchedIndexes] - cat.R1MAG[RefCatMatchedIndexes]
+                inColourLimits = (BRColour >= float(self.params['lowerColourLimit'])) & (BRColour <= float(self.params['upperColourLimit']))
+                numRemovedSourcesColour = int(np.count_nonzero(~inColourLimits))
+                keep[sourcesMatchedIndexes[~inColourLimits]] = False
+                sourcesMatchedIndexes = sourcesMatchedIndexes[inColourLimits]
+                RefCatMatchedIndexes = RefCatMatchedIndexes[inColourLimits]
+                matchDistances = matchDistances[inColourLimits]
+            
+            ## update sources with cross-matched catalogue details
+            sources.fill(cat.NAME, cat, sourcesMatchedIndexes, RefCatMatchedIndexes)
+            getattr(sources, cat.NAME + "CatXMatchDist")[sourcesMatchedIndexes] = matchDistances*3600
+            numUnmatchedSources = len(sources) - len(sourcesMatchedIndexes)
+        elif cat.NAME == "skycamz" or cat.NAME == "skycamt":
+            sources.fill("SKYCAM", cat, sourcesMatchedIndexes, RefCatMatchedIndexes)
+            sources.SKYCAMCatUSNOBREF[sourcesMatchedIndexes] = [ref.strip() for ref in sources.SKYCAMCatUSNOBREF[sourcesMatchedIndexes]]
+            numUnmatchedSources = len(sources) - len(sourcesMatchedIndexes)
+        else:
+            numUnmatchedSources = len(sources)
                 
         self.logger.info("(pipeline._XMatchSources) Removed " + str(numRemovedSourcesColour) + " source(s) due to colour index constraint")     
         self.logger.info("(pipeline._XMatchSources) Couldn't find a match for " + str(numUnmatchedSources) + " source(s)")              
-        
-        if cat.NAME == "APASS" or cat.NAME == "USNOB":
-            if len(sources) - numUnmatchedSources == 0:
-                self.err.setError(16)
-                self.err.handleError()
-                return sources, False
             
-        sources = [s for s in sources if s != None]   	# filter out removed sources
-        return sources, True
+        return keep, None
+
+    def _checkXMatches(self, cat, sources, kept, keep, checkNumMatchedSources=True):
+        '''
+        check the sources cross-matched with reference catalogue [cat], counting only those still [kept] after any 
+        earlier catalogues. [keep] is the mask returned by the cross-match, false for matches cut on colour.
+
+        returns an error code, or None if the check passed.
+        '''
+        if cat.NAME != "APASS" and cat.NAME != "USNOB":
+            return None
+        matched = sources.isMatched(cat.NAME) & kept
+
+        # if set, check number of matched sources (before the colour cut) is greater than the minimum required     
+        if checkNumMatchedSources:
+            if np.count_nonzero(matched | (kept & ~keep)) < int(self.params['minNumMatchedSources']):
+                return 12
+
+        if not matched.any():
+            return 16
+        return None
+
+    def _XMatchReference(self, in_FITS_im, c, sources):
+        '''
+        cross-match sources with reference catalogue [c]. this is called from the cross-match pool, with every 
+        catalogue matching into the same table of sources. catalogues have already been queried by run().
+
+        returns a mask of the sources to keep, an error code and any exception raised.
+        '''
+        try:
+            keep, errorCode = self._XMatchSourcesInPlace(in_FITS_im, False, cat=self.RefCatAll[c], sources=sources)
+            return keep, errorCode, None
+        except BaseException, e:      # critical errors exit/raise, which would otherwise kill the pool's worker thread
+            return None, None, e
 
     def _calibrateZP(self, sources, cat):
         '''
@@ -402,18 +548,14 @@ class pipeline():
 
         returns a list of calibration coefficients.
         '''
-        magDifference = []
-        BRcolour = []
         if cat == "APASS":
-            matchedSources = [s for s in sources if s.APASSCatREF is not None]
-            for i in matchedSources:
-                BRcolour.append(i.APASSCatBMAG - i.APASSCatRMAG)
-                magDifference.append(i.sExCatMagAuto - i.APASSCatRMAG)
+            matched = sources.isMatched("APASS")
+            BRcolour = sources.APASSCatBMAG[matched].astype(float) - sources.APASSCatRMAG[matched].astype(float)
+            magDifference = sources.sExCatMagAuto[matched] - sources.APASSCatRMAG[matched].astype(float)
         elif cat == "USNOB":
-            matchedSources = [s for s in sources if s.USNOBCatREF is not None]
-            for i in matchedSources:
-                BRcolour.append(i.USNOBCatB2MAG - i.USNOBCatR2MAG)
-                magDifference.append(i.sExCatMagAuto - i.USNOBCatR2MAG)          
+            matched = sources.isMatched("USNOB")
+            BRcolour = sources.USNOBCatB2MAG[matched].astype(float) - sources.USNOBCatR2MAG[matched].astype(float)
+            magDifference = sources.sExCatMagAuto[matched] - sources.USNOBCatR2MAG[matched].astype(float)
 
         # perform linear best fit
         coeffs, V = np.polyfit(BRcolour, magDifference, 1, cov=True) 
@@ -422,6 +564,195 @@ class pipeline():
 
         return magDifference, BRcolour, coeffs, V
 
+    def _imageValues(self, f, ZPs, ZP_COEFFS):
+        '''
+        build the images table row for a frame.
+
+        returns the row, with a new IMG_ID.
+        '''
+        im = FITSFile(f, self.err) 
+        im.openFITSFile()
+        im.getHeaders(0)
+            
+            
+        ## *******************************
+        ## **** skycam[tz?].images *******
+        ## *******************************           
+        # we do a bit of data cleansing on the headers and replace forward slashes with unicode equivalent 
+        # (otherwise REST interface breaks)
+        keep = ['DATE-OBS', 'MJD', 'UTSTART', 'RA_CENT', 'DEC_CENT', 'RA_MIN', 'RA_MAX', 'DEC_MIN', 
+                'DEC_MAX', 'CCDSTEMP', 'CCDATEMP', 'AZDMD', 'AZIMUTH', 'ALTDMD', 'ALTITUDE', 'ROTSKYPA']
+        values = {}
+        for key, val in im.headers.iteritems():
+            if key in keep:
+                try:
+                    values[key.replace('-', '_')] = urllib.quote(val, safe='').strip()
+                except AttributeError:
+                    values[key.replace('-', '_')] = val
+        values['FILENAME'] = os.path.basename(f).strip()
+        
+        # add frame zeropoint fields at zero colour term
+        for key, val in ZPs.iteritems():
+            values["FRAME_ZP_" + key] = val[0]
+            values["FRAME_ZP_STDEV_" + key] = val[1]
+        
+        # add frame zeropoint coefficients
+        for key, val in ZP_COEFFS.iteritems():
+            values["FRAME_ZP_M_" + key] = val[0]
+            values["FRAME_ZP_C_" + key] = val[1]    
+            
+        # generate a uuid for this img_id and add to values
+        img_id = str(uuid.uuid1())
+        values['IMG_ID'] = img_id
+
+        im.closeFITSFile()
+
+        return values
+
+    def _catalogueValues(self, sources, img_dateObs, ZP_COEFFS):
+        '''
+        build the catalogue table upserts for a frame's sources, which have been cross-matched with the Skycam 
+        catalogue.
+
+        returns a list of rows (one per source) and the number of new and reobserved Skycam sources.
+        '''
+        numNewSkycamCatalogueSources         = 0
+        numIncrementedSkycamCatalogueSources = 0
+        catalogue_values_to_add              = []
+
+        for s in sources:
+            # ------
+            # UPSERT.
+            # we let the database ON CONFLICT clause deal with whether this is an update or insert, but we still
+            # need to set each field separately for both instances
+            # ------
+            values = {}
+            if s.SKYCAMCatREF == None:                                                        # this source doesn't exist in the catalogue
+                values['skycamref']                       = str(uuid.uuid1())                 # give it a new skycamref
+                values['xmatch_apassref']                 = s.APASSCatREF
+                values['xmatch_apass_distasec']           = s.APASSCatXMatchDist
+                values['xmatch_usnobref']                 = s.USNOBCatREF
+                values['xmatch_usnob_distasec']           = s.USNOBCatXMatchDist
+                values['firstobs_date']                   = img_dateObs
+                values['lastobs_date']                    = img_dateObs
+                values['radeg']                           = s.sExCatRA
+                values['decdeg']                          = s.sExCatDEC
+                values['raerrasec']                       = 0                                 # we calculate an error when we have > 1 observation
+                values['decerrasec']                      = 0                                 # 
+                values['nobs']                            = 1   
+                values['xmatch_apass_brcolour']           = None
+                values['xmatch_apass_ntimesswitched']     = 0
+                values['xmatch_usnob_brcolour']           = None
+                values['xmatch_usnob_ntimesswitched']     = 0
+                
+                ## calculate magnitude from colour-dependent zp
+                ### APASS
+                if s.APASSCatREF is not None:                                                 # we can use the APASS colour terms
+                    values['xmatch_apass_brcolour']       = s.APASSCatBMAG-s.APASSCatRMAG
+                    zp = np.polyval(ZP_COEFFS['APASS'], values['xmatch_apass_brcolour'])
+                else:
+                    zp = np.polyval(ZP_COEFFS['APASS'], 1.5)                                  # else we assign an average ZP using colour of 1.5
+                calibrated_mag = s.sExCatMagAuto-zp
+                values['xmatch_apass_rollingmeanmag']     = calibrated_mag
+                values['xmatch_apass_rollingstdevmag']    = 0                                 # we calculate an error when we have > 1 observation
+                
+                ### USNOB
+                if s.USNOBCatREF is not None:                                                 # we can use the USNOB colour terms
+                    values['xmatch_usnob_brcolour']       = s.USNOBCatB1MAG-s.USNOBCatR1MAG
+                    zp = np.polyval(ZP_COEFFS['USNOB'], values['xmatch_usnob_brcolour'])
+                else:
+                    zp = np.polyval(ZP_COEFFS['USNOB'], 1.5)                                  # else we assign an average ZP using colour of 1.5
+                calibrated_mag = s.sExCatMagAuto-zp                   
+                values['xmatch_usnob_rollingmeanmag']     = calibrated_mag
+                values['xmatch_usnob_rollingstdevmag']    = 0                                 # we calculate an error when we have > 1 observation   
+                
+                numNewSkycamCatalogueSources              = numNewSkycamCatalogueSources + 1
+            else:                                                                             # this source already exists in the catalogue
+                values['skycamref']                       = s.SKYCAMCatREF
+                if str(s.APASSCatREF) != str(s.SKYCAMCatAPASSREF):                            # found different APASS reference
+                  values['xmatch_apass_ntimesswitched']   = int(s.SKYCAMCatAPASSNUMTIMESSWITCHED)+1
+                else:
+                  values['xmatch_apass_ntimesswitched']   = s.SKYCAMCatAPASSNUMTIMESSWITCHED
+                if str(s.USNOBCatREF) != s.SKYCAMCatUSNOBREF:                                 # found different USNOB reference
+                  values['xmatch_usnob_ntimesswitched']   = int(s.SKYCAMCatUSNOBNUMTIMESSWITCHED)+1
+                else:
+                  values['xmatch_usnob_ntimesswitched']   = s.SKYCAMCatUSNOBNUMTIMESSWITCHED
+                values['xmatch_apassref']                 = s.APASSCatREF
+                values['xmatch_apass_distasec']           = s.APASSCatXMatchDist
+                values['xmatch_usnobref']                 = s.USNOBCatREF
+                values['xmatch_usnob_distasec']           = s.USNOBCatXMatchDist
+                img_date_dt = datetime.strptime(img_dateObs, "%Y-%m-%dT%H:%M:%S")
+                firstobs_date_dt = datetime.strptime(s.SKYCAMCatFIRSTOBSDATE.rstrip('.000Z'), "%Y-%m-%dT%H:%M:%S") 
+                lastobs_date_dt = datetime.strptime(s.SKYCAMCatLASTOBSDATE.rstrip('.000Z'), "%Y-%m-%dT%H:%M:%S")
+                values['firstobs_date']                   = img_date_dt.strftime("%Y-%m-%dT%H:%M:%S") if img_date_dt < firstobs_date_dt else firstobs_date_dt.strftime("%Y-%m-%dT%H:%M:%S") # req check as multiprocessing
+                values['lastobs_date']                    = img_date_dt.strftime("%Y-%m-%dT%H:%M:%S") if img_date_dt > lastobs_date_dt else lastobs_date_dt.strftime("%Y-%m-%dT%H:%M:%S")   # req check as multiprocessing
+                values['radeg']       = calc_rolling_mean(s.SKYCAMCatRA, s.sExCatRA, s.SKYCAMCatNOBS+1)
+                values['raerrasec']   = calc_rolling_stdev(s.SKYCAMCatRAERR, s.sExCatRA*3600, s.SKYCAMCatRA*3600, values['radeg']*3600, s.SKYCAMCatNOBS+1)  
+                values['decdeg']      = calc_rolling_mean(s.SKYCAMCatDEC, s.sExCatDEC, s.SKYCAMCatNOBS+1)
+                values['decerrasec']  = calc_rolling_stdev(s.SKYCAMCatDECERR, s.sExCatDEC*3600, s.SKYCAMCatDEC*3600, values['decdeg']*3600, s.SKYCAMCatNOBS+1)                     
+                values['nobs']                            = s.SKYCAMCatNOBS+1
+                values['xmatch_apass_brcolour']           = None
+                values['xmatch_usnob_brcolour']           = None
+                
+                ## calculate magnitude from colour-dependent zp
+                ### APASS
+                if s.APASSCatREF is not None:                                                 # we can use the APASS colour terms
+                    values['xmatch_apass_brcolour']       = s.APASSCatBMAG-s.APASSCatRMAG
+                    zp = np.polyval(ZP_COEFFS['APASS'], values['xmatch_apass_brcolour'])
+                else:
+                    zp = np.polyval(ZP_COEFFS['APASS'], 1.5)                                  # else we assign an average ZP using colour of 1.5
+                calibrated_mag = s.sExCatMagAuto-zp
+                values['xmatch_apass_rollingmeanmag']     = calc_rolling_mean(s.SKYCAMCatROLLINGMEANAPASSMAG, calibrated_mag, s.SKYCAMCatNOBS+1)
+                values['xmatch_apass_rollingstdevmag']    = calc_rolling_stdev(s.SKYCAMCatROLLINGSTDEVAPASSMAG, calibrated_mag, s.SKYCAMCatROLLINGMEANAPASSMAG, values['xmatch_apass_rollingmeanmag'], s.SKYCAMCatNOBS+1)
+                
+                ### USNOB
+                if s.USNOBCatREF is not None:                                                 # we can use the USNOB colour terms
+                    values['xmatch_usnob_brcolour']       = s.USNOBCatB1MAG-s.USNOBCatR1MAG
+                    zp = np.polyval(ZP_COEFFS['USNOB'], values['xmatch_usnob_brcolour'])
+                else:
+                    zp = np.polyval(ZP_COEFFS['USNOB'], 1.5)                                  # else we assign an average ZP using colour of 1.5
+                calibrated_mag = s.sExCatMagAuto-zp                   
+                values['xmatch_usnob_rollingmeanmag']     = calc_rolling_mean(s.SKYCAMCatROLLINGMEANUSNOBMAG, calibrated_mag, s.SKYCAMCatNOBS+1)
+                values['xmatch_usnob_rollingstdevmag']    = calc_rolling_stdev(s.SKYCAMCatROLLINGSTDEVUSNOBMAG, calibrated_mag, s.SKYCAMCatROLLINGMEANUSNOBMAG,  values['xmatch_usnob_rollingmeanmag'], s.SKYCAMCatNOBS+1)  
+                numIncrementedSkycamCatalogueSources      = numIncrementedSkycamCatalogueSources + 1   
+            
+            catalogue_values_to_add.append(values)
+
+        return catalogue_values_to_add, numNewSkycamCatalogueSources, numIncrementedSkycamCatalogueSources
+
+    def _sourcesValues(self, sources, catalogue_values_to_add, img_id, img_mjd):
+        '''
+        build the sources table rows for a frame's sources, given their catalogue upserts.
+
+        returns a list of rows, one per source.
+        '''
+        sources_values_to_add = []
+        for s, v in zip(sources, catalogue_values_to_add):
+            values = {}
+            values['img_id']         = img_id
+            values['skycamref']      = v['skycamref']
+            values['mjd']            = img_mjd
+            values['radeg']          = s.sExCatRA
+            values['decdeg']         = s.sExCatDEC   
+            values['x_pix']          = s.sExCatx
+            values['y_pix']          = s.sExCaty
+            values['flux']           = s.sExCatFluxAuto
+            values['flux_err']       = s.sExCatFluxErrAuto
+            values['inst_mag']       = s.sExCatMagAuto
+            values['inst_mag_err']   = s.sExCatMagErrAuto
+            values['background']     = s.sExCatBackground
+            values['isoarea_world']  = s.sExCatIsoareaWorld
+            values['seflags']        = s.sExCatSEFlags
+            values['fwhm']           = s.sExCatFWHM
+            values['elongation']     = s.sExCatElongation
+            values['ellipticity']    = s.sExCatEllipticity
+            values['theta_image']    = s.sExCatThetaImage  
+            
+            # add these values to list
+            sources_values_to_add.append(values)
+
+        return sources_values_to_add
+
     def _storeToPostgresDatabase(self, f, sources, ZPs, ZP_COEFFS):
         '''
         store skycam image and extracted source information
@@ -454,40 +785,13 @@ class pipeline():
             self.err.handleError()  
             return False
         else:
-	    this_uuid = str(uuid.uuid1())	# this is used to keep flush buffer calls separate for each pipeline instance
-            im = FITSFile(f, self.err) 
-            im.openFITSFile()
-            im.getHeaders(0)
-                
+            this_uuid = str(uuid.uuid1())     # this is used to keep flush buffer calls separate for each pipeline instance
+            
             ## *******************************
             ## **** skycam[tz?].images *******
             ## *******************************           
-            # we do a bit of data cleansing on the headers and replace forward slashes with unicode equivalent 
-            # (otherwise REST interface breaks)
-            keep = ['DATE-OBS', 'MJD', 'UTSTART', 'RA_CENT', 'DEC_CENT', 'RA_MIN', 'RA_MAX', 'DEC_MIN', 
-                    'DEC_MAX', 'CCDSTEMP', 'CCDATEMP', 'AZDMD', 'AZIMUTH', 'ALTDMD', 'ALTITUDE', 'ROTSKYPA']
-            values = {}
-            for key, val in im.headers.iteritems():
-                if key in keep:
-                    try:
-                        values[key.replace('-', '_')] = urllib.quote(val, safe='').strip()
-                    except AttributeError:
-                        values[key.replace('-', '_')] = val
-            values['FILENAME'] = os.path.basename(f).strip()
-            
-            # add frame zeropoint fields at zero colour term
-            for key, val in ZPs.iteritems():
-                values["FRAME_ZP_" + key] = val[0]
-                values["FRAME_ZP_STDEV_" + key] = val[1]
-            
-            # add frame zeropoint coefficients
-            for key, val in ZP_COEFFS.iteritems():
-                values["FRAME_ZP_M_" + key] = val[0]
-                values["FRAME_ZP_C_" + key] = val[1]    
-                
-            # generate a uuid for this img_id and add to values
-            img_id = str(uuid.uuid1())
-            values['IMG_ID'] = img_id
+            values = self._imageValues(f, ZPs, ZP_COEFFS)
+            img_id = values['IMG_ID']
                 
             # call web service to insert image
             ws_cat.skycam_images_insert(self.params['schemaName'], values)
@@ -496,167 +800,41 @@ class pipeline():
                 self.err.handleError()
                 return False
 
-            img_mjd 	= values['MJD']		# need this later
-            img_dateObs = values['DATE_OBS'].replace("%3A", ':')
+            img_mjd         = values['MJD']              # need this later
+            img_dateObs     = values['DATE_OBS'].replace("%3A", ':')
 
             self.logger.info("(pipeline._storeToPostgresDatabase) Stored image details for " + str(os.path.basename(f)) + " with img_id of " + str(img_id) + " in images table")
             
-            im.closeFITSFile()  		#FIXME REMOVE!
-            return				#FIXME REMOVE!
+            if not self.params['storeSources']:
+                return
  
             ## *******************************
             ## **** skycam[tz?].catalogue ****
             ## *******************************    
-            numNewSkycamCatalogueSources         = 0
-            numIncrementedSkycamCatalogueSources = 0
-            catalogue_values_to_add		 = []
-
-            for s in sources:
-                # ------
-                # UPSERT.
-                # we let the database ON CONFLICT clause deal with whether this is an update or insert, but we still
-                # need to set each field separately for both instances
-                # ------
-                values = {}
-                if s.SKYCAMCatREF == None:                                                        # this source doesn't exist in the catalogue
-                    values['skycamref']                       = str(uuid.uuid1())		  # give it a new skycamref
-                    values['xmatch_apassref']                 = s.APASSCatREF
-                    values['xmatch_apass_distasec']           = s.APASSCatXMatchDist
-                    values['xmatch_usnobref']                 = s.USNOBCatREF
-                    values['xmatch_usnob_distasec']           = s.USNOBCatXMatchDist
-                    values['firstobs_date']                   = img_dateObs
-                    values['lastobs_date']                    = img_dateObs
-                    values['radeg']                           = s.sExCatRA
-                    values['decdeg']                          = s.sExCatDEC
-                    values['raerrasec']                       = 0                                 # we calculate an error when we have > 1 observation
-                    values['decerrasec']                      = 0                                 # 
-                    values['nobs']                            = 1   
-                    values['xmatch_apass_brcolour']           = None
-                    values['xmatch_apass_ntimesswitched']     = 0
-                    values['xmatch_usnob_brcolour']           = None
-                    values['xmatch_usnob_ntimesswitched']     = 0
-                    
-                    ## calculate magnitude from colour-dependent zp
-                    ### APASS
-                    if s.APASSCatREF is not None:                                                 # we can use the APASS colour terms
-                        values['xmatch_apass_brcolour']       = s.APASSCatBMAG-s.APASSCatRMAG
-                        zp = np.polyval(ZP_COEFFS['APASS'], values['xmatch_apass_brcolour'])
-                    else:
-                        zp = np.polyval(ZP_COEFFS['APASS'], 1.5)                                  # else we assign an average ZP using colour of 1.5
-                    calibrated_mag = s.sExCatMagAuto-zp
-                    values['xmatch_apass_rollingmeanmag']     = calibrated_mag
-                    values['xmatch_apass_rollingstdevmag']    = 0                                 # we calculate an error when we have > 1 observation
-                    
-                    ### USNOB
-                    if s.USNOBCatREF is not None:                                                 # we can use the USNOB colour terms
-                        values['xmatch_usnob_brcolour']       = s.USNOBCatB1MAG-s.USNOBCatR1MAG
-                        zp = np.polyval(ZP_COEFFS['USNOB'], values['xmatch_usnob_brcolour'])
-                    else:
-                        zp = np.polyval(ZP_COEFFS['USNOB'], 1.5)                                  # else we assign an average ZP using colour of 1.5
-                    calibrated_mag = s.sExCatMagAuto-zp                   
-                    values['xmatch_usnob_rollingmeanmag']     = calibrated_mag
-                    values['xmatch_usnob_rollingstdevmag']    = 0                                 # we calculate an error when we have > 1 observation   
-                    
-                    numNewSkycamCatalogueSources              = numNewSkycamCatalogueSources + 1
-                else:                                                                             # this source already exists in the catalogue
-                    values['skycamref']                       = s.SKYCAMCatREF
-                    if str(s.APASSCatREF) != str(s.SKYCAMCatAPASSREF):                            # found different APASS reference
-                      values['xmatch_apass_ntimesswitched']   = int(s.SKYCAMCatAPASSNUMTIMESSWITCHED)+1
-                    else:
-                      values['xmatch_apass_ntimesswitched']   = s.SKYCAMCatAPASSNUMTIMESSWITCHED
-                    if str(s.USNOBCatREF) != s.SKYCAMCatUSNOBREF:                                 # found different USNOB reference
-                      values['xmatch_usnob_ntimesswitched']   = int(s.SKYCAMCatUSNOBNUMTIMESSWITCHED)+1
-                    else:
-                      values['xmatch_usnob_ntimesswitched']   = s.SKYCAMCatUSNOBNUMTIMESSWITCHED
-                    values['xmatch_apassref']                 = s.APASSCatREF
-                    values['xmatch_apass_distasec']           = s.APASSCatXMatchDist
-                    values['xmatch_usnobref']                 = s.USNOBCatREF
-                    values['xmatch_usnob_distasec']           = s.USNOBCatXMatchDist
-                    img_date_dt = datetime.strptime(img_dateObs, "%Y-%m-%dT%H:%M:%S")
- 		    firstobs_date_dt = datetime.strptime(s.SKYCAMCatFIRSTOBSDATE.rstrip('.000Z'), "%Y-%m-%dT%H:%M:%S") 
-                    lastobs_date_dt = datetime.strptime(s.SKYCAMCatLASTOBSDATE.rstrip('.000Z'), "%Y-%m-%dT%H:%M:%S")
-                    values['firstobs_date']                   = img_date_dt.strftime("%Y-%m-%dT%H:%M:%S") if img_date_dt < firstobs_date_dt else firstobs_date_dt.strftime("%Y-%m-%dT%H:%M:%S")	# req check as multiprocessing
-                    values['lastobs_date']                    = img_date_dt.strftime("%Y-%m-%dT%H:%M:%S") if img_date_dt > lastobs_date_dt else lastobs_date_dt.strftime("%Y-%m-%dT%H:%M:%S")	# req check as multiprocessing
-                    values['radeg']       = calc_rolling_mean(s.SKYCAMCatRA, s.sExCatRA, s.SKYCAMCatNOBS+1)
-                    values['raerrasec']   = calc_rolling_stdev(s.SKYCAMCatRAERR, s.sExCatRA*3600, s.SKYCAMCatRA*3600, values['radeg']*3600, s.SKYCAMCatNOBS+1)  
-                    values['decdeg']      = calc_rolling_mean(s.SKYCAMCatDEC, s.sExCatDEC, s.SKYCAMCatNOBS+1)
-                    values['decerrasec']  = calc_rolling_stdev(s.SKYCAMCatDECERR, s.sExCatDEC*3600, s.SKYCAMCatDEC*3600, values['decdeg']*3600, s.SKYCAMCatNOBS+1)                     
-                    values['nobs']                            = s.SKYCAMCatNOBS+1
-                    values['xmatch_apass_brcolour']           = None
-                    values['xmatch_usnob_brcolour']           = None
-                    
-                    ## calculate magnitude from colour-dependent zp
-                    ### APASS
-                    if s.APASSCatREF is not None:                                                 # we can use the APASS colour terms
-                        values['xmatch_apass_brcolour']       = s.APASSCatBMAG-s.APASSCatRMAG
-                        zp = np.polyval(ZP_COEFFS['APASS'], values['xmatch_apass_brcolour'])
-                    else:
-                        zp = np.polyval(ZP_COEFFS['APASS'], 1.5)                                  # else we assign an average ZP using colour of 1.5
-                    calibrated_mag = s.sExCatMagAuto-zp
-                    values['xmatch_apass_rollingmeanmag']     = calc_rolling_mean(s.SKYCAMCatROLLINGMEANAPASSMAG, calibrated_mag, s.SKYCAMCatNOBS+1)
-                    values['xmatch_apass_rollingstdevmag']    = calc_rolling_stdev(s.SKYCAMCatROLLINGSTDEVAPASSMAG, calibrated_mag, s.SKYCAMCatROLLINGMEANAPASSMAG, values['xmatch_apass_rollingmeanmag'], s.SKYCAMCatNOBS+1)
-                    
-                    ### USNOB
-                    if s.USNOBCatREF is not None:                                                 # we can use the USNOB colour terms
-                        values['xmatch_usnob_brcolour']       = s.USNOBCatB1MAG-s.USNOBCatR1MAG
-                        zp = np.polyval(ZP_COEFFS['USNOB'], values['xmatch_usnob_brcolour'])
-                    else:
-                        zp = np.polyval(ZP_COEFFS['USNOB'], 1.5)                                  # else we assign an average ZP using colour of 1.5
-                    calibrated_mag = s.sExCatMagAuto-zp                   
-                    values['xmatch_usnob_rollingmeanmag']     = calc_rolling_mean(s.SKYCAMCatROLLINGMEANUSNOBMAG, calibrated_mag, s.SKYCAMCatNOBS+1)
-                    values['xmatch_usnob_rollingstdevmag']    = calc_rolling_stdev(s.SKYCAMCatROLLINGSTDEVUSNOBMAG, calibrated_mag, s.SKYCAMCatROLLINGMEANUSNOBMAG,  values['xmatch_usnob_rollingmeanmag'], s.SKYCAMCatNOBS+1)  
-                    numIncrementedSkycamCatalogueSources      = numIncrementedSkycamCatalogueSources + 1   
-                
-                catalogue_values_to_add.append(values)
-
-	    ## call web service to add catalogue values to buffer
-	    ws_cat.skycam_catalogue_add_to_buffer(this_uuid, catalogue_values_to_add)
-	    if ws_cat.status != 200:
-	        self.err.setError(15)
-	        self.err.handleError()
-	        return False	
-		  
-	    self.logger.info("(pipeline._storeToPostgresDatabase) " + str(numNewSkycamCatalogueSources) + " new Skycam source(s) inserted into catalogue buffer")
-	    self.logger.info("(pipeline._storeToPostgresDatabase) catalogue buffer updated with " + str(numIncrementedSkycamCatalogueSources) + " reobserved Skycam source(s)")        
+            catalogue_values_to_add, numNewSkycamCatalogueSources, numIncrementedSkycamCatalogueSources = self._catalogueValues(sources, img_dateObs, ZP_COEFFS)
+
+            ## call web service to add catalogue values to buffer
+            ws_cat.skycam_catalogue_add_to_buffer(this_uuid, catalogue_values_to_add)
+            if ws_cat.status != 200:
+                self.err.setError(15)
+                self.err.handleError()
+                return False
+              
+            self.logger.info("(pipeline._storeToPostgresDatabase) " + str(numNewSkycamCatalogueSources) + " new Skycam source(s) inserted into catalogue buffer")
+            self.logger.info("(pipeline._storeToPostgresDatabase) catalogue buffer updated with " + str(numIncrementedSkycamCatalogueSources) + " reobserved Skycam source(s)")        
              
             ## *****************************
             ## **** skycam[tz?].sources ****
             ## *****************************   
-            numNewSkycamSources = 0  
-            sources_values_to_add	 = []
-            for s, v in zip(sources, catalogue_values_to_add):
-                values = {}
-                values['img_id']         = img_id
-                values['skycamref']      = v['skycamref']
-                values['mjd']            = img_mjd
-                values['radeg']          = s.sExCatRA
-                values['decdeg']         = s.sExCatDEC   
-                values['x_pix']          = s.sExCatx
-                values['y_pix']          = s.sExCaty
-                values['flux']           = s.sExCatFluxAuto
-                values['flux_err']       = s.sExCatFluxErrAuto
-                values['inst_mag']       = s.sExCatMagAuto
-                values['inst_mag_err']   = s.sExCatMagErrAuto
-                values['background']     = s.sExCatBackground
-                values['isoarea_world']  = s.sExCatIsoareaWorld
-                values['seflags']        = s.sExCatSEFlags
-                values['fwhm']           = s.sExCatFWHM
-                values['elongation']     = s.sExCatElongation
-                values['ellipticity']    = s.sExCatEllipticity
-                values['theta_image']    = s.sExCatThetaImage  
-                
-                # add these values to list
-                sources_values_to_add.append(values)
-                
-                numNewSkycamSources = numNewSkycamSources + 1 
+            sources_values_to_add = self._sourcesValues(sources, catalogue_values_to_add, img_id, img_mjd)
   
-	    ws_cat.skycam_sources_add_to_buffer(this_uuid, sources_values_to_add)
-	    if ws_cat.status != 200:
-	        self.err.setError(15)
-	        self.err.handleError()
-	        return False   
+            ws_cat.skycam_sources_add_to_buffer(this_uuid, sources_values_to_add)
+            if ws_cat.status != 200:
+                self.err.setError(15)
+                self.err.handleError()
+                return False   
                 
-	    self.logger.info("(pipeline._storeToPostgresDatabase) " + str(numNewSkycamSources) + " Skycam source(s) added to sources buffer")                
+            self.logger.info("(pipeline._storeToPostgresDatabase) " + str(len(sources_values_to_add)) + " Skycam source(s) added to sources buffer")                
          
             ## call web service to flush all buffers to database in single transaction and set image success flag to true
             ws_cat.skycam_flush_buffers_by_uuid_to_db(self.params['schemaName'], img_id, this_uuid)
@@ -666,5 +844,101 @@ class pipeline():
                 self.err.handleError()
                 return False
             self.logger.info("(pipeline._storeToPostgresDatabase) flushed buffers to database")      
-                
-            im.closeFITSFile()    
+
+    def _queueStore(self, f, hdr, sources, ZPs, ZP_COEFFS):
+        '''
+        add a frame, with a copy of its image headers [hdr], to the store batch, storing the batch once it's full.
+        '''
+        if not self.storeBatch:
+            self.storeBatchStart = time.time()
+        self.storeBatch.append((f, hdr, sources, ZPs, ZP_COEFFS))
+        if len(self.storeBatch) >= self.params['storeBatchSize']:
+            self._flushStoreBatch()
+
+    def _flushStoreBatch(self):
+        '''
+        store the batched frames, holding the database lock once for the whole batch.
+        '''
+        if not self.storeBatch:
+            return
+        batch, self.storeBatch = self.storeBatch, []
+        lock = LockFile(self.params['path_lock'])
+        try:
+            lock.acquire()                                   # we effectively lock any other threads from executing, otherwise mid-air collision
+            self.logger.info("(pipeline._flushStoreBatch) locked database")
+            stored = self._storeBatchToPostgresDatabase(batch)
+            lock.release()
+            self.logger.info("(pipeline._flushStoreBatch) released lock on database")
+        except BaseException, e:
+            lock.release()                                   # always release lock after exception, otherwise it'll hang other threads..
+            self.logger.warning("(pipeline._flushStoreBatch) released database after fault: " + repr(e))
+            stored = False
+        if not stored:
+            self.logger.warning("(pipeline._flushStoreBatch) Frames not stored: " + ", ".join([os.path.basename(frame[0]) for frame in batch]))
+            self.err.setError(20)
+            self.err.handleError()
+
+    def _storeBatchToPostgresDatabase(self, batch):
+        '''
+        store a batch of skycam images and their extracted source information with a single call, flushed to 
+        the database in one transaction.
+
+        returns True if the batch was stored.
+
+        if sources are being stored, each frame is cross-matched with the Skycam catalogue in turn, with the 
+        catalogue rows upserted by earlier frames in the batch overlaid, so that sources seen in more than one 
+        frame are accumulated rather than inserted twice.
+        '''
+        try:
+            ip, port, username, password = rpf(self.params['path_pw_list'], self.params['skycam_cat_db_credentials_id'])
+            port = int(port)
+        except IOError:
+            self.err.setError(-19)
+            self.err.handleError()       
+        except TypeError:
+            self.err.setError(-20)
+            self.err.handleError() 
+ 
+        ws_cat = wsc(ip, port, self.err, self.logger) 
+
+        images_values_to_add    = []
+        catalogue_values_to_add = {}          # keyed on skycamref, rows from later frames replace earlier ones
+        sources_values_to_add   = []
+        for f, hdr, sources, ZPs, ZP_COEFFS in batch:
+            values = self._imageValues(f, ZPs, ZP_COEFFS)
+            img_dateObs = values['DATE_OBS'].replace("%3A", ':')
+
+            if not self.params['storeSources']:
+                images_values_to_add.append(values)
+                self.logger.info("(pipeline._storeBatchToPostgresDatabase) Batched image details for " + str(os.path.basename(f)) + " with img_id of " + str(values['IMG_ID']))
+                continue
+
+            # without the catalogue, reobserved sources would be inserted as new ones
+            if not self._queryCatalogue(hdr, self.SkycamCat):
+                self.logger.warning("(pipeline._storeBatchToPostgresDatabase) Skycam catalogue query failed, not storing " + str(os.path.basename(f)))
+                continue
+            self.SkycamCat.overlay(catalogue_values_to_add.values())
+            if len(self.SkycamCat.RA) > 0:                  # otherwise every source is new
+                sources = self._XMatchSources(None, False, cat=self.SkycamCat, sources=sources)[0]
+
+            frame_catalogue_values, numNewSkycamCatalogueSources, numIncrementedSkycamCatalogueSources = self._catalogueValues(sources, img_dateObs, ZP_COEFFS)
+            for v in frame_catalogue_values:
+                catalogue_values_to_add[v['skycamref']] = v
+            images_values_to_add.append(values)
+            sources_values_to_add.extend(self._sourcesValues(sources, frame_catalogue_values, values['IMG_ID'], values['MJD']))
+
+            self.logger.info("(pipeline._storeBatchToPostgresDatabase) Batched " + str(os.path.basename(f)) + " with img_id of " + str(values['IMG_ID']) + ", " 
+                             + str(numNewSkycamCatalogueSources) + " new and " + str(numIncrementedSkycamCatalogueSources) + " reobserved Skycam source(s)")
+
+        if not images_values_to_add:
+            return False
+
+        ## call web service to store the batch and flush it to database in single transaction
+        ws_cat.skycam_batch_to_db(self.params['schemaName'], str(uuid.uuid1()), images_values_to_add, catalogue_values_to_add.values(), sources_values_to_add)
+        if ws_cat.status != 200:
+            self.err.setError(15)
+            self.err.handleError()
+            return False
+        self.logger.info("(pipeline._storeBatchToPostgresDatabase) Stored " + str(len(images_values_to_add)) + " image(s), " + str(len(catalogue_values_to_add)) 
+                         + " catalogue row(s) and " + str(len(sources_values_to_add)) + " source(s) in one transaction")
+        return True
@@ -6,19 +6,123 @@ description: 	A wrapper script for sExtractor
 '''
 import logging
 import os, shutil
+import atexit
+import subprocess
+import tempfile
+import threading
+import uuid
+
+import numpy as np
+import pyfits
 
 import asciidata
 
+BINARY_CATALOG_TYPES = ('FITS_1.0', 'FITS_LDAC')
+
+# integer valued sExtractor parameters, every other column of a streamed ASCII catalogue is read as float
+INTEGER_PARAMS = ('NUMBER', 'FLAGS', 'FLAGS_WEIGHT', 'IMAFLAGS_ISO', 'NIMAFLAGS_ISO', 'EXT_NUMBER', 'ISOAREA_IMAGE', 
+                  'ISOAREAF_IMAGE', 'XMIN_IMAGE', 'YMIN_IMAGE', 'XMAX_IMAGE', 'YMAX_IMAGE', 'XPEAK_IMAGE', 'YPEAK_IMAGE')
+
+def read_cat(path):
+    '''
+    read a sExtractor catalogue into a NumPy structured array. 
+
+    binary (FITS_1.0, FITS_LDAC) catalogues are read straight through pyfits, anything else is parsed as 
+    an ASCII_HEAD catalogue.
+    '''
+    with open(path, 'rb') as f:
+        isFITS = f.read(6) == 'SIMPLE'
+    if isFITS:
+        return _read_cat_fits(path)
+    else:
+        return _read_cat_ascii(path)
+
+def _read_cat_fits(path):
+    hdus = pyfits.open(path, memmap=False)
+    try:
+        if 'LDAC_OBJECTS' in [hdu.name for hdu in hdus]:
+            hdu = hdus['LDAC_OBJECTS']
+        else:
+            hdu = hdus[1]
+        if hdu.data is None:        # no sources
+            return np.zeros(0, dtype=[(name, float) for name in hdu.columns.names])
+        data = np.array(hdu.data).view(np.ndarray)
+        return data.astype(data.dtype.newbyteorder('='))
+    finally:
+        hdus.close()
+
+def _read_cat_ascii(path):
+    catdata = asciidata.open(path)
+    return np.rec.fromarrays([col.tonumpy() for col in catdata.columns], names=[col.colname for col in catdata.columns]).view(np.ndarray)
+
+def read_cat_stream(stream, chunk_rows=4096):
+    '''
+    read an ASCII_HEAD sExtractor catalogue from a stream into a NumPy structured array, parsing 
+    rows as they arrive. rows are converted [chunk_rows] at a time into an array that grows by doubling.
+    '''
+    names = []
+    catdata, n = None, 0
+    chunk = []
+    for line in iter(stream.readline, ''):
+        if line.startswith('#'):
+            fields = line.split()
+            col, name = int(fields[1]), fields[2]
+            _pad_vector_names(names, col - 1)
+            names.append(name)
+        elif line.strip():
+            chunk.append(line.split())
+            if len(chunk) == chunk_rows:
+                catdata, n = _append_rows(catdata, n, names, chunk)
+                chunk = []
+
+    if not names:
+        return None
+    catdata, n = _append_rows(catdata, n, names, chunk)
+    if n < len(catdata):
+        catdata = catdata[:n].copy()
+    return catdata
+
+def _append_rows(catdata, n, names, rows):
+    # convert a chunk of split rows into [catdata] after its first [n] rows, growing it if need be
+    if catdata is None:
+        if rows:
+            _pad_vector_names(names, len(rows[0]))
+        catdata = np.zeros(len(rows), dtype=[(name, int if name in INTEGER_PARAMS else float) for name in names])
+    if n + len(rows) > len(catdata):
+        grown = np.zeros(max(n + len(rows), 2*len(catdata)), dtype=catdata.dtype)
+        grown[:n] = catdata[:n]
+        catdata = grown
+    data = np.array(rows, dtype=float).reshape(len(rows), len(names))
+    for idx, name in enumerate(names):
+        catdata[name][n:n + len(rows)] = data[:, idx]
+    return catdata, n + len(rows)
+
+def _pad_vector_names(names, ncols):
+    # vector parameters (e.g. FLUX_APER) only head their first column, name the rest after it
+    vector_name, n = names[-1] if names else None, 1
+    while len(names) < ncols:
+        n = n + 1
+        names.append(vector_name + '_' + str(n))
+
 class pysex():
-    def __init__(self, f, data_path, path_to_conf_file, err, logger):
+    # sExtractor configs rendered once per process, keyed on (config file, scratch path)
+    _rendered_confs = {}
+    _rendered_confs_lock = threading.Lock()
+
+    def __init__(self, f, data_path, path_to_conf_file, err, logger, scratch_path=None, stream=False):
         self.f = f
         self.data_path = data_path
         self.path_to_conf_file = path_to_conf_file
+        self.scratch_path = scratch_path
+        self.stream = stream
         self.catdata = None
+        self.catalog_type = None
+        self.conf_path = None
+        self.cat_path = None
         self.err = err
         self.logger = logger
         
-    def _setup(self):
+    def _parse_conf(self):
         # parse standard conf file into dict
         sEx_conf = {}
         with open(self.path_to_conf_file, 'r') as f:
@@ -31,47 +135,127 @@ class pysex():
         if not os.path.exists(sEx_conf["PARAMETERS_NAME"]):
             self.err.setError(-7)
             self.err.handleError()
-        self.logger.info("(pysex._setup Using parameter file " + sEx_conf["PARAMETERS_NAME"])
+        self.logger.info("(pysex._parse_conf) Using parameter file " + sEx_conf["PARAMETERS_NAME"])
+
+        # binary catalogues are read straight into NumPy, ASCII_HEAD is kept as a fallback
+        if sEx_conf.get('CATALOG_TYPE', 'ASCII_HEAD') not in BINARY_CATALOG_TYPES:
+            self.logger.info("(pysex._parse_conf) Catalogue type is " + sEx_conf.get('CATALOG_TYPE', 'ASCII_HEAD') + ", falling back to ASCII parser")
 
-        # append catalogue output file parameter based on data_path
-        sEx_conf['CATALOG_NAME'] = self.data_path + ".pysex.cat"
+        return sEx_conf
 
-        with open(self.data_path + ".pysex.sex", 'w') as f:
+    def get_conf_files(self):
+        '''
+        returns the config file along with the parameter/filter/neural network files it refers to.
+        '''
+        sEx_conf = self._parse_conf()
+        files = [self.path_to_conf_file]
+        for key in ('PARAMETERS_NAME', 'FILTER_NAME', 'STARNNW_NAME'):
+            if key in sEx_conf and os.path.exists(sEx_conf[key]):
+                files.append(sEx_conf[key])
+        return files
+
+    def get_catalog_type(self):
+        '''
+        returns the type of catalogue configured, which the hard copy is written as. streamed catalogues are 
+        always piped as ASCII_HEAD.
+        '''
+        return self._parse_conf().get('CATALOG_TYPE', 'ASCII_HEAD')
+
+    def _write_conf(self, sEx_conf, path):
+        with open(path, 'w') as f:
             for key, val in sEx_conf.iteritems():
                 f.write(key + ' ' + val + '\n')
 
+    def _render_conf(self):
+        '''
+        render the config into a scratch directory private to this process. CATALOG_NAME is 
+        passed on the command line for each frame instead.
+        '''
+        scratch_dir = tempfile.mkdtemp(prefix='pysex.' + str(os.getpid()) + '.', dir=self.scratch_path)
+        atexit.register(shutil.rmtree, scratch_dir, True)
+        
+        sEx_conf = self._parse_conf()
+        conf_path = os.path.join(scratch_dir, 'pysex.sex')
+        self._write_conf(sEx_conf, conf_path)
+        self.logger.info("(pysex._render_conf) Rendered sExtractor config to " + conf_path)
+
+        return conf_path, sEx_conf.get('CATALOG_TYPE', 'ASCII_HEAD'), scratch_dir
+
+    def _setup(self):
+        if self.scratch_path is None:
+            # render a fresh config alongside the data for every frame
+            sEx_conf = self._parse_conf()
+            self.catalog_type = sEx_conf.get('CATALOG_TYPE', 'ASCII_HEAD')
+            self.conf_path = self.data_path + ".pysex.sex"
+            self.cat_path = self.data_path + ".pysex.cat"
+            self._write_conf(sEx_conf, self.conf_path)
+        else:
+            # reuse the config rendered for this process, and keep the catalogue in its scratch directory 
+            key = (self.path_to_conf_file, self.scratch_path)
+            with pysex._rendered_confs_lock:
+                if key not in pysex._rendered_confs:
+                    pysex._rendered_confs[key] = self._render_conf()
+            self.conf_path, self.catalog_type, scratch_dir = pysex._rendered_confs[key]
+            self.cat_path = os.path.join(scratch_dir, str(uuid.uuid4()) + '.pysex.cat')
+
     def _get_cmd(self):
-        cmd = 'sex ' + str(self.f) + ' -c ' + str(self.data_path) + '.pysex.sex'
+        cmd = ['sex', str(self.f), '-c', str(self.conf_path)]
+        if self.stream:
+            # sExtractor can only pipe ASCII catalogues to stdout
+            cmd = cmd + ['-CATALOG_NAME', 'STDOUT', '-CATALOG_TYPE', 'ASCII_HEAD']
+        else:
+            cmd = cmd + ['-CATALOG_NAME', str(self.cat_path)]
         return cmd
 
     def _cleanup(self):
-        files = [f for f in os.listdir(self.data_path) if '.pysex.' in f]
+        files = [self.cat_path]
+        if self.scratch_path is None:
+            files.append(self.conf_path)
         for f in files:
-            os.remove(self.data_path + f)
+            if os.path.exists(f):
+                os.remove(f)
 
     def _read_cat(self):
-        catdata = asciidata.open(self.data_path + '.pysex.cat')
+        catdata = read_cat(self.cat_path)
         return catdata
 
     def run(self):
         self._setup()
         cmd = self._get_cmd()
-        res = os.system(cmd)
+        if self.stream:
+            # parse the catalogue straight off sExtractor's stdout
+            proc = subprocess.Popen(cmd, stdout=subprocess.PIPE)
+            try:
+                self.catdata = read_cat_stream(proc.stdout)
+            finally:
+                proc.stdout.close()
+                res = proc.wait()
+        else:
+            res = subprocess.call(cmd)
         if res:
-            self.err.setError(-17)
+            self.logger.critical("(pysex.run) sExtractor exited with status " + str(res) + " for " + str(self.f))
+            self._cleanup()
+            self.err.setError(-8)
             self.err.handleError()
-            _cleanup(image)
             return False
 
-        self.catdata = self._read_cat()
+        if not self.stream:
+            self.catdata = self._read_cat()
         self._cleanup()
+        return True
 
     def write_cat(self, path):
         '''
         write sExtractor catalogue to file
         '''
         self.logger.info("(pysex.write_cat) Writing sExtractor catalogue to " + path)
-        self.catdata.writeto(path)
+        if self.catalog_type in BINARY_CATALOG_TYPES:
+            pyfits.BinTableHDU(self.catdata).writeto(path, clobber=True)
+        else:
+            names = self.catdata.dtype.names
+            fmt = ['%d' if np.issubdtype(self.catdata.dtype[name], np.integer) else '%.10g' for name in names]
+            header = '\n'.join(['%4d %s' % (idx+1, name) for idx, name in enumerate(names)])
+            np.savetxt(path, self.catdata, fmt=fmt, header=header, comments='#')
 
         return True
 
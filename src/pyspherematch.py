@@ -9,14 +9,13 @@ Requires numpy and scipy.
 from __future__ import division
 
 import numpy as np
-from collections import Counter
 
 try:
     from scipy.spatial import cKDTree as KDT
 except ImportError:
     from scipy.spatial import KDTree as KDT
  
-def spherematch(ra1, dec1, ra2, dec2, logger, tol=None, nnearest=1):
+def spherematch(ra1, dec1, ra2, dec2, logger, tol=None, nnearest=1, tree=None, assign='nearest', n_jobs=1):
     """
     Finds matches in one catalog to another.
  
@@ -37,6 +36,19 @@ def spherematch(ra1, dec1, ra2, dec2, logger, tol=None, nnearest=1):
         second nearest neighbor, etc.  Particularly useful if you want to get
         the nearest *non-self* neighbor of a catalog.  To do this, use:
         ``spherematch(ra, dec, ra, dec, nnearest=2)``
+    tree : KDTree or None, optional
+        A tree over the second catalog, as returned by `build_tree`. If None,
+        one is built for this call.
+    assign : 'nearest' or 'greedy', optional
+        With 'nearest', each object in the first catalog is matched to its
+        nearest neighbour and duplicate matches are resolved in favour of the
+        closest. With 'greedy', every pair within `tol` is a candidate and
+        pairs are accepted in order of increasing distance, so an object
+        whose nearest neighbour is taken can still match its next nearest.
+        'greedy' requires `tol` and ignores `nnearest`.
+    n_jobs : int, optional
+        Number of processes to split the tree queries over, -1 for all
+        cores. Needs a cKDTree.
  
     Returns
     -------
@@ -60,27 +72,27 @@ def spherematch(ra1, dec1, ra2, dec2, logger, tol=None, nnearest=1):
     if ra2.shape != dec2.shape:
         raise ValueError('ra2 and dec2 do not match!')
  
-    x1, y1, z1 = _spherical_to_cartesian(ra1.ravel(), dec1.ravel())
+    coords1 = _to_cartesian_coords(ra1, dec1)
  
-    # this is equivalent to, but faster than just doing np.array([x1, y1, z1])
-    coords1 = np.empty((x1.size, 3))
-    coords1[:, 0] = x1
-    coords1[:, 1] = y1
-    coords1[:, 2] = z1
- 
-    x2, y2, z2 = _spherical_to_cartesian(ra2.ravel(), dec2.ravel())
- 
-    # this is equivalent to, but faster than just doing np.array([x1, y1, z1])
-    coords2 = np.empty((x2.size, 3))
-    coords2[:, 0] = x2
-    coords2[:, 1] = y2
-    coords2[:, 2] = z2
- 
-    kdt = KDT(coords2)
+    kdt = tree
+    if kdt is None:
+        kdt = build_tree(ra2, dec2)
+
+    if assign == 'greedy':
+        if tol is None:
+            raise ValueError('greedy assignment requires a tolerance')
+        return _greedy_match(ra1, dec1, ra2, dec2, coords1, kdt, tol, logger)
+    elif assign != 'nearest':
+        raise ValueError('invalid assign ' + str(assign))
+
+    query_args = {}
+    if n_jobs != 1:
+        query_args['n_jobs'] = n_jobs
+
     if nnearest == 1:
-        idxs2 = kdt.query(coords1)[1]
+        idxs2 = kdt.query(coords1, **query_args)[1]
     elif nnearest > 1:
-        idxs2 = kdt.query(coords1, nnearest)[1][:, -1]
+        idxs2 = kdt.query(coords1, nnearest, **query_args)[1][:, -1]
     else:
         raise ValueError('invalid nnearest ' + str(nnearest))
  
@@ -100,28 +112,99 @@ def spherematch(ra1, dec1, ra2, dec2, logger, tol=None, nnearest=1):
         idxs1 = idxs1[idxs2_unique_indexes]
         logger.info("(pipeline._XMatchSources.spherematch) Found " + str(c - len(idxs1)) + " duplicate(s) in spherematch")'''
 
-        # The following removes duplicates, only preserving the nearest match
+        # The following removes duplicates, only preserving the nearest match. Matches are sorted by 
+        # reference index then distance, so the first of each run of equal reference indexes is the 
+        # nearest. Ties go to the lowest index in the first catalog.
         c = len(idxs1)
-        for i in Counter(idxs2).most_common():		# returns ([idx_that_is_the_duplicate, count), ..])
-          if i[1] < 2:					# no more duplicates here
-            break
-          else:
-            duplicate_idxs = np.where(idxs2==i[0])[0]			# what are the indexes of the duplicate entry in idxs2 
-            duplicate_idxs_dist = ds[duplicate_idxs]			# find the corresponding distances
-            duplicate_idx_min = np.argmin(duplicate_idxs_dist)		# find the index of the minimum of the above
-            keep = duplicate_idxs[duplicate_idx_min]			# this the index in duplicate_idxs to be retained
-            for d in duplicate_idxs:					# delete all but "keep" index
-              if d == keep:
-                continue
-              else:
-                idxs1 = np.delete(idxs1, d)
-                idxs2 = np.delete(idxs2, d)
-                ds = np.delete(ds, d)
+        order = np.lexsort((ds, idxs2))
+        first = np.ones(c, dtype=bool)
+        first[1:] = idxs2[order][1:] != idxs2[order][:-1]
+        keep = np.sort(order[first])				# restore the order of the first catalog
+        idxs1 = idxs1[keep]
+        idxs2 = idxs2[keep]
+        ds = ds[keep]
         logger.info("(pipeline._XMatchSources.spherematch) Found " + str(c - len(idxs1)) + " duplicate(s) in spherematch")
 
     return idxs1, idxs2, ds
  
  
+def _greedy_match(ra1, dec1, ra2, dec2, coords1, kdt, tol, logger):
+    """
+    (Private internal function)
+    One-to-one matching over all candidate pairs within `tol`.
+
+    Candidates come from a sparse distance matrix between the two trees,
+    using the chord length equivalent to `tol`. Pairs that are the nearest
+    remaining candidate of both their objects are accepted together, their
+    objects removed, and the rest go round again. This gives the same result
+    as accepting pairs one at a time in order of increasing distance, but a
+    round at a time rather than a pair at a time.
+    """
+    chord = 2*np.sin(np.radians(tol)/2.)
+    pairs = KDT(coords1).sparse_distance_matrix(kdt, chord, output_type='ndarray')
+    idxs1 = pairs['i'].astype(int)
+    idxs2 = pairs['j'].astype(int)
+    ds = _great_circle_distance(ra1[idxs1], dec1[idxs1], ra2[idxs2], dec2[idxs2])
+    msk = ds < tol
+    idxs1, idxs2, ds = idxs1[msk], idxs2[msk], ds[msk]
+    ncandidates = len(idxs1)
+
+    accepted = []
+    nrounds = 0
+    while len(idxs1) > 0:
+        # the nearest candidate of each object in either catalog, ties going to the lowest pair index
+        order = np.lexsort((ds, idxs1))
+        first = np.ones(len(order), dtype=bool)
+        first[1:] = idxs1[order][1:] != idxs1[order][:-1]
+        best1 = np.zeros(len(order), dtype=bool)
+        best1[order[first]] = True
+
+        order = np.lexsort((ds, idxs2))
+        first = np.ones(len(order), dtype=bool)
+        first[1:] = idxs2[order][1:] != idxs2[order][:-1]
+        best2 = np.zeros(len(order), dtype=bool)
+        best2[order[first]] = True
+
+        mutual = np.flatnonzero(best1 & best2)
+        accepted.append((idxs1[mutual], idxs2[mutual], ds[mutual]))
+
+        remaining = ~(np.in1d(idxs1, idxs1[mutual]) | np.in1d(idxs2, idxs2[mutual]))
+        idxs1, idxs2, ds = idxs1[remaining], idxs2[remaining], ds[remaining]
+        nrounds = nrounds + 1
+
+    idxs1 = np.concatenate([a[0] for a in accepted] + [np.empty(0, dtype=int)])
+    idxs2 = np.concatenate([a[1] for a in accepted] + [np.empty(0, dtype=int)])
+    ds = np.concatenate([a[2] for a in accepted] + [np.empty(0)])
+    order = np.argsort(idxs1, kind='mergesort')                  # restore the order of the first catalog
+    logger.info("(pipeline._XMatchSources.spherematch) Assigned " + str(len(order)) + " match(es) from " + str(ncandidates) + " candidate pair(s) in " + str(nrounds) + " round(s)")
+
+    return idxs1[order], idxs2[order], ds[order]
+ 
+ 
+def build_tree(ra, dec):
+    """
+    Builds a KD-tree over a catalog, for reuse as the `tree` argument of
+    `spherematch` while the catalog is unchanged.
+    """
+    return KDT(_to_cartesian_coords(np.array(ra, copy=False), np.array(dec, copy=False)))
+ 
+ 
+def _to_cartesian_coords(ra, dec):
+    """
+    (Private internal function)
+    Inputs in degrees.  Outputs an (n, 3) array of x,y,z
+    """
+    x, y, z = _spherical_to_cartesian(ra.ravel(), dec.ravel())
+ 
+    # this is equivalent to, but faster than just doing np.array([x, y, z])
+    coords = np.empty((x.size, 3))
+    coords[:, 0] = x
+    coords[:, 1] = y
+    coords[:, 2] = z
+ 
+    return coords
+ 
+ 
 def _spherical_to_cartesian(ra, dec):
     """
     (Private internal function)
@@ -88,8 +88,37 @@ if __name__ == "__main__":
         params['resRootPath']                   = str(pipe_cfg['paths']['path_root_res'].rstrip("/") + "/") 
         params['path_pw_list']                  = str(pipe_cfg['paths']['path_pw_list'])
         params['path_lock']			= str(pipe_cfg['paths']['path_lock'])
+        params['scratchPath']                   = str(pipe_cfg['paths']['path_scratch'].rstrip("/") + "/") if pipe_cfg['paths']['path_scratch'].lower() != 'none' else None
+        params['sExCachePath']                  = str(pipe_cfg['paths']['path_sex_cache'].rstrip("/") + "/")
+        params['refTilesPath']                  = str(pipe_cfg['paths']['path_ref_tiles'].rstrip("/") + "/")
+        params['SCSCachePath']                  = str(pipe_cfg['paths']['path_scs_cache'].rstrip("/") + "/")
         params['cat']                           = [c.upper() for c in str(pipe_cfg['general']['xmatch_cat']).split(',')]
         params['processes']                     = int(pipe_cfg['general']['max_processes'])
+        params['maxSExProcesses']               = int(pipe_cfg['general']['max_sex_processes'])
+        params['streamSExCat']                  = bool(int(pipe_cfg['general']['stream_sex_cat']))
+        params['sExCacheSize']                  = int(float(pipe_cfg['general']['sex_cache_size_mb'])*1024*1024)
+        params['maxXMatchThreads']              = int(pipe_cfg['general']['max_xmatch_threads'])
+        params['XMatchQueryJobs']               = int(pipe_cfg['general']['xmatch_query_jobs'])
+        params['storeBatchSize']                = int(pipe_cfg['general']['store_batch_size'])
+        params['storeBatchMaxLatency']          = float(pipe_cfg['general']['store_batch_latency'])
+        params['storeSources']                  = bool(int(pipe_cfg['general']['store_sources']))
+        params['WSPoolSize']                    = int(pipe_cfg['general']['ws_pool_size'])
+        params['WSConnectTimeout']              = float(pipe_cfg['general']['ws_connect_timeout'])
+        params['WSReadTimeout']                 = float(pipe_cfg['general']['ws_read_timeout'])
+        params['WSMaxRetries']                  = int(pipe_cfg['general']['ws_max_retries'])
+        params['WSRetryDelay']                  = float(pipe_cfg['general']['ws_retry_delay'])
+        params['WSMaxRetryDelay']               = float(pipe_cfg['general']['ws_max_retry_delay'])
+        params['WSHedgeSCS']                    = bool(int(pipe_cfg['general']['ws_hedge_scs']))
+        params['WSHedgeQuantile']               = float(pipe_cfg['general']['ws_hedge_quantile'])
+        params['WSBreakerThreshold']            = int(pipe_cfg['general']['ws_breaker_threshold'])
+        params['WSBreakerCooldown']             = float(pipe_cfg['general']['ws_breaker_cooldown'])
+        params['WSPayloadColumnar']             = bool(int(pipe_cfg['general']['ws_payload_columnar']))
+        params['WSPayloadCompression']          = str(pipe_cfg['general']['ws_payload_compression'])
+        params['useRefTiles']                   = bool(int(pipe_cfg['general']['use_ref_tiles']))
+        params['SCSCacheSize']                  = int(float(pipe_cfg['general']['scs_cache_size_mb'])*1024*1024)
+        params['SCSFormat']                     = str(pipe_cfg['general']['scs_format'])
+        params['SCSMaxBytes']                   = int(float(pipe_cfg['general']['scs_max_mb'])*1024*1024)
+        params['SCSCacheQuantum']               = float(pipe_cfg['general']['scs_cache_quantum'])
         params['obs_day_start']                 = str(pipe_cfg['general']['obs_day_start'])
         params['obs_day_end']                   = str(pipe_cfg['general']['obs_day_end'])
         params['t_sync_check']                  = float(pipe_cfg['general']['t_sync_check'])   
@@ -111,6 +140,7 @@ if __name__ == "__main__":
         params['CCDSizeX']                      = int(pipe_cfg[inst_cfg_header]['ccd_size_x'])
         params['CCDSizeY']                      = int(pipe_cfg[inst_cfg_header]['ccd_size_y'])
         params['matchingTolerance']             = float(pipe_cfg[inst_cfg_header]['matching_tolerance'])
+        params['XMatchAssign']                  = str(pipe_cfg[inst_cfg_header]['xmatch_assign'])
         params['upperColourLimit']              = float(pipe_cfg[inst_cfg_header]['upper_colour_limit'])
         params['lowerColourLimit']              = float(pipe_cfg[inst_cfg_header]['lower_colour_limit'])
         params['limitingMag']                   = float(pipe_cfg[inst_cfg_header]['limiting_mag'])
@@ -119,6 +149,7 @@ if __name__ == "__main__":
         params['minNumMatchedSources']          = int(pipe_cfg[inst_cfg_header]['min_num_matched_sources'])
         params['maxNumSourcesXMatch']           = int(pipe_cfg[inst_cfg_header]['max_num_sources_xmatch'])
         params['forceCatalogueQuery']           = bool(int(pipe_cfg[inst_cfg_header]['force_cat_query']))     
+        params['slideCatalogueWindow']          = bool(int(pipe_cfg[inst_cfg_header]['slide_cat_window']))
     except KeyError, e:
         logger.info("[run_pipe.go] Key/section " + str(e) + " appears to be missing.")
         exit(0) 
@@ -143,6 +174,11 @@ if __name__ == "__main__":
     except AssertionError: 
         logger.critical("(__main__) unknown reference catalogue.")
         exit(0)
+    try:
+        assert params['maxSExProcesses'] <= 1 or params['scratchPath'] is not None    # sExtractor would otherwise share its config/catalogue files in the res directory
+    except AssertionError: 
+        logger.critical("(__main__) path_scratch must be set to run more than one sExtractor process.")
+        exit(0)
         
     ## create a lock file to avoid mid-air collisions when saving data to skycam database
     lock = LockFile(params['path_lock'])
@@ -0,0 +1,151 @@
+'''
+name:		scs.py
+author:		rmb
+
+description: 	Decoders for SCS (cone search) web service responses
+'''
+import json
+from io import BytesIO
+
+import numpy as np
+
+class growableTable():
+    '''
+    a structured array that grows (by doubling) as rows are appended, up to a ceiling of [max_bytes].
+    '''
+    def __init__(self, dtype, max_bytes, capacity=4096):
+        self.dtype = np.dtype(dtype)
+        self.max_rows = max(int(max_bytes) // self.dtype.itemsize, 1)
+        self._data = np.empty(min(capacity, self.max_rows), dtype=self.dtype)
+        self._n = 0
+
+    def __len__(self):
+        return self._n
+
+    def append(self, row):
+        '''
+        append a row, returning False (and dropping it) if the table is already at its ceiling.
+        '''
+        if self._n == len(self._data):
+            if self._n >= self.max_rows:
+                return False
+            grown = np.empty(min(2*len(self._data), self.max_rows), dtype=self.dtype)
+            grown[:self._n] = self._data
+            self._data = grown
+        self._data[self._n] = row
+        self._n = self._n + 1
+        return True
+
+    def array(self):
+        return self._data[:self._n].copy()
+
+def _decode_row(entry, columns):
+    return tuple([str(entry[col]) if dtype.startswith('S') else float(entry[col]) for col, dtype in columns])
+
+def decodeSCS(text, columns):
+    '''
+    decode a JSON SCS response into a structured array with [columns] (name, dtype). rows with missing or
+    unparsable values are skipped.
+    '''
+    rows = []
+    for entry in json.loads(text):
+        try:
+            rows.append(_decode_row(entry, columns))
+        except (ValueError, TypeError):
+            continue
+    return np.array(rows, dtype=columns)
+
+def decodeSCSBinary(content, columns):
+    '''
+    decode a binary (.npy) SCS response into a structured array with [columns] (name, dtype).
+    '''
+    data = np.load(BytesIO(content))
+    decoded = np.empty(len(data), dtype=columns)
+    for col, dtype in columns:
+        decoded[col] = data[col]
+    return decoded
+
+def decodeSCSStream(chunks, columns, max_bytes, logger):
+    '''
+    decode a JSON SCS response (an array of flat objects) from an iterable of [chunks] as they arrive,
+    without ever holding the whole body. rows go straight into a growableTable, so at most [max_bytes]
+    of decoded rows are held; as responses are ordered by distance, any beyond that are the furthest
+    and are dropped.
+
+    returns the rows and whether any were dropped, or None, False if the body was cut off or malformed.
+    '''
+    table = growableTable(columns, max_bytes)
+    decoder = json.JSONDecoder()
+    buf = ''
+    closed = False                              # seen the array's closing bracket
+    nskipped = 0
+    for chunk in chunks:
+        buf = buf + chunk
+        pos = 0
+        while True:
+            # skip the array's brackets, separators and whitespace between objects
+            while pos < len(buf) and buf[pos] in ' \t\r\n[],':
+                closed = closed or buf[pos] == ']'
+                pos = pos + 1
+            if pos == len(buf):
+                break
+            try:
+                entry, end = decoder.raw_decode(buf, pos)
+            except ValueError:                  # object isn't complete yet, wait for the next chunk
+                break
+            pos = end
+            try:
+                row = _decode_row(entry, columns)
+            except (ValueError, TypeError):
+                nskipped = nskipped + 1
+                continue
+            if not table.append(row):
+                logger.warning("(scs.decodeSCSStream) Response exceeds " + str(max_bytes) + " bytes, truncated to the nearest " + str(len(table)) + " row(s)")
+                return table.array(), True
+        buf = buf[pos:]
+    if buf or not closed:
+        logger.warning("(scs.decodeSCSStream) Response was cut off or malformed, discarding " + str(len(table)) + " row(s)")
+        return None, False
+    if nskipped:
+        logger.info("(scs.decodeSCSStream) Skipped " + str(nskipped) + " row(s) with missing or unparsable values")
+    return table.array(), False
+
+def _read_exactly(raw, nbytes):
+    # streamed reads can come back short, keep reading until we have [nbytes] or the stream ends
+    parts = []
+    while nbytes > 0:
+        part = raw.read(nbytes)
+        if not part:
+            break
+        parts.append(part)
+        nbytes = nbytes - len(part)
+    return ''.join(parts)
+
+def decodeSCSBinaryStream(raw, columns, max_bytes, logger, chunk_rows=65536):
+    '''
+    decode a binary (.npy) SCS response from the file-like [raw] in chunks of [chunk_rows] rows, holding
+    at most [max_bytes] of decoded rows. as with decodeSCSStream, rows beyond that are dropped.
+
+    returns the rows and whether any were dropped, or None, False if the body was cut off.
+    '''
+    version = np.lib.format.read_magic(raw)
+    if version == (1, 0):
+        shape, fortran_order, dtype = np.lib.format.read_array_header_1_0(raw)
+    else:
+        shape, fortran_order, dtype = np.lib.format.read_array_header_2_0(raw)
+
+    nrows = min(shape[0], max(int(max_bytes) // np.dtype(columns).itemsize, 1))
+    if nrows < shape[0]:
+        logger.warning("(scs.decodeSCSBinaryStream) Response exceeds " + str(max_bytes) + " bytes, truncated to the nearest " + str(nrows) + " row(s)")
+    decoded = np.empty(nrows, dtype=columns)
+
+    for start in range(0, nrows, chunk_rows):
+        n = min(chunk_rows, nrows - start)
+        buf = _read_exactly(raw, n*dtype.itemsize)
+        chunk = np.frombuffer(buf, dtype=dtype, count=len(buf) // dtype.itemsize)
+        for col, coldtype in columns:
+            decoded[col][start:start+len(chunk)] = chunk[col]
+        if len(chunk) < n:                      # short read, response was cut off
+            logger.warning("(scs.decodeSCSBinaryStream) Response was cut off after " + str(start + len(chunk)) + " of " + str(shape[0]) + " row(s), discarding")
+            return None, False
+    return decoded, nrows < shape[0]
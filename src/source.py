@@ -2,9 +2,11 @@
 name:		source.py
 author:		rmb
 
-description: 	A class to hold source information
+description: 	Classes to hold source information
 '''
 
+import numpy as np
+
 class source():
     def __init__(self, filename, sExCatRA, sExCatDEC, sExCatx, sExCaty, sExCatFluxAuto, sExCatFluxErrAuto, sExCatMagAuto, 
                  sExCatMagErrAuto, sExCatBackground, sExCatIsoareaWorld, sExCatSEFlags, sExCatFWHM, sExCatElongation, sExCatEllipticity, 
@@ -82,3 +84,91 @@ class source():
         self.sExCatElongation = sExCatElongation
         self.sExCatEllipticity = sExCatEllipticity
         self.sExCatThetaImage = sExCatThetaImage
+
+class sourceTable():
+    '''
+    a column-oriented table of sources. each source attribute is held as an array over all sources, 
+    reference catalogue fields are None wherever a source hasn't been cross-matched.
+    '''
+    # sExtractor fields, in the order source() takes them
+    SEX_COLUMNS = ['sExCatRA', 'sExCatDEC', 'sExCatx', 'sExCaty', 'sExCatFluxAuto', 'sExCatFluxErrAuto', 'sExCatMagAuto', 
+                   'sExCatMagErrAuto', 'sExCatBackground', 'sExCatIsoareaWorld', 'sExCatSEFlags', 'sExCatFWHM', 'sExCatElongation', 
+                   'sExCatEllipticity', 'sExCatThetaImage']
+
+    # reference catalogue fields, and the catalogue attributes they're filled from on a cross-match
+    XMATCH_COLUMNS = {'APASS' : [('REF', 'APASSCatREF'), ('RA', 'APASSCatRA'), ('DEC', 'APASSCatDEC'), ('RAERR', 'APASSCatRAERR'), 
+                                 ('DECERR', 'APASSCatDECERR'), ('VMAG', 'APASSCatVMAG'), ('BMAG', 'APASSCatBMAG'), ('GMAG', 'APASSCatGMAG'), 
+                                 ('RMAG', 'APASSCatRMAG'), ('IMAG', 'APASSCatIMAG'), ('VMAGERR', 'APASSCatVMAGERR'), 
+                                 ('BMAGERR', 'APASSCatBMAGERR'), ('GMAGERR', 'APASSCatGMAGERR'), ('RMAGERR', 'APASSCatRMAGERR'), 
+                                 ('IMAGERR', 'APASSCatIMAGERR'), ('NOBS', 'APASSCatNOBS')],
+                      'USNOB' : [('REF', 'USNOBCatREF'), ('RA', 'USNOBCatRA'), ('DEC', 'USNOBCatDEC'), ('RAERR', 'USNOBCatRAERR'), 
+                                 ('DECERR', 'USNOBCatDECERR'), ('R1MAG', 'USNOBCatR1MAG'), ('B1MAG', 'USNOBCatB1MAG'), 
+                                 ('R2MAG', 'USNOBCatR2MAG'), ('B2MAG', 'USNOBCatB2MAG')],
+                      'SKYCAM': [('REF', 'SKYCAMCatREF'), ('RA', 'SKYCAMCatRA'), ('DEC', 'SKYCAMCatDEC'), ('RAERR', 'SKYCAMCatRAERR'), 
+                                 ('DECERR', 'SKYCAMCatDECERR'), ('FIRSTOBSDATE', 'SKYCAMCatFIRSTOBSDATE'), 
+                                 ('LASTOBSDATE', 'SKYCAMCatLASTOBSDATE'), ('APASSREF', 'SKYCAMCatAPASSREF'), 
+                                 ('USNOBREF', 'SKYCAMCatUSNOBREF'), ('NOBS', 'SKYCAMCatNOBS'), 
+                                 ('APASSXMATCHBRCOLOUR', 'SKYCAMCatAPASSBRCOLOUR'), ('USNOBXMATCHBRCOLOUR', 'SKYCAMCatUSNOBBRCOLOUR'), 
+                                 ('ROLLINGMEANAPASSMAG', 'SKYCAMCatROLLINGMEANAPASSMAG'), 
+                                 ('ROLLINGSTDEVAPASSMAG', 'SKYCAMCatROLLINGSTDEVAPASSMAG'), 
+                                 ('ROLLINGMEANUSNOBMAG', 'SKYCAMCatROLLINGMEANUSNOBMAG'), 
+                                 ('ROLLINGSTDEVUSNOBMAG', 'SKYCAMCatROLLINGSTDEVUSNOBMAG'), 
+                                 ('APASSNUMTIMESSWITCHED', 'SKYCAMCatAPASSNUMTIMESSWITCHED'), 
+                                 ('USNOBNUMTIMESSWITCHED', 'SKYCAMCatUSNOBNUMTIMESSWITCHED')]}
+
+    # reference catalogue fields that aren't copied straight from a catalogue attribute
+    EXTRA_COLUMNS = ['APASSCatXMatchDist', 'USNOBCatXMatchDist', 'SKYCAMCatAPASSXMATCHDISTASEC', 'SKYCAMCatUSNOBXMATCHDISTASEC']
+
+    def __init__(self, filename, sExCat=None):
+        self.filename = filename
+        n = 0
+        if sExCat is not None:
+            n = len(sExCat.RA)
+            for col, catCol in zip(self.SEX_COLUMNS, ['RA', 'DEC', 'X_IMAGE', 'Y_IMAGE', 'FLUX_AUTO', 'FLUXERR_AUTO', 'MAG_AUTO', 
+                                                     'MAGERR_AUTO', 'BACKGROUND', 'ISOAREA_WORLD', 'FLAGS', 'FWHM_WORLD', 
+                                                     'ELONGATION', 'ELLIPTICITY', 'THETA_IMAGE']):
+                setattr(self, col, getattr(sExCat, catCol))
+        else:
+            for col in self.SEX_COLUMNS:
+                setattr(self, col, np.empty(0))
+        for col in self._refColumns():
+            setattr(self, col, np.full(n, None, dtype=object))
+
+    def __len__(self):
+        return len(self.sExCatRA)
+
+    def __iter__(self):
+        '''
+        iterate over the table as source instances, for consumers that work a row at a time.
+        '''
+        cols = self.SEX_COLUMNS + self._refColumns()
+        for row in zip(*[getattr(self, col).tolist() for col in cols]):
+            yield source(self.filename, **dict(zip(cols, row)))
+
+    def _refColumns(self):
+        cols = list(self.EXTRA_COLUMNS)
+        for fields in self.XMATCH_COLUMNS.itervalues():
+            cols = cols + [col for catCol, col in fields]
+        return cols
+
+    def select(self, idx):
+        '''
+        returns a new table holding the rows picked out by a boolean mask or index array [idx].
+        '''
+        table = sourceTable(self.filename)
+        for col in self.SEX_COLUMNS + self._refColumns():
+            setattr(table, col, getattr(self, col)[idx])
+        return table
+
+    def fill(self, name, cat, sourceIdx, catIdx):
+        '''
+        copy the [name] reference catalogue fields of catalogue [cat] rows [catIdx] into table rows [sourceIdx].
+        '''
+        for catCol, col in self.XMATCH_COLUMNS[name]:
+            getattr(self, col)[sourceIdx] = getattr(cat, catCol)[catIdx]
+
+    def isMatched(self, name):
+        '''
+        returns a mask of the rows cross-matched to the [name] reference catalogue.
+        '''
+        return np.not_equal(getattr(self, name + 'CatREF'), None)
@@ -0,0 +1,71 @@
+'''
+name:		test_cache.py
+author:		rmb
+
+description: 	Tests for the on-disk array cache in cache.py
+'''
+import os
+import time
+import shutil
+import logging
+import tempfile
+import unittest
+
+import numpy as np
+
+from cache import arrayCache, hash_files
+
+class testArrayCache(unittest.TestCase):
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.logger = logging.getLogger('test_cache')
+
+    def tearDown(self):
+        shutil.rmtree(self.path, True)
+
+    def test_round_trip(self):
+        cache = arrayCache(self.path, 1<<20, self.logger)
+        data = np.zeros(10, dtype=[('X_IMAGE', 'f8'), ('FLAGS', 'i4')])
+        data['X_IMAGE'] = np.arange(10)
+        self.assertTrue(cache.put('key', data))
+        np.testing.assert_array_equal(cache.get('key'), data)
+
+    def test_miss(self):
+        self.assertIsNone(arrayCache(self.path, 1<<20, self.logger).get('key'))
+
+    def test_evicts_least_recently_used(self):
+        data = np.zeros(1000)
+        cache = arrayCache(self.path, 2.5*data.nbytes, self.logger)
+        cache.put('a', data)
+        cache.put('b', data)
+        past = time.time() - 60
+        os.utime(os.path.join(self.path, 'a.npy'), (past, past))
+        os.utime(os.path.join(self.path, 'b.npy'), (past - 60, past - 60))
+        cache.get('b')                  # b is now the most recently used
+        cache.put('c', data)
+        self.assertIsNone(cache.get('a'))
+        self.assertIsNotNone(cache.get('b'))
+        self.assertIsNotNone(cache.get('c'))
+
+class testHashFiles(unittest.TestCase):
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.files = [os.path.join(self.path, name) for name in ('a', 'b')]
+        for f in self.files:
+            with open(f, 'w') as fh:
+                fh.write(os.path.basename(f))
+
+    def tearDown(self):
+        shutil.rmtree(self.path, True)
+
+    def test_depends_on_contents_order_and_extra(self):
+        key = hash_files(self.files, extra=(True, 0))
+        self.assertEqual(key, hash_files(self.files, extra=(True, 0)))
+        self.assertNotEqual(key, hash_files(self.files[::-1], extra=(True, 0)))
+        self.assertNotEqual(key, hash_files(self.files, extra=(False, 0)))
+        with open(self.files[0], 'w') as fh:
+            fh.write('changed')
+        self.assertNotEqual(key, hash_files(self.files, extra=(True, 0)))
+
+if __name__ == "__main__":
+    unittest.main()
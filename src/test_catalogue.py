@@ -0,0 +1,150 @@
+'''
+name:		test_catalogue.py
+author:		rmb
+
+description: 	Tests for the catalogue classes in catalogue.py
+'''
+import logging
+import unittest
+
+import numpy as np
+
+import pyspherematch as pysm
+from catalogue import APASSCatalogue, SkycamCatalogue
+from source import sourceTable
+from tiles import COLUMNS
+
+class fakeTiles():
+    '''
+    a sky of random APASS objects, cone searched without any tiles.
+    '''
+    def __init__(self, n=20000, seed=0):
+        rng = np.random.RandomState(seed)
+        self.sky = np.zeros(n, dtype=COLUMNS['APASS'])
+        self.sky['apassref'] = np.arange(n).astype('S32')
+        self.sky['ra'] = rng.uniform(0, 20, n)
+        self.sky['dec'] = rng.uniform(10, 30, n)
+        self.sky['rmag'] = 10.
+
+    def cone(self, ra, dec, sr, mag_col, mag_bright_lim, mag_faint_lim, max_sources):
+        return self.sky[pysm._great_circle_distance(ra, dec, self.sky['ra'], self.sky['dec']) <= sr]
+
+class failingAPASSCatalogue(APASSCatalogue):
+    '''
+    fails any query narrower than [minRadius], or every query if [minRadius] is None.
+    '''
+    minRadius = 0
+
+    def query(self, pw_file, pw_file_id, raDeg, decDeg, searchRadius, limitingMag, maxNumSourcesXMatch, appendToCat=True):
+        if self.minRadius is None or searchRadius < self.minRadius:
+            self._clear()
+            return False
+        return APASSCatalogue.query(self, pw_file, pw_file_id, raDeg, decDeg, searchRadius, limitingMag, maxNumSourcesXMatch, appendToCat)
+
+class testSlide(unittest.TestCase):
+    def setUp(self):
+        self.tiles = fakeTiles()
+        self.cat = failingAPASSCatalogue(None, logging.getLogger('test_catalogue'), tiles=self.tiles)
+
+    def slide(self, ra, dec):
+        self.cat.slide(None, None, ra, dec, 3., 20., 1e6)
+
+    def assertHolds(self, ra, dec):
+        expected = set(self.tiles.cone(ra, dec, 3., 'rmag', -1, 20., 1e6)['apassref'])
+        self.assertEqual(set(self.cat.REF), expected)
+        self.assertEqual(len(self.cat.REF), len(expected))
+
+    def test_slide_matches_full_query(self):
+        self.slide(10., 20.)
+        self.slide(10.2, 20.1)
+        self.assertHolds(10.2, 20.1)
+
+    def test_failed_delta_query_requeries_whole_cone(self):
+        self.slide(10., 20.)
+        self.cat.minRadius = 3.
+        self.slide(10.2, 20.1)
+        self.assertHolds(10.2, 20.1)
+        self.assertEqual(self.cat._window[:2], (10.2, 20.1))
+
+    def test_failed_query_forgets_window(self):
+        self.slide(10., 20.)
+        self.cat.minRadius = None
+        self.slide(10.2, 20.1)
+        self.assertIsNone(self.cat._window)
+
+class dictCache():
+    def __init__(self):
+        self.entries = {}
+
+    def get(self, key):
+        return self.entries.get(key)
+
+    def put(self, key, data):
+        self.entries[key] = data
+
+class fakeSCSCatalogue(APASSCatalogue):
+    '''
+    answers SCS from a sky of random objects, nearest first and up to the row limit, as the web service does.
+    '''
+    def _SCS(self, ip, port, raDeg, decDeg, searchRadius, magCol, magBrightLim, magFaintLim, maxNumSources):
+        self.numSCS = getattr(self, 'numSCS', 0) + 1
+        dist = pysm._great_circle_distance(raDeg, decDeg, self.tiles.sky['ra'], self.tiles.sky['dec'])
+        inCone = np.flatnonzero(dist <= searchRadius)
+        data = self.tiles.sky[inCone[np.argsort(dist[inCone], kind='mergesort')]][:int(maxNumSources)]
+        return data, len(data) >= int(maxNumSources)
+
+class testCachedSCS(unittest.TestCase):
+    def setUp(self):
+        self.tiles = fakeTiles()
+        self.cat = fakeSCSCatalogue(None, logging.getLogger('test_catalogue'), scsCache=dictCache(), scsQuantum=0.5)
+
+    def cachedSCS(self, maxNumSources):
+        cone = self.cat._cachedSCS(None, None, 10.2, 20.2, 1., 'rmag', -1, 20., maxNumSources)
+        expected, truncated = self.cat._SCS(None, None, 10.2, 20.2, 1., 'rmag', -1, 20., maxNumSources)
+        self.assertEqual(cone['apassref'].tolist(), expected['apassref'].tolist())
+
+    def test_complete_response_is_cached(self):
+        self.cat.tiles = self.tiles
+        self.cachedSCS(1e6)
+        self.assertEqual(len(self.cat.scsCache.entries), 1)
+
+    def test_truncated_response_is_not_cached(self):
+        self.cat.tiles = self.tiles
+        for maxNumSources in (50, 150, 300):       # short of, about and beyond the requested cone
+            self.cachedSCS(maxNumSources)
+        self.assertEqual(self.cat.scsCache.entries, {})
+
+def skycam_row(ref, ra, nobs):
+    return {'skycamref': ref, 'radeg': ra, 'decdeg': 10., 'raerrasec': 0., 'decerrasec': 0., 'firstobs_date': '2016-01-01T01:23:45', 
+            'lastobs_date': '2016-01-01T01:23:45', 'xmatch_apassref': None, 'xmatch_usnobref': None, 'nobs': nobs, 
+            'xmatch_apass_brcolour': None, 'xmatch_usnob_brcolour': None, 'xmatch_apass_rollingmeanmag': 12., 
+            'xmatch_apass_rollingstdevmag': 0., 'xmatch_usnob_rollingmeanmag': 12., 'xmatch_usnob_rollingstdevmag': 0., 
+            'xmatch_apass_distasec': None, 'xmatch_usnob_distasec': None, 'xmatch_apass_ntimesswitched': 0, 
+            'xmatch_usnob_ntimesswitched': 0}
+
+class testSkycamOverlay(unittest.TestCase):
+    def setUp(self):
+        self.cat = SkycamCatalogue(None, logging.getLogger('test_catalogue'), 'skycamt')
+        self.cat._clear()
+        self.cat.overlay([skycam_row('a', 1., 1), skycam_row('b', 2., 1)])
+
+    def test_columns_are_typed_arrays(self):
+        self.assertEqual(self.cat.RA.dtype, np.float64)
+        self.assertEqual(self.cat.NOBS.dtype.kind, 'i')
+        self.assertEqual(self.cat.REF.dtype.kind, 'S')
+
+    def test_rows_replaced(self):
+        self.cat.overlay([skycam_row('a', 3., 2)])
+        self.assertEqual(list(self.cat.REF), ['b', 'a'])
+        self.assertEqual(list(self.cat.NOBS), [1, 2])
+
+    def test_fill_from_arrays(self):
+        sources = sourceTable('frame')
+        for col in sources._refColumns():
+            setattr(sources, col, np.full(3, None, dtype=object))
+        sources.fill('SKYCAM', self.cat, np.array([0, 2]), np.array([1, 0]))
+        self.assertEqual(list(sources.SKYCAMCatREF), ['b', None, 'a'])
+        self.assertIsInstance(sources.SKYCAMCatRA[0], float)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,312 @@
+'''
+name:		test_pipeline.py
+author:		rmb
+
+description: 	Tests for the frame quality gates and cross-match checks in pipeline.py
+'''
+import os
+import types
+import shutil
+import logging
+import tempfile
+import unittest
+import threading
+
+import numpy as np
+import pyfits
+
+import ws
+import pipeline
+from errors import errors, deferredErrors
+from source import sourceTable
+from catalogue import SkycamCatalogue
+from ws_standin import standinServer
+
+PARAM_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'etc', 'sex', 'T.param')
+
+def make_catdata(n, **columns):
+    # a catalogue with the columns sExtractor outputs for T.param
+    with open(PARAM_FILE) as f:
+        names = [line.strip() for line in f if line.strip()]
+    catdata = np.zeros(n, dtype=[(name, 'f8') for name in names])
+    catdata['ELONGATION'] = 1.1
+    catdata['THETA_IMAGE'] = np.linspace(-90, 90, n)
+    catdata['FLUX_MAX'] = 1000.
+    for name, values in columns.items():
+        catdata[name] = values
+    return catdata
+
+class testCheckFrameQuality(unittest.TestCase):
+    def setUp(self):
+        self.pipe = types.InstanceType(pipeline.pipeline)
+        self.pipe.logger = logging.getLogger('test_pipeline')
+        self.pipe.params = {'minSources': 10, 'maxElongation': 5, 'maxExKurtosis': 10, 'maxCombExKurtosis': 2,
+                            'maxCombElongation': 1.5, 'maxSourcesCombCheck': 5, 'maxFlux': 50000}
+
+    def test_passes_catalogue_from_param_file(self):
+        verdict = self.pipe._checkFrameQuality(make_catdata(100))
+        self.assertTrue(verdict['passed'])
+        self.assertEqual(verdict['numFailingCombCheck'], 0)
+
+    def test_too_few_sources(self):
+        verdict = self.pipe._checkFrameQuality(make_catdata(5))
+        self.assertEqual(verdict['errorCode'], 4)
+
+    def test_combined_check_needs_peaked_angles(self):
+        elongation = np.where(np.arange(100) < 20, 3., 1.1)
+        verdict = self.pipe._checkFrameQuality(make_catdata(100, ELONGATION=elongation))
+        self.assertEqual(verdict['numFailingCombCheck'], 0)
+
+        theta = np.where(np.arange(100) < 95, 0., 90.)                  # nearly all objects at the same angle
+        self.pipe.params['maxExKurtosis'] = 100
+        verdict = self.pipe._checkFrameQuality(make_catdata(100, ELONGATION=elongation, THETA_IMAGE=theta))
+        self.assertEqual(verdict['numFailingCombCheck'], 20)
+        self.assertEqual(verdict['errorCode'], 7)
+
+    def test_combined_check_is_frame_level(self):
+        # the elongated objects are the few off the peak angle, so it's the frame's kurtosis that counts them
+        self.pipe.params['maxExKurtosis'] = 100
+        self.pipe.params['maxSourcesCombCheck'] = 4
+        theta = np.where(np.arange(100) < 95, 0., 90.)
+        elongation = np.where(theta == 90., 3., 1.1)
+        catdata = make_catdata(100, ELONGATION=elongation, THETA_IMAGE=theta)
+        verdict = self.pipe._checkFrameQuality(catdata)
+        self.assertEqual(verdict['numFailingCombCheck'], 5)
+        self.assertEqual(verdict['errorCode'], 7)
+
+        self.pipe.params['maxCombExKurtosis'] = verdict['exKurtosis']   # the frame's kurtosis must be above the limit
+        verdict = self.pipe._checkFrameQuality(catdata)
+        self.assertEqual(verdict['numFailingCombCheck'], 0)
+        self.assertTrue(verdict['passed'])
+
+    def test_max_flux(self):
+        verdict = self.pipe._checkFrameQuality(make_catdata(100, FLUX_MAX=60000.))
+        self.assertEqual(verdict['errorCode'], 8)
+
+class fakeCatalogue():
+    NAME = "APASS"
+
+class fakeSources():
+    def __init__(self, refs):
+        self.APASSCatREF = np.array(refs, dtype=object)
+
+    def isMatched(self, name):
+        return np.not_equal(getattr(self, name + 'CatREF'), None)
+
+class testCheckXMatches(unittest.TestCase):
+    def setUp(self):
+        self.pipe = types.InstanceType(pipeline.pipeline)
+        self.pipe.params = {'minNumMatchedSources': 3}
+        # sources 0-3 matched, 4 matched but cut on colour, 5 unmatched
+        self.sources = fakeSources(['a', 'b', 'c', 'd', None, None])
+        self.keep = np.array([True, True, True, True, False, True])
+
+    def test_counts_matches_before_colour_cut(self):
+        kept = np.array([False, False, True, True, True, True])
+        self.assertIsNone(self.pipe._checkXMatches(fakeCatalogue(), self.sources, kept, self.keep))
+
+    def test_ignores_sources_dropped_by_earlier_catalogues(self):
+        kept = np.array([False, False, False, True, True, True])
+        self.assertEqual(self.pipe._checkXMatches(fakeCatalogue(), self.sources, kept, self.keep), 12)
+
+    def test_no_matches_left(self):
+        kept = np.array([False, False, False, False, True, True])
+        self.assertEqual(self.pipe._checkXMatches(fakeCatalogue(), self.sources, kept, self.keep, checkNumMatchedSources=False), 16)
+
+class emptySkycamCatalogue(SkycamCatalogue):
+    '''
+    a Skycam catalogue that holds nothing in the database, so only rows overlaid from the batch are matched.
+    '''
+    def query(self, pw_file, pw_file_id, raDeg, decDeg, searchRadius, limitingMag, maxNumSourcesXMatch, appendToCat=True):
+        self._clear()
+        return True
+
+def make_sources(f, ra, dec):
+    sources = sourceTable(f)
+    for col in sourceTable.SEX_COLUMNS:
+        setattr(sources, col, np.ones(len(ra)))
+    sources.sExCatRA = np.array(ra)
+    sources.sExCatDEC = np.array(dec)
+    for col in sources._refColumns():
+        setattr(sources, col, np.full(len(ra), None, dtype=object))
+    return sources
+
+class testStoreBatch(unittest.TestCase):
+    def setUp(self):
+        logger = logging.getLogger('test_pipeline')
+        self.server = standinServer(('localhost', 0), None, None, logger)
+        threading.Thread(target=self.server.serve_forever).start()
+        self.tmp = tempfile.mkdtemp()
+        pw_file = os.path.join(self.tmp, 'pw')
+        with open(pw_file, 'w') as f:
+            f.write('skycam_cat_db localhost ' + str(self.server.server_address[1]) + ' user pw\n')
+
+        self.pipe = types.InstanceType(pipeline.pipeline)
+        self.pipe.logger = logger
+        self.pipe.err = errors(logger, True)
+        self.pipe.params = {'path_pw_list': pw_file, 'skycam_cat_db_credentials_id': 'skycam_cat_db', 
+                            'catalogue_credentials_id': 'skycam_cat_db', 'schemaName': 'skycamt', 'storeSources': True, 
+                            'limitingMag': 12, 'maxNumSourcesXMatch': 1000, 'fieldSize': 1., 'pointingDiffThresh': 0.1, 
+                            'slideCatalogueWindow': False, 'matchingTolerance': 5./3600, 'XMatchAssign': 'nearest', 
+                            'XMatchQueryJobs': 1}
+        self.pipe.SkycamCat = emptySkycamCatalogue(self.pipe.err, logger, 'skycamt')
+        self.pipe._imageValues = lambda f, ZPs, ZP_COEFFS: {'IMG_ID': int(f), 'DATE_OBS': '2016-01-0' + f + 'T01:23:45', 'MJD': 57388.+int(f)}
+        self.hdr = {'RA': '12:00:00', 'DEC': '+30:00:00'}
+        self.ZP_COEFFS = {'APASS': [0., 20.], 'USNOB': [0., 20.]}
+
+    def tearDown(self):
+        ws.get_session().close()                                        # drop kept-alive connections, or their handlers outlive the server
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self.tmp)
+
+    def test_images_only(self):
+        self.pipe.params['storeSources'] = False
+        batch = [(str(i), self.hdr, make_sources(str(i), [180.], [30.]), {}, self.ZP_COEFFS) for i in (1, 2)]
+        self.assertTrue(self.pipe._storeBatchToPostgresDatabase(batch))
+        tables = self.server.tables('skycamt')
+        self.assertEqual([image['IMG_ID'] for image in tables['images']], [1, 2])
+        self.assertEqual(tables['catalogue'], {})
+        self.assertEqual(tables['sources'], [])
+
+    def test_sources_reobserved_within_batch_are_accumulated(self):
+        batch = [('1', self.hdr, make_sources('1', [180., 180.1], [30., 30.]), {}, self.ZP_COEFFS), 
+                 ('2', self.hdr, make_sources('2', [180., 180.2], [30., 30.]), {}, self.ZP_COEFFS)]
+        self.assertTrue(self.pipe._storeBatchToPostgresDatabase(batch))
+        tables = self.server.tables('skycamt')
+        self.assertEqual(len(tables['images']), 2)
+        self.assertEqual(sorted([row['nobs'] for row in tables['catalogue'].values()]), [1, 1, 2])
+        refs = [row['skycamref'] for row in tables['sources']]
+        self.assertEqual(len(refs), 4)
+        self.assertEqual(refs[0], refs[2])                              # the same object in both frames
+        self.assertEqual(len(set(refs)), 3)
+
+    def test_frame_skipped_if_catalogue_query_fails(self):
+        self.pipe.SkycamCat.query = lambda *args, **kwargs: False
+        batch = [('1', self.hdr, make_sources('1', [180.], [30.]), {}, self.ZP_COEFFS)]
+        self.assertFalse(self.pipe._storeBatchToPostgresDatabase(batch))
+        self.assertEqual(self.server.tables('skycamt')['images'], [])
+
+class fakePool():
+    def __init__(self):
+        self.submitted = []
+
+    def apply_async(self, func, args):
+        self.submitted.append(args[0])
+        return args[0]
+
+class testOpenAhead(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.pipe = types.InstanceType(pipeline.pipeline)
+        self.pipe.logger = logging.getLogger('test_pipeline')
+        self.pipe.params = {'pointingDiffThresh': 1.}
+        self.pipe.sExPool = fakePool()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def make_image(self, name, ra, dec, wcs=True):
+        hdu = pyfits.PrimaryHDU(np.zeros((2, 2)))
+        for key in pipeline.pipeline.VALID_WCS_KEYS:
+            if wcs or key != 'ROTSKYPA':
+                hdu.header[key] = 0.
+        hdu.header['RA_CENT'] = ra
+        hdu.header['DEC_CENT'] = dec
+        path = os.path.join(self.tmp, name)
+        hdu.writeto(path)
+        return path
+
+    def test_rejected_frames_not_submitted(self):
+        images = [self.make_image('a.fits', 10., 20.), self.make_image('b.fits', 10., 20., wcs=False), 
+                  self.make_image('c.fits', 10.5, 20.), self.make_image('d.fits', 30., 20.), self.make_image('e.fits', 30., 20.)]
+        pointing = []
+        for f in images:
+            im, err, extraction, pointing = self.pipe._openAhead(f, pointing)
+            im.closeFITSFile()
+        self.assertEqual(self.pipe.sExPool.submitted, [images[0], images[2], images[4]])
+
+    def test_open_errors_deferred(self):
+        im, err, extraction, pointing = self.pipe._openAhead(os.path.join(self.tmp, 'missing.fits'), [10., 20.])
+        self.assertIsNone(extraction)
+        self.assertEqual(pointing, [10., 20.])
+        self.assertEqual(err.errorCodes, [-1])
+        self.assertRaises(RuntimeError, err.replay, errors(self.pipe.logger, True))
+
+class testRunSExtractor(unittest.TestCase):
+    def test_errors_returned_to_caller(self):
+        pipe = types.InstanceType(pipeline.pipeline)
+        pipe.logger = logging.getLogger('test_pipeline')
+        pipe.params = {'resPath': '', 'sExConfFile': '/nonexistent/default.sex', 'CCDSizeX': 0, 'CCDSizeY': 0, 'fieldMargin': 0, 
+                       'scratchPath': None, 'streamSExCat': False}
+        pipe.sExCache = None
+        sExCat, catdata, err, e = pipe._runSExtractor('image.fits')
+        self.assertIsNone(sExCat)
+        self.assertIsNone(e)
+        self.assertEqual(err.errorCodes, [-6])
+
+class failingCatalogue():
+    NAME = "APASS"
+
+    def __init__(self, err, errorCodes):
+        self.err = err
+        self.errorCodes = errorCodes
+
+    def query(self, *args):
+        for errorCode in self.errorCodes:
+            self.err.setError(errorCode)
+            self.err.handleError()
+        return True
+
+class testFetchCatalogue(unittest.TestCase):
+    def setUp(self):
+        self.pipe = types.InstanceType(pipeline.pipeline)
+        self.pipe.logger = logging.getLogger('test_pipeline')
+        self.pipe.err = errors(self.pipe.logger, True)
+        self.pipe.params = {'limitingMag': 12, 'maxNumSourcesXMatch': 1000, 'fieldSize': 1., 'pointingDiffThresh': 0.1, 
+                            'slideCatalogueWindow': False, 'path_pw_list': None, 'catalogue_credentials_id': None}
+        self.im = types.InstanceType(pipeline.FITSFile)
+        self.im.headers = {'RA': '12:00:00', 'DEC': '+30:00:00'}
+
+    def test_errors_returned_to_caller(self):
+        self.pipe.RefCatAll = {'APASS': failingCatalogue(self.pipe.err, [21, -17, 15])}
+        err, e = self.pipe._fetchCatalogue(self.im, 'APASS')
+        self.assertIsNone(e)
+        self.assertEqual(err.errorCodes, [21, -17])                     # the query is unwound at the critical error
+        self.assertIs(self.pipe.RefCatAll['APASS'].err, self.pipe.err)
+        self.assertEqual(self.pipe.err.getError(), 0)
+
+class fakeUSNOBCatalogue():
+    NAME = "USNOB"
+
+    def __init__(self, ra, dec):
+        self.RA = np.array(ra)
+        self.DEC = np.array(dec)
+        self.REF = np.array(['ref' + str(i) for i in range(len(ra))], dtype=object)
+        for attr in ('RAERR', 'DECERR', 'R1MAG', 'B1MAG', 'R2MAG', 'B2MAG'):
+            setattr(self, attr, np.zeros(len(ra)))
+
+    def getTree(self):
+        return None
+
+class testXMatchAgainstAllSources(unittest.TestCase):
+    def setUp(self):
+        self.pipe = types.InstanceType(pipeline.pipeline)
+        self.pipe.logger = logging.getLogger('test_pipeline')
+        self.pipe.params = {'matchingTolerance': 2./3600, 'XMatchAssign': 'nearest', 'XMatchQueryJobs': 1}
+        self.cat = fakeUSNOBCatalogue([0.6/3600], [0.])
+        # both sources are within tolerance of the one reference object, the second is nearer
+        self.sources = make_sources('frame', [0., 0.5/3600], [0., 0.])
+
+    def test_dropped_source_can_take_match(self):
+        # as in run(), where the second source has been dropped by an earlier catalogue
+        self.pipe._XMatchSourcesInPlace(None, False, self.cat, self.sources, checkColourIndex=False)
+        self.assertFalse(self.sources.isMatched('USNOB')[0])
+
+    def test_matched_in_turn(self):
+        kept = self.sources.select(np.array([True, False]))
+        self.pipe._XMatchSourcesInPlace(None, False, self.cat, kept, checkColourIndex=False)
+        self.assertTrue(kept.isMatched('USNOB')[0])
+
+if __name__ == "__main__":
+    unittest.main()
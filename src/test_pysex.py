@@ -0,0 +1,72 @@
+'''
+name:		test_pysex.py
+author:		rmb
+
+description: 	Tests for the sExtractor wrapper in pysex.py
+'''
+import os
+import shutil
+import logging
+import tempfile
+import unittest
+from StringIO import StringIO
+
+import numpy as np
+
+from pysex import pysex, read_cat_stream
+
+class testCatalogType(unittest.TestCase):
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.params = os.path.join(self.path, 'T.param')
+        open(self.params, 'w').close()
+
+    def tearDown(self):
+        shutil.rmtree(self.path, True)
+
+    def make_pysex(self, catalog_type, stream):
+        conf = os.path.join(self.path, 'T.sex')
+        with open(conf, 'w') as f:
+            f.write('PARAMETERS_NAME ' + self.params + '\n')
+            if catalog_type is not None:
+                f.write('CATALOG_TYPE ' + catalog_type + '\n')
+        return pysex('frame.fits', self.path, conf, None, logging.getLogger('test_pysex'), stream=stream)
+
+    def test_configured_type(self):
+        self.assertEqual(self.make_pysex('FITS_LDAC', False).get_catalog_type(), 'FITS_LDAC')
+        self.assertEqual(self.make_pysex(None, False).get_catalog_type(), 'ASCII_HEAD')
+
+    def test_stream_keeps_configured_type(self):
+        sEx = self.make_pysex('FITS_1.0', True)
+        sEx._setup()
+        cmd = sEx._get_cmd()
+        self.assertEqual(cmd[cmd.index('-CATALOG_TYPE') + 1], 'ASCII_HEAD')
+        self.assertEqual(sEx.catalog_type, 'FITS_1.0')                 # the hard copy is still written as configured
+        self.assertEqual(sEx.get_catalog_type(), 'FITS_1.0')
+
+HEADER = """#   1 NUMBER                 Running object number
+#   2 X_IMAGE                Object position along x                                    [pixel]
+#   3 FLUX_APER              Flux vector within fixed circular aperture(s)              [count]
+#   6 FLAGS                  Extraction flags
+"""
+
+def make_stream(nrows):
+    rows = ['%d %.3f %.1f %.1f %.1f %d' % (i + 1, i*0.5, i, 2*i, 3*i, i % 4) for i in range(nrows)]
+    return StringIO(HEADER + ''.join([row + '\n' for row in rows]))
+
+class testReadCatStream(unittest.TestCase):
+    def test_rows_across_chunks(self):
+        for nrows in (0, 1, 7, 8, 9, 50):
+            catdata = read_cat_stream(make_stream(nrows), chunk_rows=8)
+            self.assertEqual(len(catdata), nrows)
+            self.assertEqual(catdata.dtype.names, ('NUMBER', 'X_IMAGE', 'FLUX_APER', 'FLUX_APER_2', 'FLUX_APER_3', 'FLAGS'))
+            np.testing.assert_array_equal(catdata['NUMBER'], np.arange(1, nrows + 1))
+            np.testing.assert_array_equal(catdata['X_IMAGE'], np.arange(nrows)*0.5)
+            np.testing.assert_array_equal(catdata['FLUX_APER_3'], 3.*np.arange(nrows))
+            self.assertTrue(np.issubdtype(catdata['FLAGS'].dtype, np.integer))
+
+    def test_empty_stream(self):
+        self.assertIsNone(read_cat_stream(StringIO('')))
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,60 @@
+'''
+name:		test_pyspherematch.py
+author:		rmb
+
+description: 	Tests for the cross-matching in pyspherematch.py
+'''
+import logging
+import unittest
+
+import numpy as np
+
+import pyspherematch as pysm
+
+def brute_force_greedy(ra1, dec1, ra2, dec2, tol):
+    # accept pairs one at a time in order of increasing distance
+    ds = pysm._great_circle_distance(ra1[:, None], dec1[:, None], ra2[None, :], dec2[None, :])
+    idxs1, idxs2 = np.nonzero(ds < tol)
+    order = np.lexsort((idxs2, idxs1, ds[idxs1, idxs2]))
+    used1, used2, matches = set(), set(), []
+    for i, j in zip(idxs1[order], idxs2[order]):
+        if i not in used1 and j not in used2:
+            used1.add(i)
+            used2.add(j)
+            matches.append((i, j))
+    return sorted(matches)
+
+class testSpherematch(unittest.TestCase):
+    def setUp(self):
+        self.logger = logging.getLogger('test_pyspherematch')
+        rng = np.random.RandomState(0)
+        self.ra1, self.dec1 = rng.uniform(10, 10.5, 300), rng.uniform(20, 20.5, 300)
+        self.ra2 = np.concatenate([self.ra1 + rng.normal(0, 0.002, 300), rng.uniform(10, 10.5, 100)])
+        self.dec2 = np.concatenate([self.dec1 + rng.normal(0, 0.002, 300), rng.uniform(20, 20.5, 100)])
+        self.tol = 0.01
+
+    def test_greedy_matches_brute_force(self):
+        idxs1, idxs2, ds = pysm.spherematch(self.ra1, self.dec1, self.ra2, self.dec2, self.logger, tol=self.tol, assign='greedy')
+        self.assertEqual(sorted(zip(idxs1.tolist(), idxs2.tolist())), brute_force_greedy(self.ra1, self.dec1, self.ra2, self.dec2, self.tol))
+        self.assertTrue((ds < self.tol).all())
+        self.assertTrue((np.diff(idxs1) > 0).all())
+
+    def test_greedy_is_one_to_one(self):
+        idxs1, idxs2, ds = pysm.spherematch(self.ra1, self.dec1, self.ra2, self.dec2, self.logger, tol=self.tol, assign='greedy')
+        self.assertEqual(len(set(idxs2.tolist())), len(idxs2))
+
+    def test_greedy_rematches_displaced_object(self):
+        # 0 and 1 both have reference 0 nearest, 1 loses it and takes reference 1 instead
+        ra1, dec1 = np.array([10., 10.003]), np.array([20., 20.])
+        ra2, dec2 = np.array([10.001, 10.008]), np.array([20., 20.])
+        nearest = pysm.spherematch(ra1, dec1, ra2, dec2, self.logger, tol=self.tol)
+        greedy = pysm.spherematch(ra1, dec1, ra2, dec2, self.logger, tol=self.tol, assign='greedy')
+        self.assertEqual(nearest[0].tolist(), [0])
+        self.assertEqual(greedy[0].tolist(), [0, 1])
+        self.assertEqual(greedy[1].tolist(), [0, 1])
+
+    def test_greedy_requires_tolerance(self):
+        self.assertRaises(ValueError, pysm.spherematch, self.ra1, self.dec1, self.ra2, self.dec2, self.logger, assign='greedy')
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,123 @@
+'''
+name:		test_scs.py
+author:		rmb
+
+description: 	Tests for the SCS response decoders in scs.py
+'''
+import json
+import logging
+import unittest
+from io import BytesIO
+
+import numpy as np
+
+from scs import decodeSCS, decodeSCSBinary, decodeSCSStream, decodeSCSBinaryStream, growableTable
+from tiles import COLUMNS
+
+COLUMNS_USNOB = COLUMNS['USNOB']
+
+def make_rows(n):
+    return [{'usnobref': 'ref' + str(i), 'ra': 10 + i*0.001, 'dec': -5 + i*0.002, 'raerrasec': 0.1, 'decerrasec': 0.2, 
+             'rmag1': 12 + i*0.01, 'bmag1': 13., 'rmag2': 12.5, 'bmag2': 13.5} for i in range(n)]
+
+def make_npy(rows, extra_column=False):
+    dtype = [(col, 'S16' if dtype.startswith('S') else '>f4') for col, dtype in COLUMNS_USNOB]
+    if extra_column:
+        dtype = dtype + [('distance', 'f8')]
+    data = np.zeros(len(rows), dtype=dtype)
+    for i, row in enumerate(rows):
+        for col, coldtype in COLUMNS_USNOB:
+            data[col][i] = row[col]
+    buf = BytesIO()
+    np.save(buf, data)
+    return buf.getvalue()
+
+class shortReads():
+    '''
+    a file-like response that returns at most [n] bytes per read.
+    '''
+    def __init__(self, content, n):
+        self.buf = BytesIO(content)
+        self.n = n
+
+    def read(self, nbytes):
+        return self.buf.read(min(nbytes, self.n))
+
+class testDecodeSCS(unittest.TestCase):
+    def test_json(self):
+        rows = make_rows(5)
+        rows[2]['rmag1'] = None                     # missing values are skipped
+        rows[3]['bmag1'] = 'NaN?'
+        decoded = decodeSCS(json.dumps(rows), COLUMNS_USNOB)
+        self.assertEqual(decoded.dtype, np.dtype(COLUMNS_USNOB))
+        self.assertEqual(decoded['usnobref'].tolist(), ['ref0', 'ref1', 'ref4'])
+        np.testing.assert_allclose(decoded['rmag1'], [12., 12.01, 12.04])
+
+    def test_json_empty(self):
+        self.assertEqual(len(decodeSCS('[]', COLUMNS_USNOB)), 0)
+
+    def test_binary_matches_json(self):
+        rows = make_rows(20)
+        decoded = decodeSCSBinary(make_npy(rows, extra_column=True), COLUMNS_USNOB)
+        expected = decodeSCS(json.dumps(rows), COLUMNS_USNOB)
+        self.assertEqual(decoded.dtype, expected.dtype)
+        self.assertEqual(decoded['usnobref'].tolist(), expected['usnobref'].tolist())
+        for col in ('ra', 'dec', 'rmag1', 'bmag2'):
+            np.testing.assert_allclose(decoded[col], expected[col], rtol=1e-6)
+
+class testDecodeSCSStream(unittest.TestCase):
+    def setUp(self):
+        self.logger = logging.getLogger('test_scs')
+        self.rows = make_rows(50)
+        self.expected = decodeSCS(json.dumps(self.rows), COLUMNS_USNOB)
+
+    def test_json_stream_matches_json(self):
+        text = json.dumps(self.rows, indent=1)
+        for size in (1, 7, 64, len(text)):
+            chunks = [text[i:i+size] for i in range(0, len(text), size)]
+            decoded, truncated = decodeSCSStream(iter(chunks), COLUMNS_USNOB, 1<<20, self.logger)
+            np.testing.assert_array_equal(decoded, self.expected)
+            self.assertFalse(truncated)
+
+    def test_json_stream_is_capped(self):
+        max_bytes = 10*np.dtype(COLUMNS_USNOB).itemsize
+        decoded, truncated = decodeSCSStream(iter([json.dumps(self.rows)]), COLUMNS_USNOB, max_bytes, self.logger)
+        np.testing.assert_array_equal(decoded, self.expected[:10])
+        self.assertTrue(truncated)
+
+    def test_binary_stream_matches_binary(self):
+        content = make_npy(self.rows)
+        for chunk_rows in (1, 7, 1000):
+            decoded, truncated = decodeSCSBinaryStream(shortReads(content, 100), COLUMNS_USNOB, 1<<20, self.logger, chunk_rows=chunk_rows)
+            np.testing.assert_array_equal(decoded, decodeSCSBinary(content, COLUMNS_USNOB))
+            self.assertFalse(truncated)
+
+    def test_binary_stream_is_capped(self):
+        max_bytes = 10*np.dtype(COLUMNS_USNOB).itemsize
+        decoded, truncated = decodeSCSBinaryStream(BytesIO(make_npy(self.rows)), COLUMNS_USNOB, max_bytes, self.logger, chunk_rows=3)
+        self.assertEqual(decoded['usnobref'].tolist(), self.expected['usnobref'][:10].tolist())
+        self.assertTrue(truncated)
+
+    def test_json_stream_cut_off(self):
+        text = json.dumps(self.rows)
+        for end in (len(text) - 1, len(text) - 30, text.index('}') + 2):
+            self.assertIsNone(decodeSCSStream(iter([text[:end]]), COLUMNS_USNOB, 1<<20, self.logger)[0])
+
+    def test_json_stream_empty(self):
+        self.assertEqual(len(decodeSCSStream(iter(['[', ']']), COLUMNS_USNOB, 1<<20, self.logger)[0]), 0)
+
+    def test_binary_stream_cut_off(self):
+        content = make_npy(self.rows)
+        self.assertIsNone(decodeSCSBinaryStream(BytesIO(content[:-5]), COLUMNS_USNOB, 1<<20, self.logger, chunk_rows=7)[0])
+
+class testGrowableTable(unittest.TestCase):
+    def test_grows_to_ceiling(self):
+        table = growableTable([('x', 'f8')], 100*8, capacity=4)
+        for i in range(100):
+            self.assertTrue(table.append((i,)))
+        self.assertFalse(table.append((100,)))
+        self.assertEqual(len(table), 100)
+        np.testing.assert_array_equal(table.array()['x'], np.arange(100))
+
+if __name__ == "__main__":
+    unittest.main()
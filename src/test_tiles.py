@@ -0,0 +1,92 @@
+'''
+name:		test_tiles.py
+author:		rmb
+
+description: 	Tests for the HEALPix tiled reference catalogue store in tiles.py
+'''
+import os
+import csv
+import shutil
+import logging
+import tempfile
+import unittest
+
+import numpy as np
+
+import tiles
+from tiles import ang2pix_nest, tileStore, COLUMNS
+from pyspherematch import _great_circle_distance as gcd
+
+def random_sphere(n, seed=0):
+    rng = np.random.RandomState(seed)
+    return rng.uniform(0, 360, n), np.degrees(np.arcsin(rng.uniform(-1, 1, n)))
+
+class testAng2PixNest(unittest.TestCase):
+    def test_base_faces(self):
+        self.assertEqual(ang2pix_nest(1, [45., 135., 225., 315.], [60.]*4).tolist(), [0, 1, 2, 3])
+        self.assertEqual(ang2pix_nest(1, [0., 90., 180., 270.], [0.]*4).tolist(), [4, 5, 6, 7])
+        self.assertEqual(ang2pix_nest(1, [45., 135., 225., 315.], [-60.]*4).tolist(), [8, 9, 10, 11])
+
+    def test_nested_hierarchy(self):
+        ra, dec = random_sphere(10000)
+        for nside in (1, 2, 4, 8, 16):
+            self.assertTrue((ang2pix_nest(2*nside, ra, dec) // 4 == ang2pix_nest(nside, ra, dec)).all())
+
+    def test_equal_area(self):
+        ra, dec = random_sphere(200000)
+        counts = np.bincount(ang2pix_nest(4, ra, dec), minlength=12*4*4)
+        self.assertEqual(len(counts), 12*4*4)
+        self.assertLess(np.abs(counts/float(counts.mean()) - 1).max(), 0.2)
+
+class testTileStore(unittest.TestCase):
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.logger = logging.getLogger('test_tiles')
+
+        # a patch of sky with a few unparsable rows, split over two dumps
+        rng = np.random.RandomState(0)
+        n = 5000
+        self.ra = rng.uniform(350, 370, n) % 360
+        self.dec = rng.uniform(-10, 10, n)
+        self.rmag = rng.uniform(8, 16, n)
+        names = [col for col, dtype in COLUMNS['APASS']]
+        dumps = []
+        for part in range(2):
+            dump = os.path.join(self.path, 'apass_' + str(part) + '.csv')
+            with open(dump, 'wb') as f:
+                writer = csv.DictWriter(f, names)
+                writer.writeheader()
+                for i in range(part, n, 2):
+                    row = dict([(col, 0) for col in names])
+                    row.update({'apassref': 'ref' + str(i), 'ra': repr(self.ra[i]), 'dec': repr(self.dec[i]), 'rmag': repr(self.rmag[i])})
+                    writer.writerow(row)
+                writer.writerow(dict([(col, 'NULL') for col in names]))
+            dumps.append(dump)
+        tiles.build(self.path, 'apass', 16, dumps, self.logger, chunk_size=1000)
+        self.store = tileStore(self.path, 'APASS', None, self.logger)
+
+    def tearDown(self):
+        shutil.rmtree(self.path, True)
+
+    def brute_force(self, ra, dec, sr, lo, hi, max_sources):
+        dist = gcd(ra, dec, self.ra, self.dec)
+        keep = np.flatnonzero((dist <= sr) & (self.rmag >= lo) & (self.rmag <= hi))
+        return ['ref' + str(i) for i in keep[np.argsort(dist[keep], kind='mergesort')]][:max_sources]
+
+    def test_cone_matches_brute_force(self):
+        for ra, dec, sr in ((0., 0., 3.), (355., 5., 2.), (359.5, -9., 4.)):
+            res = self.store.cone(ra, dec, sr, 'rmag', -1, 100, 1e6)
+            self.assertEqual(res['apassref'].tolist(), self.brute_force(ra, dec, sr, -1, 100, 10**6))
+
+    def test_cone_limits_magnitude_and_count(self):
+        res = self.store.cone(0., 0., 5., 'rmag', 10, 12, 50)
+        self.assertEqual(res['apassref'].tolist(), self.brute_force(0., 0., 5., 10, 12, 50))
+        self.assertEqual(len(res['apassref']), 50)
+
+    def test_cone_outside_catalogue(self):
+        res = self.store.cone(180., 0., 1., 'rmag', -1, 100, 1e6)
+        self.assertEqual(len(res['apassref']), 0)
+        self.assertEqual(sorted(res.keys()), sorted([col for col, dtype in COLUMNS['APASS']]))
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,63 @@
+'''
+name:		test_util.py
+author:		rmb
+
+description: 	Tests for the utility functions in util.py
+'''
+import unittest
+
+import numpy as np
+
+import util
+import pyspherematch as pysm
+from util import find_delta_cones, _destination
+
+def random_points_in_cone(ra, dec, radius, n, seed=0):
+    rng = np.random.RandomState(seed)
+    dist = np.radians(radius)*np.sqrt(rng.uniform(0, 1, n))
+    pts_ra, pts_dec = _destination(np.radians(ra), np.radians(dec), dist, rng.uniform(-np.pi, np.pi, n))
+    return np.degrees(pts_ra) % 360, np.degrees(pts_dec)
+
+class testFindDeltaCones(unittest.TestCase):
+    def assertCovers(self, lastPointing, pointing, radius):
+        cones = find_delta_cones(lastPointing, pointing, radius)
+        self.assertIsNotNone(cones)
+        ra, dec = random_points_in_cone(pointing[0], pointing[1], radius, 5000)
+        exposed = pysm._great_circle_distance(lastPointing[0], lastPointing[1], ra, dec) > radius
+        covered = np.zeros(len(ra), dtype=bool)
+        for cra, cdec, sr in cones:
+            covered |= pysm._great_circle_distance(cra, cdec, ra, dec) <= sr
+        self.assertTrue(exposed.any())
+        self.assertTrue(covered[exposed].all())
+
+    def test_unmoved_pointing_needs_no_cones(self):
+        self.assertEqual(find_delta_cones((10., 20.), (10., 20.), 5.), [])
+
+    def test_unresolved_move_needs_no_cones(self):
+        # a move so small that no point on the new cone's edge comes out as lying outside the old cone
+        great_circle_distance = pysm._great_circle_distance
+        def edge_inside(ra1, dec1, ra2, dec2):
+            dist = great_circle_distance(ra1, dec1, ra2, dec2)
+            if np.ndim(dist):
+                return np.minimum(dist, 5.)
+            return dist
+        util.pysm._great_circle_distance = edge_inside
+        try:
+            self.assertEqual(find_delta_cones((10., 20.), (10., 20. + 1e-9), 5.), [])
+        finally:
+            util.pysm._great_circle_distance = great_circle_distance
+
+    def test_distant_pointing_is_requeried(self):
+        self.assertIsNone(find_delta_cones((10., 20.), (20., 20.), 5.))
+
+    def test_covers_exposed_region(self):
+        self.assertCovers((10., 20.), (10.2, 20.1), 5.)
+
+    def test_covers_exposed_region_near_pole(self):
+        self.assertCovers((100., 88.), (105., 88.05), 3.)
+
+    def test_covers_exposed_region_across_ra_zero(self):
+        self.assertCovers((359.9, -10.), (0.1, -10.), 4.)
+
+if __name__ == "__main__":
+    unittest.main()
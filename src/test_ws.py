@@ -0,0 +1,145 @@
+'''
+name:		test_ws.py
+author:		rmb
+
+description: 	Tests for the webservice wrappers in ws.py
+'''
+import time
+import logging
+import unittest
+
+from requests.exceptions import ConnectionError, ConnectTimeout, ReadTimeout
+from requests.packages.urllib3.exceptions import MaxRetryError, NewConnectionError, ProtocolError
+
+import ws
+
+class fakeResponse():
+    def __init__(self, status_code=200):
+        self.status_code = status_code
+
+    def close(self):
+        pass
+
+def refused():
+    # what requests raises when a new connection can't be made
+    return ConnectionError(MaxRetryError(None, '/', NewConnectionError(None, 'Connection refused')))
+
+class fakeSession():
+    '''
+    answers each call with the next of [outcomes], an exception to raise or a response to return.
+    '''
+    def __init__(self, outcomes, delay=0):
+        self.outcomes = list(outcomes)
+        self.delay = delay
+        self.calls = 0
+
+    def _call(self, url, **kwargs):
+        self.calls = self.calls + 1
+        outcome = self.outcomes.pop(0)
+        time.sleep(self.delay)
+        if isinstance(outcome, Exception):
+            raise outcome
+        return outcome
+
+    get = post = put = _call
+
+class testRequest(unittest.TestCase):
+    def setUp(self):
+        self.ws = ws.ws_catalogue('localhost', 0, None, logging.getLogger('test_ws'), max_retries=3, retry_delay=0)
+        self.ws.breaker = ws.circuitBreaker()
+
+    def test_get_retries_read_timeout(self):
+        self.ws.session = fakeSession([ReadTimeout(), fakeResponse()])
+        self.assertIsNotNone(self.ws._request('test', 'get', '/'))
+        self.assertEqual(self.ws.session.calls, 2)
+
+    def test_post_not_retried_after_read_timeout(self):
+        self.ws.session = fakeSession([ReadTimeout(), fakeResponse()])
+        self.assertIsNone(self.ws._request('test', 'post', '/'))
+        self.assertEqual(self.ws.session.calls, 1)
+
+    def test_post_retries_refused_connection(self):
+        self.ws.session = fakeSession([refused(), ConnectTimeout(), fakeResponse()])
+        self.assertIsNotNone(self.ws._request('test', 'post', '/'))
+        self.assertEqual(self.ws.session.calls, 3)
+
+    def test_post_not_retried_after_connection_aborted(self):
+        self.ws.session = fakeSession([ConnectionError(ProtocolError('Connection aborted.')), fakeResponse()])
+        self.assertIsNone(self.ws._request('test', 'post', '/'))
+        self.assertEqual(self.ws.session.calls, 1)
+
+    def test_get_retries_server_error(self):
+        self.ws.session = fakeSession([fakeResponse(503), fakeResponse()])
+        self.assertEqual(self.ws._request('test', 'get', '/').status_code, 200)
+        self.assertEqual(self.ws.session.calls, 2)
+
+    def test_post_not_retried_after_server_error(self):
+        self.ws.session = fakeSession([fakeResponse(500), fakeResponse()])
+        self.assertEqual(self.ws._request('test', 'post', '/').status_code, 500)
+        self.assertEqual(self.ws.breaker.failures, 1)
+
+    def test_idempotent_post_retries_read_timeout(self):
+        self.ws.session = fakeSession([ReadTimeout(), fakeResponse()])
+        self.assertIsNotNone(self.ws._request('test', 'post', '/', idempotent=True))
+
+class testCircuitBreaker(unittest.TestCase):
+    def setUp(self):
+        self.ws = ws.ws_catalogue('localhost', 0, None, logging.getLogger('test_ws'), max_retries=1, retry_delay=0)
+        self.ws.breaker = ws.circuitBreaker()
+        self.ws.breaker.open_until = time.time() - 1                   # cooled down, the next request is a trial
+
+    def test_trial_cleared_after_unexpected_error(self):
+        self.ws.session = fakeSession([ValueError(), fakeResponse()])
+        self.assertRaises(ValueError, self.ws._request, 'test', 'get', '/')
+        self.assertIsNotNone(self.ws._request('test', 'get', '/'))
+        self.assertIsNone(self.ws.breaker.open_until)
+
+    def test_server_errors_open_breaker(self):
+        self.ws.session = fakeSession([fakeResponse(502)])
+        self.ws._request('test', 'get', '/')
+        self.assertFalse(self.ws.breaker.allow())
+
+class testHedged(unittest.TestCase):
+    def setUp(self):
+        self.ws = ws.ws_catalogue('localhost', 0, None, logging.getLogger('test_ws'))
+        self.latencies = ws._latencies
+        ws._latencies = ws.latencyTracker()
+        for i in range(ws._latencies.min_samples):
+            ws._latencies.record('test', 0.01)
+
+    def tearDown(self):
+        ws._latencies = self.latencies
+
+    def test_unexpected_errors_are_raised(self):
+        self.ws.session = fakeSession([ValueError(), ValueError()], delay=0.05)
+        self.assertRaises(ValueError, self.ws._hedged, 'test', 'get', '/')
+
+    def test_hedge_answers_when_first_fails(self):
+        self.ws.session = fakeSession([ReadTimeout(), fakeResponse()], delay=0.05)
+        self.assertIsInstance(self.ws._hedged('test', 'get', '/'), fakeResponse)
+        self.assertEqual(self.ws.session.calls, 2)
+
+class testPayloads(unittest.TestCase):
+    rows = [{'ra': 1.5, 'dec': -2., 'mag': 10.}, {'ra': 3., 'dec': 4.5, 'mag': None}]
+
+    def test_columns_round_trip(self):
+        columns = ws.to_columns(self.rows)
+        self.assertEqual(columns['ra'], [1.5, 3.])
+        self.assertEqual(ws.to_rows(columns), self.rows)
+
+    def test_missing_fields_are_none(self):
+        self.assertEqual(ws.to_columns([{'ra': 1.}, {'dec': 2.}]), {'ra': [1., None], 'dec': [None, 2.]})
+
+    def test_rows_pass_through(self):
+        self.assertEqual(ws.to_rows(self.rows), self.rows)
+
+    def test_body_round_trip(self):
+        for compression in ('none', 'gzip', 'deflate'):
+            body, headers = ws.encode_body(self.rows, compression)
+            self.assertEqual(ws.decode_body(body, headers.get('Content-Encoding')), self.rows)
+
+    def test_invalid_compression(self):
+        self.assertRaises(ValueError, ws.configure_payloads, False, 'bzip2')
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,206 @@
+#!/bin/python
+'''
+name:		tiles.py
+author:		rmb
+
+description: 	A local, HEALPix tiled store of reference catalogues.
+
+                each catalogue lives in its own directory with one subdirectory per (nested) HEALPix
+                pixel, holding one raw binary file per column. an index of pixels, with the centre and
+                radius of the objects in each, is used to find the tiles covering a cone, which are then
+                read with memory maps.
+
+                run as a script to build a catalogue's tiles from CSV dump files, e.g.
+                python tiles.py --c APASS --o /mnt/NAS/devel/skycam/tiles apass_*.csv
+'''
+import os
+import shutil
+import csv
+import json
+import optparse
+
+import numpy as np
+
+from pyspherematch import _great_circle_distance as gcd
+
+# columns stored for each catalogue, named as in the web service SCS output
+COLUMNS = {'APASS' : [('apassref', 'S32'), ('ra', 'f8'), ('dec', 'f8'), ('raerrasec', 'f8'), ('decerrasec', 'f8'), ('vmag', 'f8'),
+                      ('bmag', 'f8'), ('gmag', 'f8'), ('rmag', 'f8'), ('imag', 'f8'), ('verr', 'f8'), ('berr', 'f8'), ('gerr', 'f8'),
+                      ('rerr', 'f8'), ('ierr', 'f8'), ('nobs', 'i4')],
+           'USNOB' : [('usnobref', 'S32'), ('ra', 'f8'), ('dec', 'f8'), ('raerrasec', 'f8'), ('decerrasec', 'f8'), ('rmag1', 'f8'),
+                      ('bmag1', 'f8'), ('rmag2', 'f8'), ('bmag2', 'f8')]}
+
+def ang2pix_nest(nside, ra, dec):
+    '''
+    returns the nested HEALPix pixel for each position (deg). [nside] must be a power of 2.
+    '''
+    ra = np.asarray(ra, dtype=float)
+    dec = np.asarray(dec, dtype=float)
+    z = np.sin(np.radians(dec))
+    za = np.abs(z)
+    tt = np.mod(np.radians(ra), 2*np.pi) / (np.pi/2)           # in [0, 4)
+
+    face = np.empty(ra.shape, dtype=np.int64)
+    ix = np.empty(ra.shape, dtype=np.int64)
+    iy = np.empty(ra.shape, dtype=np.int64)
+
+    # equatorial region
+    eq = za <= 2./3
+    t1 = nside*(0.5 + tt[eq])
+    t2 = nside*z[eq]*0.75
+    jp = (t1 - t2).astype(np.int64)
+    jm = (t1 + t2).astype(np.int64)
+    ifp = jp // nside
+    ifm = jm // nside
+    face[eq] = np.where(ifp == ifm, ifp | 4, np.where(ifp < ifm, ifp, ifm + 8))
+    ix[eq] = jm & (nside - 1)
+    iy[eq] = nside - (jp & (nside - 1)) - 1
+
+    # polar caps
+    pol = ~eq
+    ntt = np.minimum(tt[pol].astype(np.int64), 3)
+    tp = tt[pol] - ntt
+    tmp = nside*np.sqrt(3*(1 - za[pol]))
+    jp = np.minimum((tp*tmp).astype(np.int64), nside - 1)
+    jm = np.minimum(((1 - tp)*tmp).astype(np.int64), nside - 1)
+    north = z[pol] >= 0
+    face[pol] = np.where(north, ntt, ntt + 8)
+    ix[pol] = np.where(north, nside - jm - 1, jp)
+    iy[pol] = np.where(north, nside - jp - 1, jm)
+
+    # interleave the bits of ix (even) and iy (odd) for the index within the face
+    ipf = np.zeros(ra.shape, dtype=np.int64)
+    for bit in range(int(np.log2(nside))):
+        ipf |= ((ix >> bit) & 1) << (2*bit)
+        ipf |= ((iy >> bit) & 1) << (2*bit + 1)
+
+    return face*nside*nside + ipf
+
+class tileStore():
+    def __init__(self, path, name, err, logger):
+        self.path = os.path.join(path, name.upper())
+        self.name = name.upper()
+        self.err = err
+        self.logger = logger
+        try:
+            with open(os.path.join(self.path, 'meta.json')) as f:
+                meta = json.load(f)
+            self.index = np.load(os.path.join(self.path, 'index.npy'))
+        except IOError:
+            self.err.setError(-9)
+            self.err.handleError()
+        self.nside = int(meta['nside'])
+        self.columns = [(str(col), str(dtype)) for col, dtype in meta['columns']]
+
+    def _read_tile(self, pix, n):
+        tile = {}
+        for col, dtype in self.columns:
+            tile[col] = np.memmap(os.path.join(self.path, str(pix), col + '.bin'), dtype=dtype, mode='r', shape=(n,))
+        return tile
+
+    def cone(self, ra, dec, sr, mag_col, mag_bright_lim, mag_faint_lim, max_sources):
+        '''
+        cone search the store. as with the web service SCS, objects are restricted to [mag_bright_lim] <=
+        [mag_col] <= [mag_faint_lim] and ordered by distance, up to [max_sources] of them.
+
+        returns a dict of column arrays.
+        '''
+        covering = self.index[gcd(ra, dec, self.index['RA'], self.index['DEC']) - self.index['RADIUS'] <= sr]
+        self.logger.info("(tileStore.cone) Reading " + str(len(covering)) + " " + self.name + " tile(s) covering " + str(ra) + " " + str(dec) + ", " + str(sr) + " deg")
+
+        parts = dict([(col, []) for col, dtype in self.columns])
+        dists = []
+        for entry in covering:
+            tile = self._read_tile(entry['PIX'], entry['N'])
+            dist = gcd(ra, dec, tile['ra'], tile['dec'])
+            keep = (dist <= sr) & (tile[mag_col] >= float(mag_bright_lim)) & (tile[mag_col] <= float(mag_faint_lim))
+            for col, dtype in self.columns:
+                parts[col].append(np.asarray(tile[col][keep]))
+            dists.append(dist[keep])
+
+        order = np.argsort(np.concatenate(dists + [np.empty(0)]), kind='mergesort')[:int(max_sources)]
+        res = {}
+        for col, dtype in self.columns:
+            res[col] = np.concatenate(parts[col] + [np.empty(0, dtype=dtype)])[order]
+        return res
+
+def build(path, name, nside, dumps, logger, chunk_size=1000000):
+    '''
+    build the tiles for catalogue [name] from CSV [dumps] with a header row of SCS column names.
+    rows with unparsable values are skipped, as they are when reading from the web service. any 
+    existing tiles for the catalogue are replaced.
+    '''
+    name = name.upper()
+    columns = COLUMNS[name]
+    root = os.path.join(path, name)
+    if os.path.exists(root):
+        logger.info("(tiles.build) Removing existing tiles in " + root)
+        shutil.rmtree(root)
+    os.makedirs(root)
+
+    def flush(rows):
+        data = np.array(rows, dtype=columns)
+        pix = ang2pix_nest(nside, data['ra'], data['dec'])
+        order = np.argsort(pix, kind='mergesort')
+        data, pix = data[order], pix[order]
+        bounds = np.flatnonzero(np.diff(pix)) + 1
+        for start, end in zip(np.concatenate([[0], bounds]), np.concatenate([bounds, [len(pix)]])):
+            tile_dir = os.path.join(root, str(pix[start]))
+            if not os.path.exists(tile_dir):
+                os.makedirs(tile_dir)
+            for col, dtype in columns:
+                with open(os.path.join(tile_dir, col + '.bin'), 'ab') as f:
+                    np.ascontiguousarray(data[col][start:end]).tofile(f)
+
+    nrows, nskipped = 0, 0
+    for dump in dumps:
+        logger.info("(tiles.build) Reading " + dump)
+        rows = []
+        with open(dump, 'rb') as f:
+            for entry in csv.DictReader(f):
+                try:
+                    rows.append(tuple([str(entry[col]) if dtype.startswith('S') else float(entry[col]) for col, dtype in columns]))
+                except (ValueError, TypeError):
+                    nskipped = nskipped + 1
+                    continue
+                if len(rows) == chunk_size:
+                    flush(rows)
+                    nrows, rows = nrows + len(rows), []
+        if rows:
+            flush(rows)
+            nrows = nrows + len(rows)
+    logger.info("(tiles.build) Tiled " + str(nrows) + " " + name + " object(s), skipped " + str(nskipped))
+
+    # index each tile by the centre and radius of its objects
+    index = []
+    for d in os.listdir(root):
+        if not d.isdigit():
+            continue
+        ra = np.fromfile(os.path.join(root, d, 'ra.bin'), dtype='f8')
+        dec = np.fromfile(os.path.join(root, d, 'dec.bin'), dtype='f8')
+        x, y, z = np.mean(np.cos(np.radians(dec))*np.cos(np.radians(ra))), np.mean(np.cos(np.radians(dec))*np.sin(np.radians(ra))), np.mean(np.sin(np.radians(dec)))
+        cra, cdec = np.degrees(np.arctan2(y, x)) % 360, np.degrees(np.arctan2(z, np.hypot(x, y)))
+        index.append((int(d), len(ra), cra, cdec, gcd(cra, cdec, ra, dec).max()))
+    np.save(os.path.join(root, 'index.npy'), np.array(index, dtype=[('PIX', 'i8'), ('N', 'i8'), ('RA', 'f8'), ('DEC', 'f8'), ('RADIUS', 'f8')]))
+    with open(os.path.join(root, 'meta.json'), 'w') as f:
+        json.dump({'nside': nside, 'columns': columns}, f)
+    logger.info("(tiles.build) Wrote index of " + str(len(index)) + " tile(s) to " + root)
+
+if __name__ == "__main__":
+    import logging
+
+    parser = optparse.OptionParser(usage="%prog [options] dump.csv [dump.csv ...]")
+    parser.add_option('--c', action='store', default='APASS', type=str, dest='catalogue', help='catalogue (APASS|USNOB)')
+    parser.add_option('--o', action='store', type=str, dest='path', help='path to root of tile store')
+    parser.add_option('--n', action='store', default=32, type=int, dest='nside', help='HEALPix nside (power of 2)')
+    options, dumps = parser.parse_args()
+    if options.path is None or not dumps:
+        parser.error("a tile store path and at least one dump file are required")
+
+    logger = logging.getLogger('skycam_tiles_build')
+    logger.setLevel(logging.INFO)
+    ch = logging.StreamHandler()
+    ch.setFormatter(logging.Formatter("(" + str(os.getpid()) + ") %(asctime)s:%(levelname)s: %(message)s"))
+    logger.addHandler(ch)
+
+    build(options.path, options.catalogue, options.nside, dumps, logger)
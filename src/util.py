@@ -14,6 +14,8 @@ import ConfigParser
 import math
 import tarfile
 
+import numpy as np
+
 import pyspherematch as pysm
 from FITSFile import FITSFile
 
@@ -64,6 +66,56 @@ def decompress_files(path, err, logger):
 def dms_2_deg(DMS):
     return (float(DMS.split(':')[0])) + (float(DMS.split(':')[1])*(1./60.)) + (float(DMS.split(':')[2])*(1./3600.)); 
       
+def find_delta_cones(lastPointing, pointing, radius, max_cones=32, max_area_frac=0.5):
+    '''
+    find a set of small cones (ra, dec, radius) covering the crescent of the cone at [pointing] that lies 
+    outside the cone of the same [radius] at [lastPointing]. cones are centred along the leading edge of the 
+    new cone, sized so that adjacent cones cover the crescent to its full depth.
+
+    returns None if the cones barely overlap, or if covering the crescent would take more than [max_cones] 
+    cones or more than [max_area_frac] of the area of a full query.
+    '''
+    d = find_pointing_angle_diff(lastPointing, pointing)
+    if d >= radius:
+        return None
+    if d == 0:
+        return []
+
+    # bearings around the new cone's edge that lie outside the old cone
+    ra0, dec0, sr = np.radians(pointing[0]), np.radians(pointing[1]), np.radians(radius)
+    bearings = np.linspace(-np.pi, np.pi, 720, endpoint=False)
+    toLast = np.arctan2(np.sin(np.radians(lastPointing[0]) - ra0)*np.cos(np.radians(lastPointing[1])), 
+                        np.cos(dec0)*np.sin(np.radians(lastPointing[1])) - 
+                        np.sin(dec0)*np.cos(np.radians(lastPointing[1]))*np.cos(np.radians(lastPointing[0]) - ra0))
+    bearings = bearings + toLast + np.pi                        # centred on the direction of travel
+    edge = _destination(ra0, dec0, sr, bearings)
+    outside = pysm._great_circle_distance(lastPointing[0], lastPointing[1], np.degrees(edge[0]), np.degrees(edge[1])) > radius
+    if not outside.any():                                       # moved by less than the edge distances can resolve
+        return []
+    halfAngle = np.abs(bearings[outside] - toLast - np.pi).max() + (bearings[1] - bearings[0])
+
+    # space cones along the arc so that the gap between neighbours is still covered to depth d
+    arcLength = 2*halfAngle*np.degrees(np.sin(sr))
+    r = 2*d
+    n = int(np.ceil(arcLength / (2*np.sqrt(3)*d))) + 1
+    if n > max_cones:
+        n = max_cones
+        r = np.sqrt(d**2 + (arcLength/(n - 1)/2)**2)
+    r = 1.1*r
+    if n*r**2 > max_area_frac*radius**2:
+        return None
+
+    centres = _destination(ra0, dec0, sr, toLast + np.pi + np.linspace(-halfAngle, halfAngle, n))
+    return [(cra % 360, cdec, r) for cra, cdec in zip(np.degrees(centres[0]).tolist(), np.degrees(centres[1]).tolist())]
+
+def _destination(ra, dec, dist, bearing):
+    '''
+    find the position (rad) reached by travelling [dist] (rad) along [bearing] from [ra], [dec] (rad).
+    '''
+    dec2 = np.arcsin(np.sin(dec)*np.cos(dist) + np.cos(dec)*np.sin(dist)*np.cos(bearing))
+    ra2 = ra + np.arctan2(np.sin(bearing)*np.sin(dist)*np.cos(dec), np.cos(dist) - np.sin(dec)*np.sin(dec2))
+    return ra2, dec2
+
 def find_pointing_angle_diff(pointing1, pointing2):
     '''
     find great circle difference in degrees between two sets of ra/dec
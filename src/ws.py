@@ -4,168 +4,435 @@ author:		rmb
 
 description: 	wrappers to talk to webservices
 '''
+import os
 import requests
-from requests.exceptions import ConnectionError
+from requests.adapters import HTTPAdapter
+from requests.exceptions import RequestException, ConnectionError, ConnectTimeout
+from requests.packages.urllib3.exceptions import MaxRetryError, NewConnectionError
 import urllib
 import json
 import time
+import random
+import threading
+import Queue
+import gzip
+import zlib
+from io import BytesIO
+from collections import deque
+
+import numpy as np
+
+# connection pool settings for the per-process session, see configure_session()
+_session_params = {'pool_size': 4, 'timeout': (10, 180)}
+_sessions       = {}
+_sessions_lock  = threading.Lock()
+
+def configure_session(pool_size, connect_timeout, read_timeout):
+    '''
+    set the pool size and (connect, read) timeouts (s) used by ws_catalogue. takes effect from the next 
+    session created.
+    '''
+    with _sessions_lock:
+        _session_params['pool_size'] = int(pool_size)
+        _session_params['timeout'] = (float(connect_timeout), float(read_timeout))
+        _sessions.clear()
+
+def get_session():
+    '''
+    returns this process's keep-alive session, shared by every ws_catalogue so that connections to the 
+    webservices are pooled and reused. sessions are keyed on pid, so a forked process never reuses its 
+    parent's sockets.
+    '''
+    pid = os.getpid()
+    with _sessions_lock:
+        if pid not in _sessions:
+            _sessions.clear()
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=_session_params['pool_size'], pool_maxsize=_session_params['pool_size'])
+            session.mount('http://', adapter)
+            session.mount('https://', adapter)
+            _sessions[pid] = session
+        return _sessions[pid]
+
+# retry, hedging and circuit breaker policy for ws_catalogue, see configure_retries()
+_retry_params = {'max_retries': 5, 'retry_delay': 1., 'max_retry_delay': 30., 'hedge': False, 'hedge_quantile': 95., 
+                 'breaker_threshold': 5, 'breaker_cooldown': 60.}
+
+def configure_retries(max_retries, retry_delay, max_retry_delay, hedge, hedge_quantile, breaker_threshold, breaker_cooldown):
+    '''
+    set the retry policy used by ws_catalogue. failed attempts are retried up to [max_retries] times after an
+    exponential backoff starting at [retry_delay] and capped at [max_retry_delay] (s), with full jitter. if 
+    [hedge] is set, SCS requests that haven't answered within the [hedge_quantile] percentile of their recent
+    latencies are duplicated. a host is failed fast for [breaker_cooldown] (s) after [breaker_threshold] 
+    consecutive failed attempts.
+    '''
+    _retry_params['max_retries'] = int(max_retries)
+    _retry_params['retry_delay'] = float(retry_delay)
+    _retry_params['max_retry_delay'] = float(max_retry_delay)
+    _retry_params['hedge'] = bool(hedge)
+    _retry_params['hedge_quantile'] = float(hedge_quantile)
+    _retry_params['breaker_threshold'] = int(breaker_threshold)
+    _retry_params['breaker_cooldown'] = float(breaker_cooldown)
+
+class latencyTracker():
+    '''
+    recent request latencies (s), by endpoint.
+    '''
+    def __init__(self, max_samples=100, min_samples=10):
+        self.max_samples = max_samples
+        self.min_samples = min_samples
+        self._samples = {}
+        self._lock = threading.Lock()
+
+    def record(self, endpoint, latency):
+        with self._lock:
+            self._samples.setdefault(endpoint, deque(maxlen=self.max_samples)).append(latency)
+
+    def quantile(self, endpoint, q):
+        '''
+        returns the [q] percentile of [endpoint]'s recent latencies, or None if there aren't enough of them.
+        '''
+        with self._lock:
+            samples = list(self._samples.get(endpoint, []))
+        if len(samples) < self.min_samples:
+            return None
+        return float(np.percentile(samples, q))
+
+class circuitBreaker():
+    '''
+    fails requests to a host fast once it has failed [breaker_threshold] attempts in a row. after 
+    [breaker_cooldown] (s) a single trial request is let through; its success closes the breaker, its failure 
+    opens it for another cooldown.
+    '''
+    def __init__(self):
+        self.failures = 0
+        self.open_until = None
+        self.trial = False
+        self._lock = threading.Lock()
+
+    def allow(self):
+        with self._lock:
+            if self.open_until is None:
+                return True
+            if time.time() < self.open_until or self.trial:
+                return False
+            self.trial = True
+            return True
+
+    def success(self):
+        with self._lock:
+            self.failures = 0
+            self.open_until = None
+            self.trial = False
+
+    def release(self):
+        '''
+        let another trial request through, if this one ended without a success or failure being recorded.
+        '''
+        with self._lock:
+            self.trial = False
+
+    def failure(self):
+        '''
+        record a failed attempt, returning True if it opened the breaker.
+        '''
+        with self._lock:
+            self.failures = self.failures + 1
+            if self.trial or (self.open_until is None and self.failures >= _retry_params['breaker_threshold']):
+                self.open_until = time.time() + _retry_params['breaker_cooldown']
+                self.trial = False
+                return True
+            return False
+
+def _never_sent(e):
+    '''
+    returns True if request error [e] means the request never reached the server, i.e. a new connection couldn't 
+    be made.
+    '''
+    if isinstance(e, ConnectTimeout):
+        return True
+    if isinstance(e, ConnectionError) and e.args:
+        reason = e.args[0]
+        if isinstance(reason, MaxRetryError):
+            reason = reason.reason
+        return isinstance(reason, NewConnectionError)
+    return False
+
+_latencies      = latencyTracker()
+_breakers       = {}
+_breakers_lock  = threading.Lock()
+
+def get_breaker(ip, port):
+    '''
+    returns the circuit breaker for host [ip]:[port], shared by every ws_catalogue in the process.
+    '''
+    with _breakers_lock:
+        return _breakers.setdefault((str(ip), str(port)), circuitBreaker())
+
+# format of buffer uploads, see configure_payloads()
+_payload_params = {'columnar': False, 'compression': 'none'}
+
+def configure_payloads(columnar, compression):
+    '''
+    set the format of buffer uploads made by ws_catalogue: rows as a list of dicts or, if [columnar], a dict 
+    of field name to list of values, with the request body compressed by [compression] (none||gzip||deflate).
+    '''
+    if compression not in ('none', 'gzip', 'deflate'):
+        raise ValueError('invalid compression ' + str(compression))
+    _payload_params['columnar'] = bool(columnar)
+    _payload_params['compression'] = compression
+
+def to_columns(rows):
+    '''
+    returns [rows] (a list of dicts) as a dict of field name to list of values. fields missing from a row are None.
+    '''
+    keys = set()
+    for row in rows:
+        keys.update(row)
+    return dict([(key, [row.get(key) for row in rows]) for key in keys])
+
+def to_rows(payload):
+    '''
+    returns an uploaded [payload] as a list of dicts, whether it was sent as rows or columns.
+    '''
+    if not isinstance(payload, dict):
+        return payload
+    keys = payload.keys()
+    return [dict(zip(keys, values)) for values in zip(*[payload[key] for key in keys])]
+
+def encode_body(payload, compression):
+    '''
+    returns [payload] as a JSON request body compressed by [compression], and its headers.
+    '''
+    body = json.dumps(payload, separators=(',', ':'))
+    headers = {'Content-Type': 'application/json'}
+    if compression == 'gzip':
+        buf = BytesIO()
+        with gzip.GzipFile(fileobj=buf, mode='wb', compresslevel=1) as f:
+            f.write(body)
+        body = buf.getvalue()
+        headers['Content-Encoding'] = 'gzip'
+    elif compression == 'deflate':
+        body = zlib.compress(body, 1)
+        headers['Content-Encoding'] = 'deflate'
+    return body, headers
+
+def decode_body(body, encoding=None):
+    '''
+    returns the payload of a JSON request [body] with Content-Encoding [encoding].
+    '''
+    if encoding == 'gzip':
+        body = gzip.GzipFile(fileobj=BytesIO(body)).read()
+    elif encoding == 'deflate':
+        body = zlib.decompress(body)
+    return json.loads(body)
 
 class ws_catalogue:
-    def __init__(self, ip, port, err, logger, max_retries=5, retry_delay=5):
+    def __init__(self, ip, port, err, logger, max_retries=None, retry_delay=None):
         self.ip         = ip
         self.port       = port
         self.err	= err
         self.logger	= logger
         self.status     = None
         self.text       = None
-        self.max_retries = 5
-        self.retry_delay = 20
-        self.timeout     = 180
-        
-    def SCS(self, catalogue, ra, dec, sr, mag_col, mag_bright_lim, mag_faint_lim, order_col, max_sources, output_format):
-        conn_retry_count = 1
-        while conn_retry_count <= self.max_retries:
+        self.content    = None
+        self.response   = None
+        self.max_retries = max_retries if max_retries is not None else _retry_params['max_retries']
+        self.retry_delay = retry_delay if retry_delay is not None else _retry_params['retry_delay']
+        self.session     = get_session()
+        self.timeout     = _session_params['timeout']
+        self.breaker     = get_breaker(ip, port)
+
+    def _backoff(self, attempt):
+        # exponential backoff with full jitter, so retrying processes don't all come back at once
+        return random.uniform(0, min(self.retry_delay*2**(attempt-1), _retry_params['max_retry_delay']))
+
+    def _hedged(self, endpoint, method, url, **kwargs):
+        '''
+        make an idempotent request, sending a duplicate if the first hasn't answered within the endpoint's usual 
+        latency. whichever answers first is used and the other is closed when it arrives.
+        '''
+        delay = _latencies.quantile(endpoint, _retry_params['hedge_quantile'])
+        if delay is None:
+            return getattr(self.session, method)(url, timeout=self.timeout, **kwargs)
+
+        results = Queue.Queue()
+        claimed = []
+        lock = threading.Lock()
+        def attempt():
+            try:
+                req = getattr(self.session, method)(url, timeout=self.timeout, **kwargs)
+            except Exception, e:                # always answer, or the caller waits forever
+                results.put((None, e))
+                return
+            with lock:
+                won = not claimed
+                claimed.append(req)
+            if won:
+                results.put((req, None))
+            else:
+                req.close()
+
+        def start():
+            t = threading.Thread(target=attempt)
+            t.daemon = True
+            t.start()
+
+        start()
+        try:
+            req, e = results.get(timeout=delay)
+        except Queue.Empty:
+            self.logger.info("(ws." + endpoint + ") No response after " + str(round(delay, 2)) + "s, sending hedged request")
+            start()
+            req, e = results.get()
+            if req is None:                     # one attempt failed, wait on the other
+                req, e = results.get()
+        if req is None:
+            raise e
+        return req
+
+    def _request(self, endpoint, method, path, hedge=False, idempotent=None, **kwargs):
+        '''
+        make a request to [path], retrying failed attempts with backoff. connection errors and 5xx responses 
+        count as failures. fails fast while the host's circuit breaker is open.
+
+        only GETs are assumed [idempotent]. anything else is retried only if a new connection couldn't be made, 
+        as any later error (a timeout or reset after the body was sent, or a 5xx response) may mean the write 
+        already happened.
+
+        returns the response, or None if no attempt got one.
+        '''
+        url = 'http://' + str(self.ip) + ':' + str(self.port) + path
+        if idempotent is None:
+            idempotent = method == 'get'
+        req = None
+        for attempt in range(1, self.max_retries + 1):
+            if not self.breaker.allow():
+                self.logger.warning("(ws." + endpoint + ") Webservice at " + str(self.ip) + ":" + str(self.port) + " is down, failing fast")
+                return req
+            start = time.time()
+            recorded = False
             try:
-                req = requests.get('http://' + str(self.ip) + ':' + str(self.port) + '/scs/' + str(catalogue) + '/' + str(ra) 
-                                   + '/' + str(dec) + '/' + str(sr) + '/' + mag_col + '/' + str(mag_bright_lim) + '/' 
-                                   + str(mag_faint_lim) + '/' + order_col + '/' + str(max_sources) + '/' + output_format, timeout=self.timeout)   
-		break
-	    except:
-	      	self.logger.warning("(ws.SCS) Webservice connection error (" + str(conn_retry_count) + "/" + str(self.max_retries) + "), retrying in " + str(self.retry_delay) + "s")
-	        time.sleep(self.retry_delay)
-	    conn_retry_count = conn_retry_count + 1
+                try:
+                    if hedge:
+                        req = self._hedged(endpoint, method, url, **kwargs)
+                    else:
+                        req = getattr(self.session, method)(url, timeout=self.timeout, **kwargs)
+                    recorded = True
+                except RequestException, e:
+                    recorded = True
+                    req = None
+                    error = "connection error"
+                    retry = idempotent or _never_sent(e)
+            finally:
+                if not recorded:                # an unexpected error mustn't leave a trial request outstanding
+                    self.breaker.release()
+            if req is not None and req.status_code < 500:
+                self.breaker.success()
+                _latencies.record(endpoint, time.time() - start)
+                return req
+            if req is not None:
+                error = "error " + str(req.status_code)
+                retry = idempotent
+            if self.breaker.failure():
+                self.logger.warning("(ws." + endpoint + ") Webservice at " + str(self.ip) + ":" + str(self.port) + " marked as down for " + str(_retry_params['breaker_cooldown']) + "s, giving up")
+                break
+            if attempt == self.max_retries:
+                self.logger.warning("(ws." + endpoint + ") Webservice " + error + " (" + str(attempt) + "/" + str(self.max_retries) + "), giving up")
+                break
+            if not retry:
+                self.logger.warning("(ws." + endpoint + ") Webservice " + error + " after the request was sent, not retrying")
+                break
+            delay = self._backoff(attempt)
+            self.logger.warning("(ws." + endpoint + ") Webservice " + error + " (" + str(attempt) + "/" + str(self.max_retries) + "), retrying in " + str(round(delay, 1)) + "s")
+            if req is not None:
+                req.close()
+                req = None
+            time.sleep(delay)
+        return req
+
+    def _upload(self, endpoint, method, path, payload):
+        '''
+        make a request with a JSON [payload], in the configured format and compression.
+        '''
+        body, headers = encode_body(payload, _payload_params['compression'])
+        return self._request(endpoint, method, path, data=body, headers=headers)
+
+    def _rows(self, rows):
+        if _payload_params['columnar']:
+            return to_columns(rows)
+        return rows
+
+    def _setResult(self, req):
+        self.response = None
+        self.content = None
+        if req is None:
+            self.text   = None
+            self.status = None
+            return
         if req.status_code == 200:
             self.text   = req.text
         else:
             self.text   = None
         self.status = req.status_code
         
-    def skycam_catalogue_add_to_buffer(self, uuid, values): 
-        conn_retry_count = 1
-        while conn_retry_count <= self.max_retries:
-	    try:
-                req = requests.put('http://' + str(self.ip) + ':' + str(self.port) + '/skycam/tables/catalogue/buffer/' + uuid, json=values) 
-                break
-	    except ConnectionError:
-	      	self.logger.warning("(ws.skycam_catalogue_add_to_buffer) Webservice connection error (" + str(conn_retry_count) + "/" + str(self.max_retries) + "), retrying in " + str(self.retry_delay) + "s")
-	        time.sleep(self.retry_delay)
-	    conn_retry_count = conn_retry_count + 1
-        if req.status_code == 200:
+    def SCS(self, catalogue, ra, dec, sr, mag_col, mag_bright_lim, mag_faint_lim, order_col, max_sources, output_format, stream=False):
+        req = self._request('SCS', 'get', '/scs/' + str(catalogue) + '/' + str(ra) + '/' + str(dec) + '/' + str(sr) + '/' + mag_col + '/' 
+                            + str(mag_bright_lim) + '/' + str(mag_faint_lim) + '/' + order_col + '/' + str(max_sources) + '/' + output_format, 
+                            hedge=_retry_params['hedge'], stream=stream)
+        self.response = None
+        if req is None:
+            self.text   = None
+            self.content = None
+            self.status = None
+            return
+        if req.status_code == 200 and stream:
+            self.text   = None
+            self.content = None
+            self.response = req           # body is left unread for the caller to stream
+            req.raw.decode_content = True
+        elif req.status_code == 200:
             self.text   = req.text
+            self.content = req.content     # raw body, for binary output formats
         else:
             self.text   = None
-        self.status = req.status_code       
+            self.content = None
+            req.content                   # read the error body, releasing the connection back to the pool
+        self.status = req.status_code
+        
+    def skycam_catalogue_add_to_buffer(self, uuid, values): 
+        req = self._upload('skycam_catalogue_add_to_buffer', 'put', '/skycam/tables/catalogue/buffer/' + uuid, self._rows(values))
+        self._setResult(req)
         
     def skycam_catalogue_flush_buffer_to_db(self, schema, uuid):   
-        conn_retry_count = 1
-        while conn_retry_count <= self.max_retries:
-	    try:
-                req = requests.post('http://' + str(self.ip) + ':' + str(self.port) + '/skycam/tables/catalogue/buffer/' + schema + '/' + uuid)  
-                break
-	    except ConnectionError:
-	      	self.logger.warning("(ws.skycam_catalogue_flush_buffer_to_db) Webservice connection error (" + str(conn_retry_count) + "/" + str(self.max_retries) + "), retrying in " + str(self.retry_delay) + "s")
-	        time.sleep(self.retry_delay)
-	    conn_retry_count = conn_retry_count + 1
-        if req.status_code == 200:
-            self.text   = req.text
-        else:
-            self.text   = None
-        self.status = req.status_code         
+        req = self._request('skycam_catalogue_flush_buffer_to_db', 'post', '/skycam/tables/catalogue/buffer/' + schema + '/' + uuid)
+        self._setResult(req)
                  
     def skycam_catalogue_insert(self, schema, values):
-        conn_retry_count = 1
-        while conn_retry_count <= self.max_retries:
-	    try:
-                req = requests.post('http://' + str(self.ip) + ':' + str(self.port) + '/skycam/tables/catalogue/' + schema, json=values)  
-                break
-	    except ConnectionError:
-	      	self.logger.warning("(ws.skycam_catalogue_insert) Webservice connection error (" + str(conn_retry_count) + "/" + str(self.max_retries) + "), retrying in " + str(self.retry_delay) + "s")
-	        time.sleep(self.retry_delay)
-	    conn_retry_count = conn_retry_count + 1  
-        if req.status_code == 200:
-            self.text   = req.text
-        else:
-            self.text   = None
-        self.status = req.status_code     
+        req = self._request('skycam_catalogue_insert', 'post', '/skycam/tables/catalogue/' + schema, json=values)
+        self._setResult(req)
         
     def skycam_flush_buffers_by_uuid_to_db(self, schema, img_id, uuid):    
-        conn_retry_count = 1
-        while conn_retry_count <= self.max_retries:
-	    try:
-                req = requests.post('http://' + str(self.ip) + ':' + str(self.port) + '/skycam/transactions/flush/' + schema + '/' + img_id + '/' + uuid)
-                break
-	    except ConnectionError:
-	      	self.logger.warning("(ws.skycam_flush_two_buffers_to_db) Webservice connection error (" + str(conn_retry_count) + "/" + str(self.max_retries) + "), retrying in " + str(self.retry_delay) + "s")
-	        time.sleep(self.retry_delay)
-	    conn_retry_count = conn_retry_count + 1             
-        if req.status_code == 200:
-            self.text   = req.text
-        else:
-            self.text   = None
-        self.status = req.status_code         
+        req = self._request('skycam_flush_buffers_by_uuid_to_db', 'post', '/skycam/transactions/flush/' + schema + '/' + img_id + '/' + uuid)
+        self._setResult(req)
       
     def skycam_images_get_by_filename(self, schema, filename):
-        conn_retry_count = 1
-        while conn_retry_count <= self.max_retries:
-	    try:
-                req = requests.get('http://' + str(self.ip) + ':' + str(self.port) + '/skycam/tables/images/' + schema + '/filename/' + filename)  
-                break
-	    except ConnectionError:
-	      	self.logger.warning("(ws.skycam_images_get_by_filename) Webservice connection error (" + str(conn_retry_count) + "/" + str(self.max_retries) + "), retrying in " + str(self.retry_delay) + "s")
-	        time.sleep(self.retry_delay)
-	    conn_retry_count = conn_retry_count + 1     
-        if req.status_code == 200:
-            self.text   = req.text
-        else:
-            self.text   = None
-        self.status = req.status_code
+        req = self._request('skycam_images_get_by_filename', 'get', '/skycam/tables/images/' + schema + '/filename/' + filename)
+        self._setResult(req)
         
     def skycam_images_insert(self, schema, values):
-        conn_retry_count = 1
-        while conn_retry_count <= self.max_retries:
-	    try:
-                req = requests.post('http://' + str(self.ip) + ':' + str(self.port) + '/skycam/tables/images/' + schema, json=values)
-                break
-	    except ConnectionError:
-	      	self.logger.warning("(ws.skycam_images_insert) Webservice connection error (" + str(conn_retry_count) + "/" + str(self.max_retries) + "), retrying in " + str(self.retry_delay) + "s")
-	        time.sleep(self.retry_delay)
-	    conn_retry_count = conn_retry_count + 1                 
-        if req.status_code == 200:
-            self.text   = req.text
-        else:
-            self.text   = None
-        self.status = req.status_code        
+        req = self._request('skycam_images_insert', 'post', '/skycam/tables/images/' + schema, json=values)
+        self._setResult(req)
                 
     def skycam_sources_add_to_buffer(self, uuid, values): 
-        conn_retry_count = 1
-        while conn_retry_count <= self.max_retries:
-	    try:
-                req = requests.put('http://' + str(self.ip) + ':' + str(self.port) + '/skycam/tables/sources/buffer/' + uuid, json=values) 
-                break
-	    except ConnectionError:
-	      	self.logger.warning("(ws.skycam_sources_add_to_buffer) Webservice connection error (" + str(conn_retry_count) + "/" + str(self.max_retries) + "), retrying in " + str(self.retry_delay) + "s")
-	        time.sleep(self.retry_delay)
-	    conn_retry_count = conn_retry_count + 1                       
-        if req.status_code == 200:
-            self.text   = req.text
-        else:
-            self.text   = None
-        self.status = req.status_code       
+        req = self._upload('skycam_sources_add_to_buffer', 'put', '/skycam/tables/sources/buffer/' + uuid, self._rows(values))
+        self._setResult(req)
         
     def skycam_sources_flush_buffer_to_db(self, schema, uuid):    
-        conn_retry_count = 1
-        while conn_retry_count <= self.max_retries:
-	    try:
-                req = requests.post('http://' + str(self.ip) + ':' + str(self.port) + '/skycam/tables/sources/buffer/' + schema + '/' + uuid)
-                break
-	    except ConnectionError:
-	      	self.logger.warning("(ws.skycam_sources_flush_buffer_to_db) Webservice connection error (" + str(conn_retry_count) + "/" + str(self.max_retries) + "), retrying in " + str(self.retry_delay) + "s")
-	        time.sleep(self.retry_delay)
-	    conn_retry_count = conn_retry_count + 1             
-        if req.status_code == 200:
-            self.text   = req.text
-        else:
-            self.text   = None
-        self.status = req.status_code         
-    
-            
+        req = self._request('skycam_sources_flush_buffer_to_db', 'post', '/skycam/tables/sources/buffer/' + schema + '/' + uuid)
+        self._setResult(req)
+        
+    def skycam_batch_to_db(self, schema, uuid, images, catalogue, sources):
+        req = self._upload('skycam_batch_to_db', 'post', '/skycam/transactions/batch/' + schema + '/' + uuid, 
+                           {'images': images, 'catalogue': self._rows(catalogue), 'sources': self._rows(sources)})
+        self._setResult(req)
@@ -0,0 +1,180 @@
+#!/bin/python
+'''
+name:		ws_standin.py
+author:		rmb
+
+description: 	A stand-in for the catalogue webservices, for testing without them.
+
+                serves reference catalogue cone searches (/scs/...) from a local tile store (see tiles.py),
+                in either the json or the binary npy output format, e.g.
+                python ws_standin.py --t /mnt/NAS/devel/skycam/tiles --p 8080
+
+                also accepts Skycam image inserts, buffer uploads and flushes (/skycam/...), as rows or 
+                columns with optionally compressed bodies, into in-memory tables.
+'''
+import os
+import json
+import zlib
+import logging
+import optparse
+import threading
+from io import BytesIO
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from SocketServer import ThreadingMixIn
+
+import numpy as np
+
+from tiles import tileStore
+from ws import decode_body, to_rows
+
+class standinHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'       # keep connections alive, as the webservices do
+    def do_GET(self):
+        parts = self.path.strip('/').split('/')
+        if len(parts) == 11 and parts[0] == 'scs':
+            self._SCS(*parts[1:])
+        else:
+            self._reply(404, 'text/plain', 'not found')
+
+    def do_PUT(self):
+        parts = self.path.strip('/').split('/')
+        if len(parts) == 5 and parts[:2] == ['skycam', 'tables'] and parts[2] in ('catalogue', 'sources') and parts[3] == 'buffer':
+            self._addToBuffer(parts[2], parts[4])
+        else:
+            self._reply(404, 'text/plain', 'not found')
+
+    def do_POST(self):
+        parts = self.path.strip('/').split('/')
+        if len(parts) == 4 and parts[:3] == ['skycam', 'tables', 'images']:
+            self._insertImage(parts[3])
+        elif len(parts) == 6 and parts[:3] == ['skycam', 'transactions', 'flush']:
+            self._flushBuffers(parts[3], parts[4], parts[5])
+        elif len(parts) == 5 and parts[:3] == ['skycam', 'transactions', 'batch']:
+            self._batch(parts[3], parts[4])
+        else:
+            self._reply(404, 'text/plain', 'not found')
+
+    def _readPayload(self):
+        # returns None (having replied) if the body can't be decoded
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        try:
+            return decode_body(body, self.headers.get('Content-Encoding'))
+        except (ValueError, IOError, zlib.error):
+            self._reply(400, 'text/plain', 'bad payload')
+            return None
+
+    def _insertImage(self, schema):
+        values = self._readPayload()
+        if values is None:
+            return
+        with self.server.lock:
+            self.server.tables(schema)['images'].append(values)
+        self._reply(200, 'application/json', json.dumps({'inserted': 1}))
+
+    def _addToBuffer(self, table, uuid):
+        payload = self._readPayload()
+        if payload is None:
+            return
+        rows = to_rows(payload)
+        with self.server.lock:
+            self.server.buffers.setdefault((table, uuid), []).extend(rows)
+        self._reply(200, 'application/json', json.dumps({'buffered': len(rows)}))
+
+    def _flushBuffers(self, schema, img_id, uuid):
+        with self.server.lock:
+            catalogue = self.server.buffers.pop(('catalogue', uuid), [])
+            sources = self.server.buffers.pop(('sources', uuid), [])
+            self.server.commit(schema, [], catalogue, sources)
+            for image in self.server.tables(schema)['images']:
+                if image.get('IMG_ID') == img_id:
+                    image['SUCCESS'] = True
+        self._reply(200, 'application/json', json.dumps({'catalogue': len(catalogue), 'sources': len(sources)}))
+
+    def _batch(self, schema, uuid):
+        payload = self._readPayload()
+        if payload is None:
+            return
+        images, catalogue, sources = to_rows(payload['images']), to_rows(payload['catalogue']), to_rows(payload['sources'])
+        for image in images:
+            image['SUCCESS'] = True
+        with self.server.lock:
+            self.server.commit(schema, images, catalogue, sources)
+        self._reply(200, 'application/json', json.dumps({'images': len(images), 'catalogue': len(catalogue), 'sources': len(sources)}))
+
+    def _SCS(self, catalogue, ra, dec, sr, mag_col, mag_bright_lim, mag_faint_lim, order_col, max_sources, output_format):
+        store = self.server.stores.get(catalogue.upper())
+        if store is None or order_col != 'distance' or output_format not in ('json', 'npy'):
+            self._reply(404, 'text/plain', 'not found')
+            return
+        cone = store.cone(float(ra), float(dec), float(sr), mag_col, float(mag_bright_lim), float(mag_faint_lim), int(max_sources))
+
+        if output_format == 'npy':
+            data = np.empty(len(cone['ra']), dtype=store.columns)
+            for col, dtype in store.columns:
+                data[col] = cone[col]
+            buf = BytesIO()
+            np.save(buf, data)
+            self._reply(200, 'application/octet-stream', buf.getvalue())
+        else:
+            cols = [col for col, dtype in store.columns]
+            rows = [dict(zip(cols, row)) for row in zip(*[cone[col].tolist() for col in cols])]
+            self._reply(200, 'application/json', json.dumps(rows))
+
+    def _reply(self, status, content_type, body):
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        self.server.logger.debug("(standinHandler) " + format % args)
+
+class standinServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, tiles_path, err, logger):
+        HTTPServer.__init__(self, address, standinHandler)
+        self.logger = logger
+        self.stores = {}
+        if tiles_path is not None:
+            for name in os.listdir(tiles_path):
+                if os.path.exists(os.path.join(tiles_path, name, 'meta.json')):
+                    self.stores[name] = tileStore(tiles_path, name, err, logger)
+        self.lock = threading.Lock()
+        self.buffers = {}
+        self._tables = {}
+        self.logger.info("(standinServer.__init__) Serving " + ', '.join(sorted(self.stores) + ['SKYCAM']) + " on port " + str(self.server_address[1]))
+
+    def tables(self, schema):
+        '''
+        returns the images, catalogue (keyed on skycamref) and sources tables for [schema].
+        '''
+        return self._tables.setdefault(schema, {'images': [], 'catalogue': {}, 'sources': []})
+
+    def commit(self, schema, images, catalogue, sources):
+        '''
+        add rows to [schema]'s tables, upserting the catalogue. callers hold the lock.
+        '''
+        tables = self.tables(schema)
+        tables['images'].extend(images)
+        for row in catalogue:
+            tables['catalogue'][row['skycamref']] = row
+        tables['sources'].extend(sources)
+
+if __name__ == "__main__":
+    from errors import errors
+
+    parser = optparse.OptionParser()
+    parser.add_option('--t', action='store', type=str, dest='tilesPath', help='path to root of tile store, if serving SCS')
+    parser.add_option('--p', action='store', default=8080, type=int, dest='port', help='port to listen on')
+    options, args = parser.parse_args()
+
+    logger = logging.getLogger('skycam_ws_standin')
+    logger.setLevel(logging.INFO)
+    ch = logging.StreamHandler()
+    ch.setFormatter(logging.Formatter("(" + str(os.getpid()) + ") %(asctime)s:%(levelname)s: %(message)s"))
+    logger.addHandler(ch)
+
+    server = standinServer(('', options.port), options.tilesPath, errors(logger, False), logger)
+    server.serve_forever()